@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+"""
+Benchmark of the annotation lookup modes of annotations.py: a Tabix
+fetch per variant and track ("fetch"), one sorted sweep per track
+("stream") and one fetch per track for each cluster of nearby variants
+in a block of BLOCK_SIZE variants ("block"), see --anno-lookup.
+
+Builds synthetic BED, VCF and per-position (CADD-like) Tabix files,
+looks up a sorted variant stream in each of them with every mode,
+checks that all modes return exactly the same hits and reports seeks
+per variant and wall time. A shuffled run checks the fallbacks.
+
+Usage: python anno_lookup_bench.py [n_variants] [workdir]
+"""
+import os
+import sys
+import time
+import random
+import tempfile
+
+import pysam
+
+from geminicassandra import annotations
+
+CHROM_LENGTH = 2000000
+# the default --buffer-size of load
+BLOCK_SIZE = 333
+
+
+class Var(object):
+    """The bits of a cyvcf record the annotation helpers look at."""
+    def __init__(self, chrom, pos, ref, alt):
+        self.CHROM = chrom
+        self.POS = pos
+        self.start = pos - 1
+        self.end = pos - 1 + len(ref)
+        self.REF = ref
+        self.ALT = [alt]
+
+
+def make_bed(path):
+    with open(path, "w") as bed:
+        for chrom in ["chr1", "chr2"]:
+            pos = 0
+            while pos < CHROM_LENGTH:
+                pos += random.randint(1, 400)
+                # mostly short intervals, a few very long ones
+                length = random.randint(1, 300) if random.random() < 0.99 else random.randint(10000, 200000)
+                bed.write("%s\t%d\t%d\tfeature%d\n" % (chrom, pos, pos + length, pos))
+    return pysam.tabix_index(path, preset="bed", force=True)
+
+
+def make_vcf(path):
+    with open(path, "w") as vcf:
+        vcf.write("##fileformat=VCFv4.1\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n")
+        for chrom in ["1", "2"]:
+            pos = 0
+            while pos < CHROM_LENGTH:
+                pos += random.randint(1, 60)
+                ref = random.choice(["A", "C", "GT", "TAC"])
+                info = "AF=0.%d" % random.randint(1, 99)
+                if random.random() < 0.01:
+                    info += ";END=%d" % (pos + random.randint(100, 5000))
+                vcf.write("%s\t%d\trs%d\t%s\tG\t.\tPASS\t%s\n" % (chrom, pos, pos, ref, info))
+    return pysam.tabix_index(path, preset="vcf", force=True)
+
+
+def make_scores(path):
+    with open(path, "w") as scores:
+        for chrom in ["1", "2"]:
+            for pos in xrange(1, CHROM_LENGTH / 4):
+                scores.write("%s\t%d\tA\t0.1,0.2,0.3\t1,2,3\n" % (chrom, pos))
+    return pysam.tabix_index(path, seq_col=0, start_col=1, end_col=1, force=True)
+
+
+def make_variants(n_variants, dense):
+    span = CHROM_LENGTH / 4 if dense else CHROM_LENGTH
+    variants = []
+    for chrom in ["chr1", "chr2"]:
+        for pos in sorted(random.sample(xrange(1, span), n_variants / 2)):
+            variants.append(Var(chrom, pos, random.choice(["A", "C", "GT"]), "T"))
+    return variants
+
+
+def lookup(variants, mode, tracks):
+    def annotate_variant(var, skip_cadd=False, skip_gerp_bp=False):
+        # block mode returns tuple hits as lists of fields
+        return [["\t".join(hit) if isinstance(hit, list) else str(hit)
+                 for hit in annotations.annotations_in_region(var, anno, parser_type, naming)]
+                for (anno, parser_type, naming) in tracks]
+
+    # annotate_block looks the variants up with annotate_variant
+    annotations.annotate_variant = annotate_variant
+    annotations.set_lookup_mode("fetch" if mode == "block" else mode)
+    start = time.time()
+    results = []
+    if mode == "block":
+        for i in xrange(0, len(variants), BLOCK_SIZE):
+            results.extend(annotations.annotate_block(variants[i:i + BLOCK_SIZE]))
+    else:
+        results = [annotate_variant(var) for var in variants]
+    elapsed = time.time() - start
+    (lookups, seeks) = annotations.get_lookup_counts()
+    return results, elapsed, seeks / float(len(variants))
+
+
+def run(name, variants, tracks):
+    (fetched, fetch_time, fetch_seeks) = lookup(variants, "fetch", tracks)
+    report = "%-16s fetch: %6.2f s, %5.2f seeks/variant" % (name, fetch_time, fetch_seeks)
+    for mode in ["stream", "block"]:
+        (hits, elapsed, seeks) = lookup(variants, mode, tracks)
+        if hits != fetched:
+            sys.exit("ERROR: %s: %s and fetch hits differ" % (name, mode))
+        report += " | %s: %6.2f s, %5.2f seeks/variant, %.1fx" % \
+            (mode, elapsed, seeks, fetch_time / max(elapsed, 1e-9))
+    print report
+
+
+if __name__ == "__main__":
+    n_variants = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    workdir = sys.argv[2] if len(sys.argv) > 2 else tempfile.mkdtemp()
+    random.seed(42)
+
+    annotations.annos["bench_bed"] = pysam.Tabixfile(make_bed(os.path.join(workdir, "bench.bed")))
+    annotations.annos["bench_vcf"] = pysam.Tabixfile(make_vcf(os.path.join(workdir, "bench.vcf")))
+    annotations.annos["bench_scores"] = pysam.Tabixfile(make_scores(os.path.join(workdir, "bench.scores")))
+    tracks = [("bench_bed", "bed", "ucsc"),
+              ("bench_vcf", "vcf", "grch37"),
+              ("bench_scores", "tuple", "grch37")]
+
+    print "Looking up %d variants in 3 tracks." % n_variants
+    run("dense, sorted", make_variants(n_variants, True), tracks)
+    run("sparse, sorted", make_variants(n_variants / 10, False), tracks)
+    shuffled = make_variants(n_variants / 10, True)
+    random.shuffle(shuffled)
+    run("shuffled", shuffled, tracks)
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+"""
+Benchmark of the offline export of load --sstable-out: the rows of the
+genotype index tables of n_variants variants go through a
+bulk_export.BulkExporter, with small runs so that merge_runs merges in
+several passes, into one CSV file per table.
+
+Checks that every row is exported once, that the CSV files are in token
+order with the rows of a partition together, and that the tokens match
+those of the driver's Murmur3Token for the routing key it would send.
+Reports the export and merge rates.
+
+Usage: python bulk_export_bench.py [n_variants] [n_samples] [workdir]
+"""
+import os
+import csv
+import sys
+import time
+import random
+import tempfile
+from collections import namedtuple
+
+from cassandra import cqltypes
+from cassandra.metadata import Murmur3Token
+
+from geminicassandra import bulk_export
+
+bulk_export.RUN_ROWS = 20000
+bulk_export.MERGE_FAN_IN = 8
+
+Column = namedtuple("Column", ["name"])
+ColumnSpec = namedtuple("ColumnSpec", ["keyspace_name", "table_name", "name", "type"])
+
+# table: ([(column, type)], partition key, clustering key), as in create_tables
+TABLES = {"variants_by_samples_gt_types": ([("variant_id", cqltypes.Int32Type), ("sample_name", cqltypes.UTF8Type),
+                                            ("gt_types", cqltypes.Int32Type)],
+                                           ["sample_name"], ["gt_types", "variant_id"]),
+          "samples_by_variants_gt_type": ([("variant_id", cqltypes.Int32Type), ("sample_name", cqltypes.UTF8Type),
+                                           ("gt_type", cqltypes.Int32Type)],
+                                          ["variant_id"], ["gt_type", "sample_name"])}
+
+
+class Query(object):
+    def __init__(self, table):
+        columns = TABLES[table][0]
+        self.query_string = "INSERT INTO %s (%s) VALUES (%s)" % \
+            (table, ",".join(c for (c, t) in columns), ",".join("?" * len(columns)))
+        self.column_metadata = [ColumnSpec("bench", table, c, t) for (c, t) in columns]
+
+
+class Table(object):
+    def __init__(self, table):
+        self.partition_key = [Column(c) for c in TABLES[table][1]]
+        self.clustering_key = [Column(c) for c in TABLES[table][2]]
+
+
+class Keyspace(object):
+    tables = dict((table, Table(table)) for table in TABLES)
+
+
+class Metadata(object):
+    keyspaces = {"bench": Keyspace()}
+
+
+class Cluster(object):
+    protocol_version = 3
+    metadata = Metadata()
+
+
+def export(directory, n_variants, n_samples):
+    exporter = bulk_export.BulkExporter(directory, Cluster())
+    queries = dict((table, Query(table)) for table in TABLES)
+    samples = ["sample_%d" % i for i in xrange(n_samples)]
+    start = time.time()
+    for v_id in xrange(1, n_variants + 1):
+        rows = [[v_id, sample, random.choice([0, 0, 0, 1, 3])] for sample in samples]
+        for table in TABLES:
+            exporter.execute(queries[table], rows)
+    exporter.close()
+    return exporter, time.time() - start
+
+
+def check(directory, table, n_rows):
+    (columns, partition_key, clustering_key) = TABLES[table]
+    names = [c for (c, t) in columns]
+    key_index = names.index(partition_key[0])
+    key_type = columns[key_index][1]
+    with open(os.path.join(directory, table + ".csv"), "rb") as handle:
+        reader = csv.reader(handle)
+        if reader.next() != names:
+            sys.exit("ERROR: %s: wrong header" % table)
+        previous = None
+        seen = set()
+        rows = 0
+        for row in reader:
+            value = int(row[key_index]) if key_type is cqltypes.Int32Type else row[key_index]
+            token = Murmur3Token.from_key(key_type.serialize(value, 3)).value
+            if previous is not None and token < previous[0]:
+                sys.exit("ERROR: %s: rows out of token order" % table)
+            if previous is not None and value != previous[1]:
+                if value in seen:
+                    sys.exit("ERROR: %s: partition %s is split" % (table, value))
+                seen.add(previous[1])
+            previous = (token, value)
+            rows += 1
+    if rows != n_rows:
+        sys.exit("ERROR: %s: %d rows exported, %d expected" % (table, rows, n_rows))
+
+
+if __name__ == "__main__":
+    n_variants = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    n_samples = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    directory = sys.argv[3] if len(sys.argv) > 3 else tempfile.mkdtemp()
+    random.seed(42)
+
+    (exporter, export_time) = export(directory, n_variants, n_samples)
+    n_rows = n_variants * n_samples
+    start = time.time()
+    bulk_export.merge_runs(directory, "bench")
+    merge_time = time.time() - start
+    for table in TABLES:
+        check(directory, table, n_rows)
+    print "%d rows in %d run files: exported in %.2f s (%.0f rows/s), merged in %.2f s (%.0f rows/s)" % \
+        (2 * n_rows, exporter.run_files, export_time, 2 * n_rows / max(export_time, 1e-9),
+         merge_time, 2 * n_rows / max(merge_time, 1e-9))
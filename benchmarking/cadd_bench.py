@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+"""
+Benchmark of the CADD score lookup of annotations.py: the former
+regex-based allele matching against the precomputed CADD_ALLELE_INDEX,
+with fetch and block (--anno-lookup block) lookups.
+
+Builds a synthetic CADD-format Tabix file (including the ambiguity
+codes R and M as reference bases), looks up a sorted stream of SNVs
+and indels in it, checks that every implementation returns the same
+scores and reports the wall time of each, both for whole lookups and
+for the allele matching alone (on hits fetched beforehand).
+
+Usage: python cadd_bench.py [n_variants] [workdir]
+"""
+import os
+import re
+import sys
+import time
+import random
+import tempfile
+
+import pysam
+
+from geminicassandra import annotations
+
+CHROM_LENGTH = 500000
+# the default --buffer-size of load
+BLOCK_SIZE = 333
+
+
+class Var(object):
+    """The bits of a cyvcf record the annotation helpers look at."""
+    def __init__(self, chrom, pos, ref, alt):
+        self.CHROM = chrom
+        self.POS = pos
+        self.start = pos - 1
+        self.end = pos - 1 + len(ref)
+        self.REF = ref
+        self.ALT = [alt]
+
+
+def legacy_get_cadd_scores(var):
+    """get_cadd_scores as it was before CADD_ALLELE_INDEX."""
+    def _get_cadd_scores(var, labels, hit):
+        raw = hit[3].split(",")
+        scaled = hit[4].split(",")
+
+        p = re.compile(str(var.ALT[0]))
+        for m in p.finditer(str(labels[hit[2]])):
+            pos = m.start()
+            return raw[pos], scaled[pos]
+
+    cadd_raw = cadd_scaled = None
+    labels = {"A":"CGT", "C":"AGT", "G":"ACT", "T":"ACG", "R":"ACGT", "M":"ACGT"}
+
+    for hit in annotations.annotations_in_region(var, "cadd_score", "tuple", "grch37"):
+        if str(hit[1]) == str(var.POS) and len(var.REF) == 1 and \
+           len(var.ALT[0]) == 1:
+            if str(hit[2]) == var.REF and str(var.ALT[0]) in labels[hit[2]]:
+                (cadd_raw, cadd_scaled) = _get_cadd_scores(var, labels, hit)
+            elif ((str(hit[2]) == 'R' and var.REF in('G', 'A')) or \
+                (str(hit[2]) == 'M' and var.REF in('A', 'C'))) and \
+                str(var.ALT[0]) in labels[hit[2]]:
+                (cadd_raw, cadd_scaled) = _get_cadd_scores(var, labels, hit)
+
+    return (cadd_raw, cadd_scaled)
+
+
+def make_cadd(path, refs):
+    with open(path, "w") as cadd:
+        for chrom in ["1", "2"]:
+            for pos in xrange(1, CHROM_LENGTH):
+                ref = random.choice("ACGT") if random.random() < 0.99 else random.choice("RM")
+                refs[(chrom, pos)] = ref
+                n_alts = 4 if ref in "RM" else 3
+                raw = ",".join("%.3f" % random.uniform(-2, 5) for _ in xrange(n_alts))
+                scaled = ",".join("%.2f" % random.uniform(0, 40) for _ in xrange(n_alts))
+                cadd.write("%s\t%d\t%s\t%s\t%s\n" % (chrom, pos, ref, raw, scaled))
+    return pysam.tabix_index(path, seq_col=0, start_col=1, end_col=1, force=True)
+
+
+def make_variants(n_variants, refs):
+    variants = []
+    for chrom in ["1", "2"]:
+        for pos in sorted(random.sample(xrange(1, CHROM_LENGTH), n_variants / 2)):
+            # mostly the reference base of the CADD file
+            ref = refs[(chrom, pos)] if random.random() < 0.9 else random.choice("ACGT")
+            if ref == "R":
+                ref = random.choice("GA")
+            elif ref == "M":
+                ref = random.choice("AC")
+            alt = random.choice("ACGTN") if random.random() < 0.95 else ref + "T"
+            variants.append(Var(chrom, pos, ref, alt))
+    return variants
+
+
+def lookup(variants, get_scores, block):
+    annotations.set_lookup_mode("fetch")
+    start = time.time()
+    if block:
+        # annotate_block looks the variants up with annotate_variant
+        annotations.annotate_variant = lambda var, skip_cadd=False, skip_gerp_bp=False: get_scores(var)
+        results = []
+        for i in xrange(0, len(variants), BLOCK_SIZE):
+            results.extend(annotations.annotate_block(variants[i:i + BLOCK_SIZE]))
+    else:
+        results = [get_scores(var) for var in variants]
+    return results, time.time() - start
+
+
+def match(variants, get_scores, hits):
+    """Time the allele matching alone, on the hits of each variant."""
+    annotations_in_region = annotations.annotations_in_region
+    annotations.annotations_in_region = lambda var, anno, parser_type=None, naming="ucsc": hits[var]
+    try:
+        start = time.time()
+        results = [get_scores(var) for var in variants]
+        return results, time.time() - start
+    finally:
+        annotations.annotations_in_region = annotations_in_region
+
+
+def compare(title, variants, expected, legacy_time, runs):
+    print "%-24s %6.2f s" % (title + ", regex:", legacy_time)
+    for (name, get_scores, run) in runs:
+        (scores, elapsed) = run(variants, get_scores)
+        if scores != expected:
+            sys.exit("ERROR: %s: %s scores differ" % (title, name))
+        print "%-24s %6.2f s, %.1fx" % ("%s, %s:" % (title, name), elapsed,
+                                         legacy_time / max(elapsed, 1e-9))
+
+
+if __name__ == "__main__":
+    n_variants = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    workdir = sys.argv[2] if len(sys.argv) > 2 else tempfile.mkdtemp()
+    random.seed(42)
+
+    refs = {}
+    annotations.annos["cadd_score"] = pysam.Tabixfile(make_cadd(os.path.join(workdir, "cadd.tsv"), refs))
+    variants = make_variants(n_variants, refs)
+
+    print "Looking up the CADD scores of %d variants." % n_variants
+    (expected, legacy_time) = lookup(variants, legacy_get_cadd_scores, False)
+    compare("fetch", variants, expected, legacy_time,
+            [("index", annotations.get_cadd_scores, lambda v, f: lookup(v, f, False))])
+    (block_expected, legacy_time) = lookup(variants, legacy_get_cadd_scores, True)
+    if block_expected != expected:
+        sys.exit("ERROR: block and fetch scores differ")
+    compare("block", variants, expected, legacy_time,
+            [("index", annotations.get_cadd_scores, lambda v, f: lookup(v, f, True))])
+
+    hits = dict((var, list(annotations.annotations_in_region(var, "cadd_score", "tuple", "grch37")))
+                for var in variants)
+    (matched, legacy_time) = match(variants * 10, legacy_get_cadd_scores, hits)
+    compare("matching only", variants * 10, matched, legacy_time,
+            [("index", annotations.get_cadd_scores, lambda v, f: match(v, f, hits))])
+    print "%d of %d variants scored." % (len([s for s in expected if s[0] is not None]), n_variants)
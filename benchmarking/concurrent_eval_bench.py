@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+"""
+Wall time of a wide OR of genotype filters, with its operands evaluated
+one after another, as the evaluator used to, and concurrently.
+
+No cluster is needed: the session answers every query after a fixed
+latency per page (2 pages per query), which is what bounds the
+evaluation of the filters. Checks that both give the same variants.
+
+Usage: python concurrent_eval_bench.py [n_filters] [latency_ms]
+"""
+import sys
+import time
+import random
+import threading
+
+from geminicassandra.query_expressions import Basic_expression, OR_expression
+
+N_VARIANTS = 100000
+
+
+class LatencyFuture(object):
+
+    def __init__(self, rows, latency):
+        self.pages = [rows[:len(rows) / 2], rows[len(rows) / 2:]]
+        self.latency = latency
+        self.has_more_pages = True
+
+    def add_callbacks(self, callback, errback):
+        self.callback = callback
+        self.start_fetching_next_page()
+
+    def start_fetching_next_page(self):
+        page = self.pages.pop(0)
+        self.has_more_pages = len(self.pages) > 0
+        threading.Timer(self.latency, self.callback, [page]).start()
+
+
+class LatencySession(object):
+
+    def __init__(self, latency):
+        self.latency = latency
+
+    def execute_async(self, query):
+        # the variants of a sample: a pseudo-random tenth of them
+        rng = random.Random(query)
+        return LatencyFuture([(v,) for v in xrange(1, N_VARIANTS + 1) if rng.random() < 0.1], self.latency)
+
+
+def run(n_filters, latency):
+    session = LatencySession(latency)
+    filters = [Basic_expression('variants_by_samples_gt_types', 'variant_id',
+                                "sample_name = 'S%d' AND gt_types = 1" % i) for i in range(n_filters)]
+    start = time.time()
+    sequential = set()
+    for exp in filters:
+        sequential |= set(exp.evaluate(session, "*"))
+    sequential_time = time.time() - start
+    exp = filters[0]
+    for other in filters[1:]:
+        exp = OR_expression(exp, other)
+    start = time.time()
+    concurrent = exp.evaluate(session, "*")
+    concurrent_time = time.time() - start
+    if sorted(sequential) != concurrent.tolist():
+        sys.exit("ERROR: the results differ")
+    print "OR of %d filters, %d ms per page: one after another %.2f s, concurrently %.2f s" % \
+        (n_filters, latency * 1000, sequential_time, concurrent_time)
+
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 10,
+        float(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0.05)
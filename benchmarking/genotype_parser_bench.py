@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+"""
+Benchmark of the genotype fast path of the loader (genotype_parser).
+
+Writes a VCF of n_variants variants and n_samples samples in the GATK
+style (GT:AD:DP:GQ:PL, with some bare ./. calls and multi-allelic
+sites), then reads it with cyvcf, taking the genotype lists and the
+per-sample calls as the loader used to, and with a GenotypeReader.
+Checks that both give the same genotype columns, called samples and
+counts, and reports the variants per second of each.
+
+Usage: python genotype_parser_bench.py [n_variants] [n_samples]
+"""
+import sys
+import time
+import random
+import tempfile
+
+import cyvcf as vcf
+
+from geminicassandra.genotype_parser import GenotypeReader, GT_FIELDS
+
+HEADER = """##fileformat=VCFv4.1
+##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">
+##FORMAT=<ID=AD,Number=.,Type=Integer,Description="Allelic depths">
+##FORMAT=<ID=DP,Number=1,Type=Integer,Description="Read depth">
+##FORMAT=<ID=GQ,Number=1,Type=Float,Description="Genotype quality">
+##FORMAT=<ID=PL,Number=G,Type=Integer,Description="Phred-scaled likelihoods">
+#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t%s
+"""
+
+
+def make_sample(n_alts):
+    if random.random() < 0.05:
+        return "./."
+    gt = random.choice(["0/0"] * 6 + ["0/1", "0/1", "1/1", "0|1"] + (["1/2"] if n_alts > 1 else []))
+    return "%s:%d,%d:%d:%.2f:%d,%d,0" % (gt, random.randint(0, 40), random.randint(0, 40), random.randint(0, 80),
+                                        random.uniform(0, 99), random.randint(0, 900), random.randint(0, 90))
+
+
+def write_vcf(path, n_variants, n_samples):
+    with open(path, "w") as out:
+        out.write(HEADER % "\t".join("S%d" % i for i in xrange(n_samples)))
+        for i in xrange(n_variants):
+            alts = random.choice([["G"], ["G"], ["G"], ["GTT"], ["G", "T"]])
+            out.write("chr1\t%d\t.\tA\t%s\t50\tPASS\t.\tGT:AD:DP:GQ:PL\t%s\n" %
+                      (100 * (i + 1), ",".join(alts), "\t".join(make_sample(len(alts)) for _ in xrange(n_samples))))
+
+
+def read_cyvcf(path):
+    """The genotype values the loader took from cyvcf before."""
+    result = []
+    start = time.time()
+    for var in vcf.VCFReader(open(path), 'rb'):
+        columns = [getattr(var, field) for field in GT_FIELDS]
+        called = [(i, entry.gt_type, entry.gt_depth, entry.gt_bases)
+                  for (i, entry) in enumerate(var.samples) if entry.gt_type is not None]
+        result.append((columns, called, (var.num_hom_ref, var.num_het, var.num_hom_alt, var.num_unknown)))
+    return (result, time.time() - start)
+
+
+def read_fast(path):
+    result = []
+    start = time.time()
+    reader = GenotypeReader(open(path), 'rb')
+    for var in reader:
+        genotypes = reader.genotypes
+        result.append((genotypes.column_values(), genotypes.called(),
+                       (var.num_hom_ref, var.num_het, var.num_hom_alt, var.num_unknown)))
+    return (result, time.time() - start, reader)
+
+
+def check(expected, found):
+    for (i, ((columns, called, counts), (fast_columns, fast_called, fast_counts))) in enumerate(zip(expected, found)):
+        for (field, values, fast_values) in zip(GT_FIELDS, columns, fast_columns):
+            if [float(v) for v in values] != [float(v) for v in fast_values] if field != "gt_bases" \
+                    else values != fast_values:
+                sys.exit("ERROR: variant %d: %s differ" % (i, field))
+        if called != fast_called or counts != fast_counts:
+            sys.exit("ERROR: variant %d: called samples or counts differ" % i)
+
+
+if __name__ == "__main__":
+    n_variants = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    n_samples = int(sys.argv[2]) if len(sys.argv) > 2 else 2500
+    random.seed(42)
+    path = tempfile.mktemp(suffix=".vcf")
+    write_vcf(path, n_variants, n_samples)
+
+    (expected, cyvcf_time) = read_cyvcf(path)
+    (found, fast_time, reader) = read_fast(path)
+    if len(expected) != len(found):
+        sys.exit("ERROR: %d variants read by cyvcf, %d by the fast path" % (len(expected), len(found)))
+    check(expected, found)
+    print "%d variants x %d samples: cyvcf %.2f s (%.0f variants/s), fast path %.2f s (%.0f variants/s), " \
+          "speedup %.1fx; %d records parsed by cyvcf" % \
+        (n_variants, n_samples, cyvcf_time, n_variants / max(cyvcf_time, 1e-9), fast_time,
+         n_variants / max(fast_time, 1e-9), cyvcf_time / max(fast_time, 1e-9), reader.slow_records)
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+"""
+Batches sent for the genotype index tables of one buffer of variants:
+one 4-statement UNLOGGED batch per (variant, sample), as the loader used
+to send them, against the batches of gemini_load_chunk._partition_batches,
+which each go to a single partition of a single table.
+
+Reports the number of batches (round trips), the partitions each batch
+touches (the coordinator fan-out) and the time spent grouping the rows.
+
+Usage: python gt_batch_bench.py [n_samples ...]
+"""
+import sys
+import time
+import random
+
+from geminicassandra.gemini_load_chunk import _partition_batches, GT_BATCH_ROWS
+
+# the default --buffer-size of load
+BUFFER_SIZE = 333
+
+
+def make_buffers(n_samples):
+    samples = ["sample_%d" % i for i in xrange(n_samples)]
+    types_buf = []
+    depth_buf = []
+    gt_buf = []
+    for v_id in xrange(1, BUFFER_SIZE + 1):
+        for sample in samples:
+            gt_type = random.choice([0, 0, 0, 1, 3])
+            types_buf.append([v_id, sample, gt_type])
+            depth_buf.append([v_id, sample, random.randint(0, 60)])
+            gt_buf.append([v_id, sample, "A/G"])
+    return types_buf, depth_buf, gt_buf
+
+
+def run(n_samples):
+    (types_buf, depth_buf, gt_buf) = make_buffers(n_samples)
+    old_batches = len(types_buf)
+    start = time.time()
+    batches = [(rows, key_column) for (buf, key_column) in [(types_buf, 0), (types_buf, 1), (depth_buf, 1), (gt_buf, 1)]
+               for rows in _partition_batches(buf, key_column)]
+    elapsed = time.time() - start
+    if sum(len(rows) for (rows, key_column) in batches) != 4 * old_batches:
+        sys.exit("ERROR: rows lost while grouping")
+    if any(len(set(row[key_column] for row in rows)) != 1 for (rows, key_column) in batches):
+        sys.exit("ERROR: batch spans several partitions")
+    print "%5d samples: per (variant, sample): %7d batches x 4 partitions | " \
+          "per partition: %5d batches x 1 partition (<= %d rows), %.1fx fewer round trips, grouped in %.3f s" % \
+          (n_samples, old_batches, len(batches), GT_BATCH_ROWS, old_batches / float(len(batches)), elapsed)
+
+
+if __name__ == "__main__":
+    random.seed(42)
+    for n_samples in map(int, sys.argv[1:]) or [10, 100, 1000]:
+        run(n_samples)
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+"""
+Micro-benchmark for the per-sample genotype tally of GeminiLoader.
+
+Compares the old per-sample Python loop with the buffered bincount
+tally for cohorts of 100, 1,000 and 10,000 samples and checks that
+both produce exactly the same counts.
+
+Usage: python gt_counts_bench.py [n_variants] [buffer_size]
+"""
+import sys
+import time
+import numpy as np
+
+from geminicassandra.gemini_load_chunk import GeminiLoader
+
+
+def loop_tally(counts, gt_types):
+    """The per-sample loop GeminiLoader used before."""
+    for idx, gt_type in enumerate(gt_types):
+        counts[idx][gt_type] += 1
+
+
+def make_loader(samples):
+    loader = GeminiLoader.__new__(GeminiLoader)
+    loader.samples = samples
+    loader._init_sample_gt_counts()
+    return loader
+
+
+def run(n_samples, n_variants, buffer_size):
+    samples = ["S%d" % i for i in range(n_samples)]
+    # mostly hom_ref, some het, hom_alt and unknown calls
+    variants = [np.array(np.random.choice([0, 1, 2, 3], n_samples,
+                                          p=[0.7, 0.15, 0.05, 0.1]), np.int8)
+                for _ in range(n_variants)]
+
+    reference = np.array(np.zeros((n_samples, 4)), dtype='uint32')
+    start = time.time()
+    for gt_types in variants:
+        loop_tally(reference, gt_types)
+    loop_time = time.time() - start
+
+    loader = make_loader(samples)
+    start = time.time()
+    for i, gt_types in enumerate(variants):
+        loader._update_sample_gt_counts(gt_types)
+        if (i + 1) % buffer_size == 0:
+            loader._flush_sample_gt_counts()
+    loader._flush_sample_gt_counts()
+    vector_time = time.time() - start
+
+    if not np.array_equal(reference, loader.sample_gt_counts):
+        sys.exit("ERROR: tallies differ for %d samples" % n_samples)
+
+    print "%6d samples: loop %.3f s, bincount %.3f s, speedup %.1fx" % \
+        (n_samples, loop_time, vector_time, loop_time / max(vector_time, 1e-9))
+
+
+if __name__ == "__main__":
+    n_variants = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    buffer_size = int(sys.argv[2]) if len(sys.argv) > 2 else 333
+    np.random.seed(42)
+    print "Tallying %d variants, flushing every %d variants." % (n_variants, buffer_size)
+    for n_samples in [100, 1000, 10000]:
+        run(n_samples, n_variants, buffer_size)
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+"""
+Benchmark of the HWE p-value and inbreeding coefficient computation of
+the loader: popgen.get_hwe_likelihood once per variant against
+popgen.get_hwe_likelihoods once per buffer.
+
+Draws random genotype counts (with a few undefined allele frequencies
+and monomorphic sites), checks that both return the same values and
+reports the time per buffer. Also checks stats.achisqprob against
+stats.lchisqprob for other degrees of freedom.
+
+Usage: python hwe_bench.py [n_variants] [n_samples]
+"""
+import sys
+import time
+import random
+
+import numpy as np
+
+from geminicassandra import popgen, stats
+
+# the default --buffer-size of load
+BUFFER_SIZE = 333
+
+
+def make_counts(n_variants, n_samples):
+    counts = []
+    for _ in xrange(n_variants):
+        aaf = random.choice([0.0, 1.0, random.random() / 50, random.random()])
+        hom_ref = het = hom_alt = 0
+        for _ in xrange(n_samples):
+            alts = (random.random() < aaf) + (random.random() < aaf)
+            if alts == 0:
+                hom_ref += 1
+            elif alts == 1:
+                het += 1
+            else:
+                hom_alt += 1
+        obs_aaf = (het + 2.0 * hom_alt) / (2.0 * n_samples)
+        counts.append((hom_ref, het, hom_alt, obs_aaf if random.random() > 0.02 else None))
+    return counts
+
+
+def scalar(counts):
+    return [popgen.get_hwe_likelihood(*c) for c in counts]
+
+
+def batch(counts):
+    result = []
+    for i in xrange(0, len(counts), BUFFER_SIZE):
+        block = np.array([(r, h, a, np.nan if f is None else f) for (r, h, a, f) in counts[i:i + BUFFER_SIZE]],
+                         dtype=np.float64)
+        (p_values, coeffs) = popgen.get_hwe_likelihoods(block[:, 0], block[:, 1], block[:, 2], block[:, 3])
+        result.extend((p if p == p else None, f if f == f else None)
+                      for (p, f) in zip(p_values.tolist(), coeffs.tolist()))
+    return result
+
+
+def max_difference(expected, found):
+    diff = 0.0
+    for (e, f) in zip(expected, found):
+        for (x, y) in zip(e, f):
+            if (x is None) != (y is None):
+                sys.exit("ERROR: defined values differ: %s, %s" % (e, f))
+            if x is not None:
+                diff = max(diff, abs(x - y))
+    return diff
+
+
+if __name__ == "__main__":
+    n_variants = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    n_samples = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    random.seed(42)
+
+    counts = make_counts(n_variants, n_samples)
+    start = time.time()
+    expected = scalar(counts)
+    scalar_time = time.time() - start
+    start = time.time()
+    found = batch(counts)
+    batch_time = time.time() - start
+    print "%d variants, %d samples, max. difference %g" % \
+        (n_variants, n_samples, max_difference(expected, found))
+    print "per variant: %.3f s (%.1f us/buffer), per buffer: %.3f s (%.1f us/buffer), %.1fx" % \
+        (scalar_time, scalar_time * 1e6 * BUFFER_SIZE / n_variants,
+         batch_time, batch_time * 1e6 * BUFFER_SIZE / n_variants, scalar_time / max(batch_time, 1e-9))
+
+    chisq = [0.0, -1.0] + [random.expovariate(0.05) for _ in xrange(10000)]
+    for df in [1, 2, 3, 4, 7, 10]:
+        diff = np.max(np.abs(stats.achisqprob(chisq, df) - [stats.lchisqprob(c, df) for c in chisq]))
+        print "achisqprob, df=%d: max. difference %g" % (df, diff)
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+"""
+Variant_id sets of the query expressions: Python sets, as the evaluator
+used to build them, against id_sets.IdSet.
+
+For a keyspace of n_variants variants, evaluates a NOT (all variants
+minus those matching its body, 1 in 20 here), the AND and OR of two
+results, and reports the time of each, the memory of the starting set
+and the bytes a result takes through a Pipe (pickled). Checks that both
+give the same ids.
+
+Usage: python id_sets_bench.py [n_variants]
+"""
+import sys
+import time
+import random
+import cPickle
+
+import numpy as np
+
+from geminicassandra.id_sets import IdSet
+
+
+def timed(fn):
+    start = time.time()
+    result = fn()
+    return (result, time.time() - start)
+
+
+def set_size(ids):
+    # the set and its int objects
+    return sys.getsizeof(ids) + sum(sys.getsizeof(i) for i in ids)
+
+
+def run(n_variants):
+    random.seed(42)
+    body = random.sample(xrange(1, n_variants + 1), n_variants / 20)
+    other = random.sample(xrange(1, n_variants + 1), n_variants / 3)
+
+    (old_not, old_not_time) = timed(lambda: set(range(1, n_variants + 1)) - set(body))
+    (new_not, new_not_time) = timed(lambda: IdSet.range(1, n_variants) - IdSet(np.array(body)))
+    other_set = set(other)
+    other_ids = IdSet(np.array(other))
+    (old_and, old_and_time) = timed(lambda: old_not & other_set)
+    (new_and, new_and_time) = timed(lambda: new_not & other_ids)
+    (old_or, old_or_time) = timed(lambda: old_not | other_set)
+    (new_or, new_or_time) = timed(lambda: new_not | other_ids)
+    if sorted(old_not) != new_not.tolist() or sorted(old_and) != new_and.tolist() or \
+            sorted(old_or) != new_or.tolist():
+        sys.exit("ERROR: the sets differ")
+
+    print "%d variants:" % n_variants
+    print "  NOT: set %.2f s, IdSet %.2f s" % (old_not_time, new_not_time)
+    print "  AND: set %.2f s, IdSet %.2f s" % (old_and_time, new_and_time)
+    print "  OR: set %.2f s, IdSet %.2f s" % (old_or_time, new_or_time)
+    print "  all variants: set %.1f MB, IdSet %.1f MB" % \
+        (set_size(set(range(1, n_variants + 1))) / 1048576.0, IdSet.range(1, n_variants).ids.nbytes / 1048576.0)
+    print "  NOT result pickled: set %.1f MB, IdSet %.2f MB" % \
+        (len(cPickle.dumps(old_not, 2)) / 1048576.0, len(cPickle.dumps(new_not, 2)) / 1048576.0)
+
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 5000000)
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+"""
+Memory of one buffer of variants of the loader: the rows as the loader
+used to buffer them (lists of Python values in blists), against a
+row_buffers.RowBuffers.
+
+Reads the genotypes of a synthetic VCF of BUFFER_SIZE variants and
+n_samples samples with a GenotypeReader, buffers them both ways and
+reports the size of the objects of each (the arrays by their data).
+Checks that both give the same variant and genotype index rows.
+
+Usage: python row_buffers_bench.py [n_samples ...]
+"""
+import os
+import sys
+import random
+import tempfile
+
+import numpy as np
+from blist import blist
+
+from genotype_parser_bench import write_vcf
+from geminicassandra.genotype_parser import GenotypeReader
+from geminicassandra.row_buffers import RowBuffers
+from geminicassandra.gemini_load_chunk import _partition_batches, concat, GT_BATCH_ROWS
+
+# the default --buffer-size of load
+BUFFER_SIZE = 333
+
+COLUMNS = ['gt_types', 'gt_depths', 'gts']
+
+
+def read_genotypes(path):
+    reader = GenotypeReader(open(path), 'rb')
+    return (reader.samples, [reader.genotypes for var in reader])
+
+
+def buffer_lists(samples, genotypes):
+    variants = blist([])
+    index = dict((column, blist([])) for column in COLUMNS)
+    for (v_id, gts) in enumerate(genotypes):
+        variants.append([v_id, 'chr1', v_id * 100] + concat(gts.column_values()))
+        for (i, gt_type, gt_depth, gt_bases) in gts.called():
+            index['gt_types'].append([v_id, samples[i], gt_type])
+            index['gt_depths'].append([v_id, samples[i], gt_depth])
+            index['gts'].append([v_id, samples[i], gt_bases])
+    return (variants, index)
+
+
+def buffer_arrays(samples, genotypes):
+    buffers = RowBuffers(samples, [], False, BUFFER_SIZE)
+    for (v_id, gts) in enumerate(genotypes):
+        buffers.add_variant([v_id, 'chr1', v_id * 100], gts)
+        buffers.add_genotypes(v_id, gts)
+    return buffers
+
+
+def get_rows(buffered):
+    """The variant rows and the index batches by sample, as Python values."""
+    if isinstance(buffered, RowBuffers):
+        return ([list(row) for row in buffered.variant_rows()],
+                dict((column, sorted(buffered.index_batches(column, 1, GT_BATCH_ROWS))) for column in COLUMNS))
+    (variants, index) = buffered
+    return (list(variants), dict((column, sorted(_partition_batches(index[column], 1))) for column in COLUMNS))
+
+
+def get_size(buffered):
+    """
+    The bytes of the objects of the buffers, each counted once (numpy
+    arrays by their data).
+    """
+    seen = set()
+    pending = [buffered]
+    size = 0
+    while len(pending) > 0:
+        obj = pending.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        if isinstance(obj, np.ndarray):
+            size += obj.nbytes
+            continue
+        size += sys.getsizeof(obj)
+        if isinstance(obj, RowBuffers):
+            pending.extend(obj.__dict__.itervalues())
+        elif isinstance(obj, dict):
+            pending.extend(obj.iterkeys())
+            pending.extend(obj.itervalues())
+        elif isinstance(obj, (list, tuple, blist)):
+            pending.extend(obj)
+    return size / 1048576.0
+
+
+def run(n_samples):
+    random.seed(42)
+    path = tempfile.mktemp(suffix=".vcf")
+    write_vcf(path, BUFFER_SIZE, n_samples)
+    (samples, genotypes) = read_genotypes(path)
+    os.remove(path)
+    lists = buffer_lists(samples, genotypes)
+    lists_mb = get_size(lists)
+    arrays = buffer_arrays(samples, genotypes)
+    arrays_mb = get_size(arrays)
+    if get_rows(lists) != get_rows(arrays):
+        sys.exit("ERROR: %d samples: the buffers give different rows" % n_samples)
+    print "%d variants x %d samples: lists of lists %.1f MB, RowBuffers %.1f MB (%.1fx less)" % \
+        (BUFFER_SIZE, n_samples, lists_mb, arrays_mb, lists_mb / max(arrays_mb, 0.1))
+
+
+if __name__ == "__main__":
+    for n in (map(int, sys.argv[1:]) or [100, 1000, 2500]):
+        run(n)
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+"""
+Benchmark of the write control of the loader against a simulated
+cluster that accepts at most CAPACITY concurrent requests and times out
+the others: the former fixed window of 25 requests with immediate
+retries (up to 8, after which the rows were dropped) against the AIMD
+window with backoff of write_control.AdaptiveWriter, whose given-up
+requests go to a replay file that is then replayed on a healthy cluster.
+
+Times are scaled down (milliseconds instead of the cluster's seconds),
+and so are the backoff times of write_control.
+
+Usage: python write_control_bench.py [n_requests] [capacity]
+"""
+import os
+import sys
+import time
+import heapq
+import tempfile
+from collections import deque
+
+import cassandra
+
+from geminicassandra import write_control
+
+LATENCY = 0.002
+TIMEOUT = 0.01
+write_control.BASE_BACKOFF = 0.002
+write_control.MAX_BACKOFF = 0.2
+
+
+class Query(object):
+    query_string = "INSERT INTO t (a, b) VALUES (?, ?)"
+
+    def bind(self, row):
+        return row
+
+
+class Future(object):
+    def __init__(self, done, ok):
+        self.done = done
+        self.ok = ok
+
+    def result(self):
+        time.sleep(max(0.0, self.done - time.time()))
+        if not self.ok:
+            raise cassandra.OperationTimedOut("simulated timeout")
+
+
+class Session(object):
+    """Accepts at most capacity requests at a time, times out the others."""
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.busy = []
+        self.attempts = 0
+        self.written = 0
+
+    def execute_async(self, statement):
+        self.attempts += 1
+        now = time.time()
+        while len(self.busy) > 0 and self.busy[0] <= now:
+            heapq.heappop(self.busy)
+        if len(self.busy) >= self.capacity:
+            return Future(now + TIMEOUT, False)
+        heapq.heappush(self.busy, now + LATENCY)
+        self.written += 1
+        return Future(now + LATENCY, True)
+
+
+def fixed_window(session, n_requests):
+    """The genotype batch writes before write_control."""
+    in_flight = deque()
+    lost = 0
+
+    def wait_for_oldest():
+        (retries, future) = in_flight.popleft()
+        try:
+            future.result()
+            return 0
+        except cassandra.OperationTimedOut:
+            if retries < 8:
+                in_flight.append((retries + 1, session.execute_async(None)))
+                return 0
+            return 1
+
+    for _ in xrange(n_requests):
+        if len(in_flight) >= 25:
+            lost += wait_for_oldest()
+        in_flight.append((0, session.execute_async(None)))
+    while len(in_flight) > 0:
+        lost += wait_for_oldest()
+    return lost
+
+
+def adaptive_window(session, n_requests, replay_file):
+    writer = write_control.AdaptiveWriter(session, replay_file)
+    query = Query()
+    for i in xrange(n_requests):
+        writer.execute(query, [[i, "x"]])
+    writer.wait()
+    replay_file.close()
+    return writer
+
+
+if __name__ == "__main__":
+    n_requests = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    capacity = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+
+    session = Session(capacity)
+    start = time.time()
+    lost = fixed_window(session, n_requests)
+    print "fixed window of 25: %.2f s, %d attempts for %d requests, %d rows lost" % \
+        (time.time() - start, session.attempts, n_requests, lost)
+
+    session = Session(capacity)
+    replay_path = os.path.join(tempfile.mkdtemp(), "bench.replay")
+    start = time.time()
+    writer = adaptive_window(session, n_requests, write_control.ReplayFile(replay_path, "bench"))
+    print "AIMD window:        %.2f s, %d attempts for %d requests, %d rows to the replay file " \
+          "(window %d, %d decreases)" % \
+        (time.time() - start, session.attempts, n_requests, writer.replayed_rows,
+         int(writer.window), writer.decreases)
+
+    # an unreachable cluster: everything ends up in the replay file
+    replay_path = os.path.join(tempfile.mkdtemp(), "bench.replay")
+    writer = adaptive_window(Session(0), 200, write_control.ReplayFile(replay_path, "bench"))
+    replayed = Session(capacity)
+    replay_writer = write_control.AdaptiveWriter(replayed, write_control.ReplayFile(replay_path + ".again", "bench"))
+    rows = []
+    for (query_string, record_rows) in write_control.read_replay_file(replay_path):
+        rows.extend(record_rows)
+        replay_writer.execute(Query(), record_rows)
+    replay_writer.wait()
+    if sorted(rows) != [[i, "x"] for i in xrange(200)] or replayed.written != 200:
+        sys.exit("ERROR: replay file lost rows")
+    print "unreachable cluster: %d of 200 rows to the replay file, all %d written on replay" % \
+        (writer.replayed_rows, replayed.written)
@@ -2,8 +2,8 @@
 
 import abc
 import cassandra
-from cassandra.cluster import Cluster
 import collections
+import re
 import sys
 
 import compression
@@ -11,9 +11,13 @@ from gemini_constants import HOM_ALT, HOM_REF, HET, UNKNOWN
 from gemini_subjects import get_subjects
 from gemini_utils import (OrderedDict, itersubclasses, partition_by_fn)
 from sql_utils import ensure_columns
+from database_cassandra import get_session
 from collections import namedtuple
 from geminicassandra.query_expressions import Basic_expression, AND_expression,\
-    NOT_expression, OR_expression, async_rows_as_set, GT_wildcard_expression
+    NOT_expression, OR_expression, async_rows_as_set, GT_wildcard_expression,\
+    set_max_concurrent_queries
+from geminicassandra.id_sets import IdSet
+from geminicassandra.query_planner import QueryPlanner
 from geminicassandra.sql_utils import get_query_parts
 from cassandra.query import ordered_dict_factory, tuple_factory
 from string import strip
@@ -21,12 +25,15 @@ import time
 from threading import Event
 from itertools import repeat
 from multiprocessing.process import Process
-from multiprocessing import Pipe, cpu_count
+from multiprocessing import Pipe
 from signal import signal, SIGPIPE, SIG_DFL
 import os
-from time import sleep
 
 
+# the genotype fields that are stored as one blob per variant
+# when genotypes are loaded with --packed-genotypes
+GT_FIELDS = ['gts'] + compression.GT_COLUMN_DTYPES.keys()
+
 # geminicassandra imports
 class RowFormat:
     """A row formatter to output rows in a custom format.  To provide
@@ -220,13 +227,18 @@ class GeminiQuery(object):
             show_families=False, test_mode=False, 
             needs_sample_names=False, nr_cores = 1,
             start_time = -42, use_header = False,
-            exp_id="Oink", timeout=10.0, batch_size = 100):
+            exp_id="Oink", timeout=10.0, batch_size = 100,
+            explain=False, max_concurrent_queries=None):
         """
         Execute a query against a Gemini database. The user may
         specify:
 
             1. (reqd.) an SQL `query`.
             2. (opt.) a genotype filter.
+
+        With explain, print the evaluation plan of the filters, with
+        the estimated number of variants each one matches, instead.
+        The filters run at most max_concurrent_queries queries at once.
         """
         self.query = self.formatter.format_query(query).replace('==','=')
         self.gt_filter = gt_filter
@@ -237,6 +249,8 @@ class GeminiQuery(object):
         self.exp_id = exp_id
         self.timeout = timeout
         self.batch_size = batch_size
+        if max_concurrent_queries is not None:
+            set_max_concurrent_queries(max_concurrent_queries)
         if self._is_gt_filter_safe() is False:
             sys.exit("ERROR: unsafe --gt-filter command.")
         
@@ -275,6 +289,7 @@ class GeminiQuery(object):
 
         (self.requested_columns, self.from_table, where_clause, self.rest_of_query) = get_query_parts(self.query)
         self.extra_columns = []
+        self.gt_projection = None
         
         if where_clause != '':
             self.where_exp = self.parse_where_clause(where_clause, self.from_table)
@@ -285,6 +300,17 @@ class GeminiQuery(object):
                 self.where_exp = self.gt_filter_exp
             else:
                 self.where_exp = None
+
+        if not self.where_exp is None:
+            # evaluate the most selective filters first
+            planner = QueryPlanner(self.session, self.n_variants)
+            self.where_exp = planner.plan(self.where_exp)
+            if explain:
+                print "\n".join(planner.explain(self.where_exp))
+                return
+        elif explain:
+            print "no filters: all rows of %s" % self.from_table
+            return
             
         self._apply_query()
         self.query_executed = True
@@ -418,8 +444,8 @@ class GeminiQuery(object):
         """
         # open up a new database
         
-        self.cluster = Cluster(self.db_contact_points)
-        self.session = self.cluster.connect(self.keyspace)
+        self.session = get_session(self.db_contact_points, self.keyspace)
+        self.cluster = self.session.cluster
 
     def _is_gt_filter_safe(self):
         """
@@ -475,12 +501,16 @@ class GeminiQuery(object):
                 
                 print "All rows match query."
                 query += " " + self.rest_of_query                
-                error_count += execute_async_blocking(self.session, query, output_path % 0, self.extra_columns, (), self.timeout)
+                error_count += execute_async_blocking(self.session, query, output_path % 0, self.extra_columns, (), self.timeout, self.gt_projection)
             
             else:
                 
                 print "%d rows match query." % len(self.matches)
                 step = len(self.matches) / self.nr_cores
+                partition_key = self.get_partition_key(self.from_table)
+                # prepared once here, the workers adopt the statement
+                in_clause = ','.join(list(repeat("?", self.batch_size)))
+                prepared_query = self.session.prepare(query + " WHERE %s IN (%s)" % (partition_key, in_clause))
                     
                 procs = []
                 conns = []
@@ -490,8 +520,9 @@ class GeminiQuery(object):
                     conns.append(parent_conn)
                     p = Process(target=fetch_matches,
                                 args=(child_conn, i, output_path % i, query, self.from_table,\
-                                      self.get_partition_key(self.from_table), self.extra_columns,\
-                                      self.db_contact_points, self.keyspace, self.batch_size))
+                                      partition_key, self.extra_columns,\
+                                      self.db_contact_points, self.keyspace, self.batch_size, prepared_query,
+                                      self.gt_projection))
                     procs.append(p)
                     p.start()
                     
@@ -531,6 +562,8 @@ class GeminiQuery(object):
                 query += " " + self.rest_of_query
                     
                 res = self.session.execute(query)  
+                if self.gt_projection:
+                    res = [unpack_genotypes(row, self.gt_projection) for row in res]
                 if self.from_table == 'variants':
                     res = sorted(res, key = lambda x: x['start'])   
                 elif self.from_table == 'samples':
@@ -568,12 +601,18 @@ class GeminiQuery(object):
         
         self.matches = "*"
         if not self.where_exp is None:
-            self.matches = list(self.where_exp.evaluate(self.session, "*"))
+            # variant_ids stay an IdSet, which the workers get as a compact buffer
+            matches = self.where_exp.evaluate(self.session, "*")
+            self.matches = matches if isinstance(matches, IdSet) else list(matches)
         
         mid_time = time.time()
         
         log = open("querylog", 'a')
         log.write("1::%s;%s\n" % (self.exp_id, mid_time - self.start_time))
+        if not self.where_exp is None:
+            # whether each filter scanned its rows or looked up a starting set
+            for plan in self.where_exp.get_plans():
+                log.write("plan::%s;%s\n" % (self.exp_id, plan))
         log.close()
 
         if self._query_needs_genotype_info():
@@ -581,6 +620,8 @@ class GeminiQuery(object):
             # pieces and replace genotype columns using sample
             # names with sample indices
             self._split_select()
+            if self.from_table == 'variants' and self._has_packed_genotypes():
+                self._project_packed_genotypes()
                 
         if self.show_families or self.show_variant_samples or self.needs_sample_names:
             if (not 'variant_id' in self.requested_columns) and (not "*" in self.requested_columns):
@@ -593,6 +634,58 @@ class GeminiQuery(object):
         self.session.shutdown()
         self.cluster.shutdown()
 
+    def _has_packed_genotypes(self):
+        """
+        True if the genotypes were loaded with --packed-genotypes,
+        i.e. as one blob per genotype field instead of one column
+        per sample.
+        """
+        columns = self.cluster.metadata.keyspaces[self.keyspace].tables['variants'].columns
+        return 'gt_types' in columns
+
+    def _project_packed_genotypes(self):
+        """
+        Swap the per-sample genotype columns in the SELECT
+        (e.g. gt_types_na12878) for the packed blobs that hold them.
+        The requested values are pulled out of the blobs again by
+        unpack_genotypes. For a SELECT *, every blob is expanded into
+        the per-sample columns an unpacked keyspace has.
+        """
+        sample_to_idx = self._map_samples_to_indices()
+        if "*" in self.requested_columns:
+            # the columns of a sample are ordered by name, as Cassandra does
+            self.gt_projection = ("*", sorted(sample_to_idx.items()))
+            return
+
+        projection = []
+        plain_columns = []
+        for col in self.requested_columns:
+            field = None
+            for gt_field in GT_FIELDS:
+                if col.lower().startswith(gt_field + '_') and \
+                   col[len(gt_field) + 1:].lower() in sample_to_idx:
+                    field = gt_field
+                    break
+            if field is None:
+                plain_columns.append(col)
+                projection.append((col, None, None))
+            else:
+                projection.append((col.lower(), field, sample_to_idx[col[len(field) + 1:].lower()]))
+                if not field in self.extra_columns:
+                    self.extra_columns.append(field)
+
+        if len(plain_columns) < len(self.requested_columns):
+            self.requested_columns = plain_columns
+            self.gt_projection = projection
+
+    def _map_samples_to_indices(self):
+        """
+        Map (lowercased) sample names to their index in the packed genotype arrays.
+        """
+        self.session.row_factory = tuple_factory
+        res = self.session.execute("SELECT name, sample_id FROM samples")
+        return {name.lower(): sample_id - 1 for (name, sample_id) in res}
+
     def _get_matching_sample_ids(self, wildcard):
         
         if wildcard.strip() != "*":        
@@ -688,13 +781,16 @@ class GeminiQuery(object):
     def where_clause_to_exp(self, table, cols, clause):
         
         target_table = self.get_table_from_where_clause(table, clause)
-        exp = Basic_expression(target_table, cols, clause)
+        exp = Basic_expression(target_table, cols, clause, self.can_prune_table(target_table, cols, clause))
         return exp
     
-    def get_table_from_where_clause(self, table, where_clause):
-        
+    def get_restricted_columns(self, where_clause):
+        """
+        The columns of where_clause restricted to one value, and the one
+        restricted to a range (None if none is).
+        """
         where_clause = where_clause.replace('==','=')
-        clauses = where_clause.split("and")
+        clauses = re.split(r"\s+and\s+", where_clause, flags=re.IGNORECASE)
         
         range_clauses = filter(lambda x: '<' in x or '>' in x, clauses)    
             
@@ -715,6 +811,28 @@ class GeminiQuery(object):
         eq_clauses = filter(lambda x: not ('<' in x or '>' in x), clauses)
         eq_clauses = map(lambda x: x.split('='), eq_clauses)
         eq_columns = map(lambda x: x[0].strip(), eq_clauses)
+        return (eq_columns, range_col)
+    
+    def can_prune_table(self, table, column, where_clause):
+        """
+        Whether the rows of table that match where_clause can be looked up
+        for a set of values of column with an IN restriction: column is the
+        partition key, or a clustering column after ones restricted to one
+        value.
+        """
+        (eq_columns, range_col) = self.get_restricted_columns(where_clause)
+        table_meta = self.cluster.metadata.keyspaces[self.keyspace].tables[table]
+        partition_key = map(lambda x: x.name, table_meta.partition_key)
+        clustering_key = map(lambda x: x.name, table_meta.clustering_key)
+        if partition_key == [column]:
+            return True
+        if range_col or not column in clustering_key:
+            return False
+        return all(x in eq_columns for x in clustering_key[:clustering_key.index(column)])
+    
+    def get_table_from_where_clause(self, table, where_clause):
+        
+        (eq_columns, range_col) = self.get_restricted_columns(where_clause)
         
         relevant_tables = self.get_relevant_tables(table)
         
@@ -774,7 +892,9 @@ class GeminiQuery(object):
                         
         (column, sample) = left.split('.', 1)
                 
-        exp = Basic_expression('variants_by_samples_' + column, 'variant_id' , "sample_name = '" + sample + "' AND " + column + clause)
+        where_clause = "sample_name = '" + sample + "' AND " + column + clause
+        exp = Basic_expression('variants_by_samples_' + column, 'variant_id' , where_clause,
+                               self.can_prune_table('variants_by_samples_' + column, 'variant_id', where_clause))
         if not_exp:
             return NOT_expression(exp, 'variants', 'variant_id', self.n_variants)
         else:
@@ -804,10 +924,7 @@ class GeminiQuery(object):
         wildcard_rule = self._swap_genotype_for_number(wildcard_rule)
         wildcard_rule = wildcard_rule.replace('==', '=')
         
-        actual_nr_cores = min(len(sample_names), self.nr_cores)
-        
-        return GT_wildcard_expression(column, wildcard_rule, wildcard_op, sample_names, \
-                                       self.db_contact_points, self.keyspace, self.n_variants, actual_nr_cores) 
+        return GT_wildcard_expression(column, wildcard_rule, wildcard_op, sample_names, self.n_variants)
     
     def _swap_genotype_for_number(self, token):
                 
@@ -900,6 +1017,51 @@ def select_formatter(args):
     else:
         return SUPPORTED_FORMATS[args.format](args)
     
+def unpack_genotypes(row, gt_projection):
+    """
+    Rebuild a row fetched from a database with packed genotypes as it
+    was requested: per-sample genotype values are taken from the decoded
+    blobs and put back where the query asked for them.
+
+    gt_projection is ("*", [(sample name, sample_index), ...]) (replace
+    every blob in the row by the <gt_field>_<sample> columns of the
+    samples) or the list of (name, gt_field, sample_index) tuples built
+    by GeminiQuery._project_packed_genotypes, with gt_field None for
+    ordinary columns.
+    """
+    if gt_projection[0] == "*":
+        unpacked = OrderedDict()
+        for (col, val) in row.items():
+            if not col in GT_FIELDS:
+                unpacked[col] = val
+                continue
+            # as Python values, like those of the per-sample columns
+            values = [None] * len(gt_projection[1]) if val is None else \
+                compression.unpack_genotype_column(col, val).tolist()
+            for (sample, idx) in gt_projection[1]:
+                unpacked["%s_%s" % (col, sample)] = values[idx]
+        return unpacked
+
+    unpacked = OrderedDict()
+    arrays = {}
+    cols = row.keys()
+    i = 0
+    for (name, gt_field, idx) in gt_projection:
+        if gt_field is None:
+            # ordinary columns come first, in the order they were requested
+            unpacked[cols[i]] = row[cols[i]]
+            i += 1
+        else:
+            if not gt_field in arrays:
+                # as Python values, like those of the per-sample columns
+                arrays[gt_field] = None if row[gt_field] is None else \
+                    compression.unpack_genotype_column(gt_field, row[gt_field]).tolist()
+            unpacked[name] = None if arrays[gt_field] is None else arrays[gt_field][idx]
+    for col in cols[i:]:
+        if not col in unpacked and not col in arrays:
+            unpacked[col] = row[col]
+    return unpacked
+
 def _info_dict_to_string(info):
     """
     Flatten the VCF info-field OrderedDict into a string,
@@ -942,12 +1104,13 @@ def fold(function, iterable, initializer=None):
     
 class LoggedPagedResultHandler(object):
     
-    def __init__(self, future, extra_columns, output_path):
+    def __init__(self, future, extra_columns, output_path, gt_projection=None):
         self.error = None
         self.finished_event = Event()
         self.extra_columns = extra_columns
         self.output_path = output_path
         self.report_cols = None
+        self.gt_projection = gt_projection
         self.future = future
         self.future.add_callbacks(callback=self.handle_page, errback=self.handle_error)
 
@@ -956,6 +1119,8 @@ class LoggedPagedResultHandler(object):
         with open(self.output_path, 'a') as output:
                     
             for row in results:                
+                if self.gt_projection:
+                    row = unpack_genotypes(row, self.gt_projection)
                 if not self.report_cols:
                     self.report_cols = filter(lambda x: not x in self.extra_columns, row.keys())
                     
@@ -973,8 +1138,13 @@ class LoggedPagedResultHandler(object):
         sys.stderr.write(str(type(exc)) + "\n")
         self.finished_event.set()
 
-def fetch_matches(conn, proc_n, output_path, query, table, partition_key, extra_columns, db, keyspace, b_size):
-        
+def fetch_matches(conn, proc_n, output_path, query, table, partition_key, extra_columns, db, keyspace, b_size,
+                  prepared_query, gt_projection=None):
+    """
+    Fetch the matches sent over conn in batches of b_size, with
+    prepared_query (query with an IN clause of b_size values on the
+    partition key), which was prepared by the parent process.
+    """
     start = time.time()
     
     matches = conn.recv()
@@ -982,29 +1152,20 @@ def fetch_matches(conn, proc_n, output_path, query, table, partition_key, extra_
     
     error_count = 0
     
-    if cpu_count() > 8:            
-        nap = 1*(proc_n % 11)
-        sleep(nap)
-    
     session = connect_or_fail(db, keyspace)
     if not session:
         return       
     
-    if cpu_count() > 8:            
-        nap = 1*(11 - (proc_n % 11))
-        sleep(nap)
-    
+    # the statement is already prepared on the server; registering it lets
+    # the driver prepare it again on a node that has evicted it
+    session.cluster.add_prepared(prepared_query.query_id, prepared_query)
     batch_size = b_size       
-    in_clause = ','.join(list(repeat("?",batch_size))) 
-    batch_query = query + " WHERE %s IN (%s)" % (partition_key, in_clause)
-                
-    prepared_query = session.prepare(batch_query)
     
     print "setup ready in %.2f s" % (time.time() - start)
                 
     for i in range(n_matches / batch_size):
-        batch = matches[i*batch_size:(i+1)*batch_size]
-        error_count += execute_async_blocking(session, prepared_query, output_path, extra_columns, batch)             
+        batch = list(matches[i*batch_size:(i+1)*batch_size])
+        error_count += execute_async_blocking(session, prepared_query, output_path, extra_columns, batch, gt_projection=gt_projection)
                 
     if n_matches % batch_size != 0:
         leftovers_batch = matches[(n_matches / batch_size)*batch_size:]
@@ -1014,15 +1175,15 @@ def fetch_matches(conn, proc_n, output_path, query, table, partition_key, extra_
         else:
             in_clause = "','".join(leftovers_batch)            
             leftover_query = query + " WHERE %s IN ('%s')" % (partition_key, in_clause)
-        error_count += execute_async_blocking(session, leftover_query, output_path, extra_columns)      
+        error_count += execute_async_blocking(session, leftover_query, output_path, extra_columns, gt_projection=gt_projection)
     
     conn.send(error_count)
     conn.close()
     session.shutdown()
     
-def execute_async_blocking(session, query, output_path, extra_columns, pars=(),timeout=13.7):
+def execute_async_blocking(session, query, output_path, extra_columns, pars=(),timeout=13.7, gt_projection=None):
     future = session.execute_async(query,pars,timeout)          
-    handler = LoggedPagedResultHandler(future, extra_columns, output_path)
+    handler = LoggedPagedResultHandler(future, extra_columns, output_path, gt_projection)
     handler.finished_event.wait()
     if handler.error:
         return 1
@@ -1032,8 +1193,7 @@ def execute_async_blocking(session, query, output_path, extra_columns, pars=(),t
 def connect_or_fail(db, keyspace, retry = 0):
     
     try:
-        cluster = Cluster(db)
-        session = cluster.connect(keyspace)
+        session = get_session(db, keyspace)
         session.row_factory = ordered_dict_factory
         return session
     except Exception:
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+"""
+On-disk cache of the annotations of variants (see annotations.annotate_variant),
+so that loading the same regions again does not repeat the ~25 Tabix lookups
+per variant.
+
+The cache is an sqlite database keyed by (chrom, start, end, ref, alt). It
+carries a version stamp made from the geminicassandra version, the annotation
+resources and the size and modification time of every annotation file. When
+the stamp of an existing cache does not match, its contents are dropped.
+"""
+import os
+import sqlite3
+import cPickle
+import hashlib
+
+import annotations
+import version
+
+
+def get_cache_stamp(args):
+    """
+    Version stamp of the annotations a load with these arguments computes.
+    """
+    anno_files = annotations.get_anno_files(args)
+    files = []
+    for name in sorted(anno_files.keys()):
+        path = anno_files[name]
+        if os.path.exists(path):
+            stat = os.stat(path)
+            files.append((name, path, stat.st_size, int(stat.st_mtime)))
+        else:
+            files.append((name, path, None, None))
+    stamp = repr([version.__version__, annotations.get_resources(args), files,
+                  args.skip_cadd, args.skip_gerp_bp])
+    return hashlib.md5(stamp).hexdigest()
+
+
+class AnnotationCache(object):
+    """
+    Each loading process opens its own AnnotationCache. New entries are
+    written by flush(), which the loader calls once per buffer.
+    """
+    def __init__(self, path, args):
+        self.conn = sqlite3.connect(path, timeout=600)
+        # WAL lets the other loading processes read while one of them writes
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS cache_version (stamp TEXT)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS annotations (chrom TEXT, start INTEGER, "
+                          "end INTEGER, ref TEXT, alt TEXT, annos BLOB, "
+                          "PRIMARY KEY (chrom, start, end, ref, alt))")
+        self.conn.commit()
+        self._check_version(get_cache_stamp(args))
+        self.pending = []
+        self.hits = 0
+        self.misses = 0
+
+    def _check_version(self, stamp):
+        """
+        Empty the cache if it was filled with other annotations.
+        """
+        with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            res = self.conn.execute("SELECT stamp FROM cache_version").fetchall()
+            if res != [(stamp,)]:
+                self.conn.execute("DELETE FROM annotations")
+                self.conn.execute("DELETE FROM cache_version")
+                self.conn.execute("INSERT INTO cache_version VALUES (?)", (stamp,))
+
+    def get(self, var):
+        """
+        The cached annotations of the variant, or None.
+        """
+        res = self.conn.execute("SELECT annos FROM annotations WHERE chrom = ? AND start = ? "
+                                "AND end = ? AND ref = ? AND alt = ?", _get_key(var)).fetchone()
+        if res is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return cPickle.loads(str(res[0]))
+
+    def put(self, var, annos):
+        self.pending.append(_get_key(var) + (sqlite3.Binary(cPickle.dumps(annos, 2)),))
+
+    def flush(self):
+        if len(self.pending) > 0:
+            with self.conn:
+                self.conn.executemany("INSERT OR REPLACE INTO annotations VALUES (?,?,?,?,?,?)",
+                                      self.pending)
+            self.pending = []
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+
+def _get_key(var):
+    return (var.CHROM, var.start, var.end, var.REF, ','.join(var.ALT))
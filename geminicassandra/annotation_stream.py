@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+"""
+Sorted-sweep and block lookups in Tabix annotation files.
+
+For coordinate-sorted variants, a TabixStream reads each annotation
+track front to back, next to the variant stream, instead of seeking
+once per variant. It keeps a window of the records that may still
+overlap coming variants. When the next variant lies far ahead, it
+seeks instead of decompressing every record in between. The hits it
+returns are the same, in the same order, as those of a Tabix fetch
+over the variant's region.
+
+A RegionBlock does the same for a block of variants (e.g. a loader
+buffer): one fetch per cluster of nearby variants, after which each
+variant's hits are picked out of the fetched records in memory.
+"""
+import bisect
+import gzip
+import re
+import struct
+
+# Tabix presets (see tabix.h)
+TBX_GENERIC = 0
+TBX_VCF = 2
+TBX_UCSC = 0x10000
+
+# seek instead of streaming when more records than this are expected
+# between the end of the window and the next variant
+STREAM_MAX_SKIP = 1000
+
+# variants of a block closer than this (in bp) share a fetch
+BLOCK_MAX_GAP = 5000
+
+_leading_int = re.compile(r"\s*([+-]?\d+)")
+
+
+def read_tabix_conf(filename):
+    """
+    Read (preset, col_seq, col_beg, col_end) from the .tbi index of a
+    Tabix file, or return None if there is no .tbi index.
+    """
+    try:
+        with gzip.open(filename + ".tbi") as tbi:
+            header = tbi.read(24)
+    except IOError:
+        return None
+    if len(header) < 24 or header[:4] != "TBI\1":
+        return None
+    return struct.unpack("<4i", header[8:24])
+
+
+class TabixStream(object):
+    """
+    Answers the region queries on one Tabix file for variants that come
+    in coordinate order. Once a query goes back on the current chromosome
+    the input is taken to be unsorted and hits() returns None, for that
+    query and all later ones; the caller should fetch() those.
+    """
+    def __init__(self, tabix_file, parser, conf):
+        self.tabix_file = tabix_file
+        self.parser = parser
+        self.conf = conf
+        self.chrom = None
+        self.last_start = -1
+        self.records = None
+        self.pending = None
+        self.window = []
+        # to estimate the number of records per bp
+        self.records_read = 0
+        self.bp_read = 0
+        self.last_beg = 0
+        self.queries = 0
+        self.seeks = 0
+        self.sorted = True
+
+    def hits(self, chrom, start, end):
+        if chrom == self.chrom and start < self.last_start:
+            self.sorted = False
+        if not self.sorted:
+            return None
+        self.queries += 1
+        if chrom != self.chrom or self._too_far(start):
+            self._seek(chrom, start)
+        self.last_start = start
+
+        # records that end before this variant cannot overlap the next ones either
+        self.window = [rec for rec in self.window if rec[1] > start]
+        while True:
+            if self.pending is None:
+                self.pending = next(self.records, None)
+                if self.pending is None:
+                    break
+            if self.pending[0] >= end:
+                break
+            self.window.append(self.pending)
+            self.pending = None
+        return [rec[2] for rec in self.window if rec[0] < end and rec[1] > start]
+
+    def _too_far(self, start):
+        if self.pending is None or self.pending[0] >= start:
+            return False
+        density = self.records_read / float(max(1, self.bp_read))
+        return (start - self.pending[0]) * density > STREAM_MAX_SKIP
+
+    def _seek(self, chrom, start):
+        self.seeks += 1
+        self.chrom = chrom
+        self.window = []
+        self.pending = None
+        self.last_beg = start
+        try:
+            hit_iter = self.tabix_file.fetch(str(chrom), start, parser=self.parser,
+                                             multiple_iterators=True)
+        except (ValueError, KeyError):
+            hit_iter = []
+        self.records = self._read_records(hit_iter)
+
+    def _read_records(self, hit_iter):
+        for hit in hit_iter:
+            (beg, end) = get_interval(self.conf, str(hit).split("\t"))
+            self.records_read += 1
+            self.bp_read += max(0, beg - self.last_beg)
+            self.last_beg = max(beg, self.last_beg)
+            yield (beg, end, hit)
+
+
+def get_interval(conf, fields):
+    """
+    The 0-based, half-open interval Tabix indexes a record under
+    (as tbx_parse1 in htslib computes it).
+    """
+    (preset, col_seq, col_beg, col_end) = conf
+    beg = end = int(fields[col_beg - 1])
+    if preset & TBX_UCSC:
+        end += 1
+    else:
+        beg -= 1
+    beg = max(beg, 0)
+    end = max(end, 1)
+    if (preset & 0xffff) == TBX_GENERIC:
+        if col_end > 0:
+            end = int(fields[col_end - 1])
+    elif (preset & 0xffff) == TBX_VCF:
+        if len(fields[3]) > 0:
+            end = beg + len(fields[3])
+        if len(fields) > 7:
+            info = fields[7]
+            s = None
+            if info.startswith("END="):
+                s = info[4:]
+            elif ";END=" in info:
+                s = info[info.index(";END=") + 5:]
+            if s is not None:
+                m = _leading_int.match(s)
+                end = int(m.group(1)) if m else 0
+    return (beg, end)
+
+
+class RegionBlock(object):
+    """
+    Answers the region queries on one Tabix file for a known block of
+    regions, with one fetch per cluster of regions that lie within
+    BLOCK_MAX_GAP of each other. The regions need not be sorted.
+    With raw=True the hits are the lists of fields of the records
+    instead of the objects made by parser.
+    """
+    def __init__(self, tabix_file, parser, conf, regions, raw=False):
+        self.tabix_file = tabix_file
+        self.parser = parser
+        self.conf = conf
+        self.raw = raw
+        self.queries = 0
+        self.seeks = 0
+        # (chrom, start, end) -> its cluster, fetched on first use
+        self.clusters = {}
+        by_chrom = {}
+        for (chrom, start, end) in regions:
+            by_chrom.setdefault(chrom, []).append((start, end))
+        for chrom in by_chrom:
+            cluster = None
+            for (start, end) in sorted(set(by_chrom[chrom])):
+                if cluster is None or start - cluster[2] > BLOCK_MAX_GAP:
+                    cluster = [chrom, start, end, None]
+                else:
+                    cluster[2] = max(cluster[2], end)
+                self.clusters[(chrom, start, end)] = cluster
+
+    def hits(self, chrom, start, end):
+        """
+        The hits of the region, or None if it is not part of the block.
+        """
+        cluster = self.clusters.get((chrom, start, end))
+        if cluster is None:
+            return None
+        self.queries += 1
+        if cluster[3] is None:
+            cluster[3] = self._fetch(cluster[0], cluster[1], cluster[2])
+        (begs, records, max_length) = cluster[3]
+        # only records starting less than max_length before the region can reach it
+        lo = bisect.bisect_left(begs, start - max_length)
+        hi = bisect.bisect_left(begs, end)
+        return [records[i][2] for i in xrange(lo, hi) if records[i][1] > start]
+
+    def _fetch(self, chrom, start, end):
+        self.seeks += 1
+        try:
+            hit_iter = self.tabix_file.fetch(str(chrom), start, end,
+                                             parser=None if self.raw else self.parser)
+        except (ValueError, KeyError):
+            hit_iter = []
+        records = []
+        for hit in hit_iter:
+            if self.raw:
+                hit = hit.split("\t")
+                (beg, rec_end) = get_interval(self.conf, hit)
+            else:
+                (beg, rec_end) = get_interval(self.conf, str(hit).split("\t"))
+            records.append((beg, rec_end, hit))
+        begs = [rec[0] for rec in records]
+        max_length = max([rec[1] - rec[0] for rec in records] + [0])
+        return (begs, records, max_length)
@@ -4,14 +4,26 @@ import sqlite3
 import os
 import sys
 import collections
-import re
 from unidecode import unidecode
 from bx.bbi.bigwig_file import BigWigFile
 from geminicassandra.config import read_gemini_config
+from geminicassandra.annotation_stream import TabixStream, RegionBlock, read_tabix_conf
 
 # dictionary of anno_type -> open Tabix file handles
 annos = {}
 
+# "fetch": one Tabix fetch per variant and track.
+# "stream": a sorted sweep per track (see set_lookup_mode).
+lookup_mode = "fetch"
+# (anno, parser_type) -> TabixStream, or None if the track can't be streamed
+_streams = {}
+_fetch_count = 0
+# the block being annotated by annotate_block, and its RegionBlock per
+# (anno, parser_type, naming)
+_block = None
+_block_lookups = {}
+_block_counts = [0, 0]
+
 def get_anno_files( args ):
     config = read_gemini_config( args = args )
     anno_dirname = config["annotation_dir"]
@@ -57,6 +69,29 @@ def get_anno_files( args ):
     return annos
 
 class ClinVarInfo(object):
+    origin_code_map = {'0': 'unknown',
+                       '1': 'germline',
+                       '2': 'somatic',
+                       '4': 'inherited',
+                       '8': 'paternal',
+                       '16': 'maternal',
+                       '32': 'de-novo',
+                       '64': 'biparental',
+                       '128': 'uniparental',
+                       '256': 'not-tested',
+                       '512': 'tested-inconclusive',
+                       '1073741824': 'other'}
+
+    sig_code_map = {'0': 'unknown',
+                    '1': 'untested',
+                    '2': 'non-pathogenic',
+                    '3': 'probable-non-pathogenic',
+                    '4': 'probable-pathogenic',
+                    '5': 'pathogenic',
+                    '6': 'drug-response',
+                    '7': 'histocompatibility',
+                    '255': 'other'}
+
     def __init__(self):
         self.clinvar_dbsource = None
         self.clinvar_dbsource_id = None
@@ -71,29 +106,6 @@ class ClinVarInfo(object):
         self.clinvar_on_diag_assay = None
         self.clinvar_causal_allele = None
 
-        self.origin_code_map = {'0': 'unknown',
-                                '1': 'germline',
-                                '2': 'somatic',
-                                '4': 'inherited',
-                                '8': 'paternal',
-                                '16': 'maternal',
-                                '32': 'de-novo',
-                                '64': 'biparental',
-                                '128': 'uniparental',
-                                '256': 'not-tested',
-                                '512': 'tested-inconclusive',
-                                '1073741824': 'other'}
-
-        self.sig_code_map = {'0': 'unknown',
-                             '1': 'untested',
-                             '2': 'non-pathogenic',
-                             '3': 'probable-non-pathogenic',
-                             '4': 'probable-pathogenic',
-                             '5': 'pathogenic',
-                             '6': 'drug-response',
-                             '7': 'histocompatibility',
-                             '255': 'other'}
-
     def __repr__(self):
         return '\t'.join([self.clinvar_dbsource,
                           self.clinvar_dbsource_id,
@@ -172,6 +184,35 @@ ExacInfo = collections.namedtuple("ExacInfo",
                                    aaf_OTH \
                                    aaf_SAS")
 
+# everything geminicassandra's own annotation files tell about a variant
+VariantAnnotations = collections.namedtuple("VariantAnnotations",
+                                            "pfam_domain \
+                                             cyto_band \
+                                             rs_ids \
+                                             clinvar_info \
+                                             in_dbsnp \
+                                             rmsk_hits \
+                                             in_cpg \
+                                             in_segdup \
+                                             is_conserved \
+                                             esp \
+                                             thousandG \
+                                             recomb_rate \
+                                             gms \
+                                             grc \
+                                             in_cse \
+                                             encode_tfbs \
+                                             encode_dnaseI \
+                                             encode_cons_seg \
+                                             gerp_el \
+                                             vista_enhancers \
+                                             cosmic_ids \
+                                             fitcons \
+                                             Exac \
+                                             cadd_raw \
+                                             cadd_scaled \
+                                             gerp_bp")
+
 def load_annos( args ):
     """
     Populate a dictionary of Tabixfile handles for
@@ -204,19 +245,83 @@ def load_annos( args ):
 # ## Standard access to Tabix indexed files
 
 
-def _get_hits(coords, annotation, parser_type):
-    """Retrieve BED information, recovering if BED annotation file does have a chromosome.
+def set_lookup_mode(mode):
     """
+    Choose how annotations_in_region looks up the tracks opened by
+    load_annos. "stream" answers the lookups with one sorted sweep per
+    track and is meant for coordinate-sorted variants. It falls back to
+    fetch for a track as soon as a variant goes back on its chromosome.
+    This also resets the streams and the lookup counts, so call it
+    before each sorted run of variants.
+    """
+    global lookup_mode, _streams, _fetch_count, _block_counts
+    lookup_mode = mode
+    _streams = {}
+    _fetch_count = 0
+    _block_counts = [0, 0]
+
+def get_lookup_counts():
+    """
+    Number of region lookups and Tabix seeks since set_lookup_mode.
+    """
+    streams = [stream for stream in _streams.values() if stream is not None]
+    return (_fetch_count + _block_counts[0] + sum(stream.queries for stream in streams),
+            _fetch_count + _block_counts[1] + sum(stream.seeks for stream in streams))
+
+def _get_parser(parser_type):
     if parser_type == "bed":
-        parser = pysam.asBed()
+        return pysam.asBed()
     elif parser_type == "vcf":
-        parser = pysam.asVCF()
+        return pysam.asVCF()
     elif parser_type == "tuple":
-        parser = pysam.asTuple()
+        return pysam.asTuple()
     elif parser_type is None:
-        parser = None
+        return None
     else:
-        raise ValueError("Unexpected parser type: %s" % parser)
+        raise ValueError("Unexpected parser type: %s" % parser_type)
+
+def _get_stream_hits(coords, anno, parser_type):
+    """
+    Hits of a sorted sweep over the named annotation file,
+    or None if they have to be fetched.
+    """
+    key = (anno, parser_type)
+    if key not in _streams:
+        conf = read_tabix_conf(annos[anno].filename)
+        _streams[key] = TabixStream(annos[anno], _get_parser(parser_type), conf) \
+                            if conf is not None else None
+    stream = _streams[key]
+    if stream is None:
+        return None
+    chrom, start, end = coords
+    return stream.hits(str(chrom), start, end)
+
+def _get_block_hits(coords, anno, parser_type, naming):
+    """
+    Hits of a variant of the block being annotated by annotate_block,
+    or None if they have to be fetched.
+    """
+    key = (anno, parser_type, naming)
+    if key not in _block_lookups:
+        conf = read_tabix_conf(annos[anno].filename)
+        # tuple hits are read as plain lists of fields, which is cheaper
+        # than going through pysam's tuple parser
+        _block_lookups[key] = RegionBlock(annos[anno], _get_parser(parser_type), conf,
+                                          [_get_var_coords(var, naming) for var in _block],
+                                          raw=(parser_type == "tuple")) \
+                                  if conf is not None else None
+    lookup = _block_lookups[key]
+    if lookup is None:
+        return None
+    chrom, start, end = coords
+    return lookup.hits(chrom, start, end)
+
+def _get_hits(coords, annotation, parser_type):
+    """Retrieve BED information, recovering if BED annotation file does have a chromosome.
+    """
+    global _fetch_count
+    _fetch_count += 1
+    parser = _get_parser(parser_type)
     chrom, start, end = coords
     try:
         hit_iter = annotation.fetch(str(chrom), start, end, parser=parser)
@@ -275,18 +380,24 @@ def _get_var_coords(var, naming):
         chrom = _get_chr_as_grch37(chrom)
     return chrom, start, end
 
-def _get_cadd_scores(var, labels, hit):
+def _make_cadd_allele_index():
     """
-    get cadd scores
+    Map (reference base in the CADD file, REF, ALT) to the column holding
+    the scores of that substitution. For each reference base, CADD lists the
+    scores of the alternate bases in the order given by labels. The
+    ambiguity codes R (G,A) and M (A,C) match either of their bases.
     """
-    raw = hit[3].split(",")
-    scaled = hit[4].split(",")
-    
-    p = re.compile(str(var.ALT[0]))
-    for m in p.finditer(str(labels[hit[2]])):
-        pos = m.start()
-        return raw[pos], scaled[pos]
-        
+    labels = {"A":"CGT", "C":"AGT", "G":"ACT", "T":"ACG", "R":"ACGT", "M":"ACGT"}
+    ambiguous = {"R": "GA", "M": "AC"}
+    index = {}
+    for (cadd_ref, alts) in labels.items():
+        for ref in cadd_ref + ambiguous.get(cadd_ref, ""):
+            for (column, alt) in enumerate(alts):
+                index[(cadd_ref, ref, alt)] = column
+    return index
+
+CADD_ALLELE_INDEX = _make_cadd_allele_index()
+
 
 def annotations_in_region(var, anno, parser_type=None, naming="ucsc"):
     """Iterator of annotations found in a genomic region.
@@ -299,6 +410,14 @@ def annotations_in_region(var, anno, parser_type=None, naming="ucsc"):
     """
     coords = _get_var_coords(var, naming)
     if isinstance(anno, basestring):
+        if _block is not None:
+            hits = _get_block_hits(coords, anno, parser_type, naming)
+            if hits is not None:
+                return hits
+        elif lookup_mode == "stream":
+            hits = _get_stream_hits(coords, anno, parser_type)
+            if hits is not None:
+                return hits
         anno = annos[anno]
     return _get_hits(coords, anno, parser_type)
 
@@ -419,23 +538,22 @@ def get_cadd_scores(var):
                       "Run `geminicassandra update --dataonly --extra cadd_score")
 
     cadd_raw = cadd_scaled = None
-    labels = {"A":"CGT", "C":"AGT", "G":"ACT", "T":"ACG", "R":"ACGT", "M":"ACGT"}
-    
+    # we do not want to consider del & ins
+    if len(var.REF) != 1 or len(var.ALT[0]) != 1:
+        return (cadd_raw, cadd_scaled)
+
+    pos = str(var.POS)
+    ref = var.REF
+    alt = str(var.ALT[0])
     for hit in annotations_in_region(var, "cadd_score", "tuple", "grch37"):
         # we want exact position mapping here and not a range (end-start) as
-        # returned in hit (e.g. indels) & we do not want to consider del & ins
-        if str(hit[1]) == str(var.POS) and len(var.REF) == 1 and \
-           len(var.ALT[0]) == 1:
-           
-            if str(hit[2]) == var.REF and str(var.ALT[0]) in labels[hit[2]]:
-               (cadd_raw, cadd_scaled) = _get_cadd_scores(var, labels, hit)
-            
-            # consider ref cases with ambiguity codes R (G,A) and M (A,C)
-            elif ((str(hit[2]) == 'R'  and var.REF in('G','A')) or \
-                (str(hit[2]) == 'M'  and var.REF in('A','C'))) and \
-                str(var.ALT[0]) in labels[hit[2]]:
-                (cadd_raw, cadd_scaled) = _get_cadd_scores(var, labels, hit)
-    
+        # returned in hit (e.g. indels)
+        if hit[1] == pos:
+            column = CADD_ALLELE_INDEX.get((hit[2], ref, alt))
+            if column is not None:
+                cadd_raw = hit[3].split(",")[column]
+                cadd_scaled = hit[4].split(",")[column]
+
     return (cadd_raw, cadd_scaled)
      
     
@@ -934,6 +1052,86 @@ def get_encode_chromhmm_segs(var):
     return ENCODESegInfo(None, None, None, None, None, None)
 
 
+def annotate_variant(var, skip_cadd=False, skip_gerp_bp=False):
+    """
+    Look up the variant in all of the annotation files.
+    """
+    rs_ids = get_dbsnp_info(var)
+
+    #load CADD scores by default
+    if skip_cadd is False:
+        (cadd_raw, cadd_scaled) = get_cadd_scores(var)
+    else:
+        (cadd_raw, cadd_scaled) = (None, None)
+
+    # load the GERP score for this variant by default.
+    gerp_bp = None
+    if skip_gerp_bp is False:
+        gerp_bp = get_gerp_bp(var)
+
+    return VariantAnnotations(get_pfamA_domains(var),
+                              get_cyto_info(var),
+                              rs_ids,
+                              get_clinvar_info(var),
+                              0 if rs_ids is None else 1,
+                              get_rmsk_info(var),
+                              get_cpg_island_info(var),
+                              get_segdup_info(var),
+                              get_conservation_info(var),
+                              get_esp_info(var),
+                              get_1000G_info(var),
+                              get_recomb_info(var),
+                              get_gms(var),
+                              get_grc(var),
+                              get_cse(var),
+                              get_encode_tfbs(var),
+                              get_encode_dnase_clusters(var),
+                              get_encode_consensus_segs(var),
+                              get_gerp_elements(var),
+                              get_vista_enhancers(var),
+                              get_cosmic_info(var),
+                              get_fitcons(var),
+                              get_exac_info(var),
+                              cadd_raw,
+                              cadd_scaled,
+                              gerp_bp)
+
+def annotate_block(vars, skip_cadd=False, skip_gerp_bp=False):
+    """
+    Annotate a block of variants (e.g. a buffer of the loader) with one
+    fetch per annotation file for each cluster of nearby variants,
+    instead of one per variant. Returns the annotate_variant result of
+    each variant.
+    """
+    global _block, _block_lookups
+    _block = vars
+    _block_lookups = {}
+    try:
+        return [annotate_variant(var, skip_cadd, skip_gerp_bp) for var in vars]
+    finally:
+        for lookup in _block_lookups.values():
+            if lookup is not None:
+                _block_counts[0] += lookup.queries
+                _block_counts[1] += lookup.seeks
+        _block = None
+        _block_lookups = {}
+
+def no_annotations():
+    """
+    The annotations of a variant that is too big to annotate.
+    """
+    return VariantAnnotations(None, None, None, ClinVarInfo(), None, None, None, None, None,
+                              ESPInfo(None, None, None, None, None),
+                              ThousandGInfo(None, None, None, None, None, None, None),
+                              None,
+                              GmsTechs(None, None, None),
+                              None, None, None,
+                              ENCODEDnaseIClusters(None, None),
+                              ENCODESegInfo(None, None, None, None, None, None),
+                              None, None, None, None,
+                              ExacInfo(None, None, None, None, None, None, None, None, None, None),
+                              None, None, None)
+
 def get_resources( args ):
     """Retrieve list of annotation resources loaded into geminicassandra.
     """
@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+"""
+Offline export of the rows of the loader for bulk import (load --sstable-out).
+
+A BulkExporter takes the place of the loader's AdaptiveWriter: instead of
+inserting the rows into the cluster, it keeps them per table and, every
+RUN_ROWS rows, sorts them in the order of the partitioner (the Murmur3
+token of the partition key, then the clustering columns) and spills them
+to a run file. Once all chunks are loaded, merge_runs merges the runs of
+each table into one sorted, partition-grouped CSV file with a header, and
+writes a cqlsh script that imports them with COPY. As the rows are in
+token order, they can also be fed to a CQLSSTableWriter in sorted() mode
+to build SSTables for sstableloader.
+"""
+import os
+import csv
+import sys
+import glob
+import heapq
+import struct
+import cPickle
+from itertools import count, islice
+
+from cassandra.murmur3 import murmur3
+
+# rows kept in memory (over all tables) before they are spilled
+RUN_ROWS = 500000
+# most runs merged at once; more runs are merged in several passes
+MERGE_FAN_IN = 128
+# records per pickle in a run file
+RUN_BLOCK = 1000
+
+RUN_SUFFIX = ".run"
+IMPORT_SCRIPT = "import.cql"
+
+# numbers the run files of this process, over all the chunks it loads
+_run_numbers = count()
+
+
+class BulkExporter(object):
+    """
+    Writes the rows of prepared inserts to sorted run files in directory.
+    execute() and wait() behave like those of write_control.AdaptiveWriter,
+    so the loader's writer stage can use either.
+    """
+    def __init__(self, directory, cluster):
+        self.directory = directory
+        self.cluster = cluster
+        # per query string: (table, columns, key function, row formatter)
+        self.tables = {}
+        # per table: its columns
+        self.columns = {}
+        # per table: [(sort key, formatted row)]
+        self.runs = {}
+        self.buffered_rows = 0
+        self.run_files = 0
+        self.rows = 0
+        self.rows_without_key = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def execute(self, query, rows):
+        (table, columns, get_key, format_row) = self._get_table(query)
+        run = self.runs.setdefault(table, [])
+        for row in rows:
+            key = get_key(row)
+            if key is None:
+                # Cassandra would reject it as well
+                self.rows_without_key += 1
+                continue
+            run.append((key, format_row(row)))
+        self.rows += len(rows)
+        self.buffered_rows += len(rows)
+        if self.buffered_rows >= RUN_ROWS:
+            self._spill()
+
+    def wait(self):
+        pass
+
+    def close(self):
+        self._spill()
+
+    def report(self):
+        return "%d rows to %d run files in %s, %d rows without a partition key dropped" % \
+            (self.rows, self.run_files, self.directory, self.rows_without_key)
+
+    def _get_table(self, query):
+        if query.query_string not in self.tables:
+            (table, columns, get_key, format_row) = _describe_insert(query, self.cluster)
+            self.tables[query.query_string] = (table, columns, get_key, format_row)
+            self.columns[table] = columns
+        return self.tables[query.query_string]
+
+    def _spill(self):
+        for (table, run) in self.runs.iteritems():
+            if len(run) == 0:
+                continue
+            run.sort(key=lambda record: record[0])
+            _write_run(self.directory, table, self.columns[table], run)
+            self.run_files += 1
+        self.runs = {}
+        self.buffered_rows = 0
+
+
+def _describe_insert(query, cluster):
+    """
+    The table and columns of a prepared insert, a function returning the
+    sort key of a row (its token, partition key and clustering columns)
+    and one formatting a row for cqlsh COPY.
+    """
+    (keyspace, table) = query.column_metadata[0][0:2]
+    columns = [column[2] for column in query.column_metadata]
+    types = [column[3] for column in query.column_metadata]
+    table_meta = cluster.metadata.keyspaces[keyspace].tables[table]
+    partition_key = [columns.index(column.name) for column in table_meta.partition_key]
+    clustering_key = [columns.index(column.name) for column in table_meta.clustering_key]
+    protocol_version = cluster.protocol_version
+
+    def get_key(row):
+        parts = []
+        for i in partition_key:
+            if row[i] is None:
+                return None
+            parts.append(types[i].serialize(row[i], protocol_version))
+        if len(parts) == 1:
+            routing_key = parts[0]
+        else:
+            # the composite partition key, as the driver routes it
+            routing_key = "".join(struct.pack(">H", len(part)) + part + "\x00" for part in parts)
+        return (murmur3(routing_key), routing_key, [row[i] for i in clustering_key])
+
+    formats = [_format_blob if t.typename == "blob" else _format_value for t in types]
+
+    def format_row(row):
+        return [f(value) for (f, value) in zip(formats, row)]
+
+    return (table, columns, get_key, format_row)
+
+
+def _format_value(value):
+    if value is None:
+        return ""
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def _format_blob(value):
+    if value is None:
+        return ""
+    return "0x" + str(value).encode("hex")
+
+
+def _write_run(directory, table, columns, records):
+    """
+    Write sorted (sort key, formatted row) records to a new run file of
+    table, after a record with the names of the columns.
+    """
+    path = os.path.join(directory, "%s.%d.%d%s" % (table, os.getpid(), _run_numbers.next(), RUN_SUFFIX))
+    records = iter(records)
+    with open(path, "wb") as handle:
+        cPickle.dump(columns, handle, 2)
+        while True:
+            block = list(islice(records, RUN_BLOCK))
+            if len(block) == 0:
+                break
+            cPickle.dump(block, handle, 2)
+    return path
+
+
+def _read_run(path):
+    with open(path, "rb") as handle:
+        cPickle.load(handle)
+        while True:
+            try:
+                block = cPickle.load(handle)
+            except EOFError:
+                return
+            for record in block:
+                yield record
+
+
+def merge_runs(directory, keyspace):
+    """
+    Merge the run files in directory into one sorted CSV file per table
+    (<table>.csv, with a header) and write import.cql, which loads them
+    with `cqlsh -f`. The runs are removed once they are merged.
+    """
+    runs = {}
+    for path in glob.glob(os.path.join(directory, "*" + RUN_SUFFIX)):
+        runs.setdefault(os.path.basename(path).split(".")[0], []).append(path)
+    commands = []
+    for table in sorted(runs):
+        paths = sorted(runs[table])
+        n_runs = len(paths)
+        with open(paths[0], "rb") as handle:
+            columns = cPickle.load(handle)
+        while len(paths) > MERGE_FAN_IN:
+            merged = _write_run(directory, table, columns,
+                                heapq.merge(*[_read_run(path) for path in paths[:MERGE_FAN_IN]]))
+            for path in paths[:MERGE_FAN_IN]:
+                os.remove(path)
+            paths = paths[MERGE_FAN_IN:] + [merged]
+        csv_path = os.path.join(directory, table + ".csv")
+        n_rows = 0
+        with open(csv_path, "wb") as out:
+            writer = csv.writer(out)
+            writer.writerow(columns)
+            for (key, row) in heapq.merge(*[_read_run(path) for path in paths]):
+                writer.writerow(row)
+                n_rows += 1
+        for path in paths:
+            os.remove(path)
+        commands.append("COPY %s.%s (%s) FROM '%s' WITH HEADER = true;\n" %
+                        (keyspace, table, ", ".join(columns), os.path.abspath(csv_path)))
+        sys.stderr.write("%s: %d rows from %d runs.\n" % (csv_path, n_rows, n_runs))
+    with open(os.path.join(directory, IMPORT_SCRIPT), "w") as script:
+        script.writelines(commands)
+    sys.stderr.write("Import the tables with: cqlsh -f %s\n" % os.path.join(directory, IMPORT_SCRIPT))
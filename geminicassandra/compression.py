@@ -10,9 +10,39 @@ from gemini_utils import OrderedDict
 # pickle-a-string
 
 
+# numpy dtypes of the genotype columns when they are stored packed,
+# i.e. as one blob per variant holding the values of all samples.
+# gts holds strings and is pickled instead.
+GT_COLUMN_DTYPES = {'gt_types': numpy.int8,
+                    'gt_phases': numpy.int8,
+                    'gt_depths': numpy.int32,
+                    'gt_ref_depths': numpy.int32,
+                    'gt_alt_depths': numpy.int32,
+                    'gt_quals': numpy.float32,
+                    'gt_copy_numbers': numpy.float32}
+
 def pack_blob(obj):
     return sqlite3.Binary(zdumps(obj))
 
+def pack_genotype_column(column, values):
+    """
+    Pack the per-sample values of a genotype column
+    (gts, gt_types, ...) of one variant into a blob.
+    """
+    if column in GT_COLUMN_DTYPES:
+        array = numpy.asarray(values, dtype=GT_COLUMN_DTYPES[column])
+        return sqlite3.Binary(zlib.compress(array.tostring(), 1))
+    return pack_blob(values)
+
+def unpack_genotype_column(column, blob):
+    """
+    Inverse of pack_genotype_column: returns a numpy array
+    with one value per sample.
+    """
+    if column in GT_COLUMN_DTYPES:
+        return numpy.frombuffer(zlib.decompress(blob), dtype=GT_COLUMN_DTYPES[column])
+    return unpack_genotype_blob(blob)
+
 def unpack_genotype_blob(blob):
     return numpy.array(cPickle.loads(zlib.decompress(blob)))
     
@@ -1,10 +1,83 @@
 #!/usr/bin/env python
 
+import sys
 from itertools import repeat
+from string import strip
 
+from cassandra import ConsistencyLevel
+from cassandra.cluster import Cluster
+from cassandra.policies import DCAwareRoundRobinPolicy, HostDistance, TokenAwarePolicy
 from cassandra.query import BatchStatement, SimpleStatement
 from cassandra.concurrent import execute_concurrent_with_args
 
+from geminicassandra.config import read_gemini_config
+
+# settings of the connections made by get_session, see set_connection_options
+CONNECTION_OPTIONS = ['local_dc', 'core_connections', 'max_connections',
+                      'protocol_version', 'compression', 'connect_timeout',
+                      'request_timeout']
+_connection_options = {}
+
+
+def set_connection_options(args):
+    """
+    Take the connection settings from the command line, or else from
+    the 'cassandra' section of the geminicassandra config file, e.g.
+
+    cassandra:
+      local_dc: dc1
+      request_timeout: 30
+
+    Settings given nowhere are left to the driver.
+    """
+    config = read_gemini_config(allow_missing=True, args=args).get('cassandra') or {}
+    _connection_options.clear()
+    for option in CONNECTION_OPTIONS:
+        value = getattr(args, option, None)
+        if value is None:
+            value = config.get(option)
+        if value is not None:
+            _connection_options[option] = value
+    # the pool size can only be set for protocol versions 1 and 2; later
+    # versions multiplex the requests over one connection per host
+    if int(_connection_options.get('protocol_version', 3)) >= 3:
+        for option in ['core_connections', 'max_connections']:
+            if _connection_options.pop(option, None) is not None:
+                sys.stderr.write("WARNING: %s can only be set with protocol version 1 or 2, "
+                                 "ignored.\n" % option)
+
+def get_session(contact_points, keyspace=None):
+    """
+    Connect to the Cassandra cluster (the contact points are a list or a
+    comma-separated string) and return the session; its cluster is
+    session.cluster. Requests are routed token-aware, to a replica of
+    their partition in the local data center, when their routing key is
+    known (as for prepared statements).
+    """
+    if isinstance(contact_points, basestring):
+        contact_points = map(strip, contact_points.split(','))
+    options = _connection_options
+    cluster_args = {}
+    if 'protocol_version' in options:
+        cluster_args['protocol_version'] = int(options['protocol_version'])
+    if 'compression' in options:
+        compression = str(options['compression'])
+        cluster_args['compression'] = {'auto': True, 'none': False}.get(compression, compression)
+    if 'connect_timeout' in options:
+        cluster_args['connect_timeout'] = float(options['connect_timeout'])
+        cluster_args['control_connection_timeout'] = float(options['connect_timeout'])
+    cluster = Cluster(contact_points,
+                      load_balancing_policy=TokenAwarePolicy(DCAwareRoundRobinPolicy(local_dc=options.get('local_dc', ''))),
+                      **cluster_args)
+    if 'core_connections' in options:
+        cluster.set_core_connections_per_host(HostDistance.LOCAL, int(options['core_connections']))
+    if 'max_connections' in options:
+        cluster.set_max_connections_per_host(HostDistance.LOCAL, int(options['max_connections']))
+    session = cluster.connect(keyspace)
+    if 'request_timeout' in options:
+        session.default_timeout = float(options['request_timeout'])
+    return session
+
 
 def drop_tables(session):
     session.execute("DROP TABLE IF EXISTS variants")
@@ -49,6 +122,24 @@ def create_tables(session, gt_column_names, extra_sample_columns):
                      table_name text PRIMARY KEY,                  \
                      n_rows int)'''))
 
+    # the checkpoints of the loads, see load_progress
+    session.execute(SimpleStatement('''CREATE TABLE if not exists load_progress ( \
+                     load_id text,                           \
+                     chunk int,                              \
+                     next_line int,                          \
+                     next_variant_id int,                    \
+                     n_variants int,                         \
+                     n_new_variants int,                     \
+                     gt_counts blob,                         \
+                     setup blob,                             \
+                     done boolean,                           \
+                     PRIMARY KEY (load_id, chunk))'''))
+
+    # the next free id of each id space (e.g. 'variants'), see reserve_ids
+    session.execute(SimpleStatement('''CREATE TABLE if not exists id_ranges ( \
+                     name text PRIMARY KEY,                  \
+                     next_id int)'''))
+
     session.execute(SimpleStatement('''CREATE TABLE if not exists version ( \
                      version text PRIMARY KEY)'''))
     
@@ -131,13 +222,13 @@ def create_tables(session, gt_column_names, extra_sample_columns):
                         gene text,
                         PRIMARY KEY (gene, variant_id))'''))
     
+    # counters, so that every loading process can add its counts
     session.execute(SimpleStatement('''CREATE TABLE if not exists sample_genotype_counts ( \
                      sample_id int PRIMARY KEY, \
-                     version int,                                   \
-                     num_hom_ref int,                                 \
-                     num_het int,                                     \
-                     num_hom_alt int,                                 \
-                     num_unknown int)'''))
+                     num_hom_ref counter,                             \
+                     num_het counter,                                 \
+                     num_hom_alt counter,                             \
+                     num_unknown counter)'''))
      
     
     session.execute(create_variants_table(gt_column_names))
@@ -320,6 +411,55 @@ def insert(session, table, columns, contents):
     insert_query = 'INSERT INTO ' + table + ' (' + column_names + ') VALUES (' + placeholders + ')'
     session.execute(insert_query, contents)
 
+def compare_and_set(session, table, key_column, key, column, update, get_default):
+    """
+    Set column, in the row of table with the given key, to update(value)
+    with a lightweight transaction, retrying whenever another loader
+    changed it in the meantime. A missing row counts as having the value
+    get_default(). Returns the (old, new) value.
+    """
+    select = SimpleStatement("SELECT %s FROM %s WHERE %s = %%s" % (column, table, key_column),
+                             consistency_level=ConsistencyLevel.SERIAL)
+    insert_query = "INSERT INTO %s (%s, %s) VALUES (%%s, %%s) IF NOT EXISTS" % (table, key_column, column)
+    update_query = "UPDATE %s SET %s = %%s WHERE %s = %%s IF %s = %%s" % (table, column, key_column, column)
+    while True:
+        rows = list(session.execute(select, [key]))
+        if len(rows) == 0:
+            old = get_default()
+            new = update(old)
+            result = session.execute(insert_query, [key, new])
+        else:
+            old = rows[0][0]
+            new = update(old)
+            result = session.execute(update_query, [new, key, old])
+        # the first column of a conditional update tells whether it was applied
+        if list(result)[0][0]:
+            return (old, new)
+
+def reserve_ids(session, name, n_ids, get_first_free):
+    """
+    Reserve n_ids consecutive ids of the id space name and return the
+    first one. get_first_free() gives the first free id of an id space
+    that has no entry in id_ranges yet.
+    """
+    return compare_and_set(session, 'id_ranges', 'name', name, 'next_id',
+                           lambda next_id: next_id + n_ids, get_first_free)[0]
+
+def mark_ids_used(session, name, next_id):
+    """
+    Record that the ids of the id space name below next_id are used.
+    """
+    compare_and_set(session, 'id_ranges', 'name', name, 'next_id',
+                    lambda current: max(current, next_id), lambda: 1)
+
+def add_to_row_count(session, table_name, n):
+    """
+    Add n to the row count of table_name, without losing the counts
+    added by concurrent loads.
+    """
+    compare_and_set(session, 'row_counts', 'table_name', table_name, 'n_rows',
+                    lambda n_rows: (n_rows or 0) + n, lambda: 0)
+
 def update_gene_summary_w_cancer_census(session, genes):
     update_qry = "UPDATE gene_summary SET in_cosmic_census = ? "
     update_qry += " WHERE gene = ? and chrom = ?"
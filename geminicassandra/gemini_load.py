@@ -3,20 +3,39 @@
 # native Python imports
 import os.path
 import sys
+import gzip
 
 import annotations
 import subprocess
-from gemini_load_chunk import GeminiLoader
+from gemini_load_chunk import GeminiLoader, check_gt_counts_table
+from database_cassandra import get_session, insert, add_to_row_count, mark_ids_used
+import write_control
+import bulk_export
+from load_progress import LoadJournal, get_load_id, restore_setup, LAYOUT_ARGS
 import time
-from cassandra.cluster import Cluster
 from string import strip
+import copy
+import struct
+import zlib
+from itertools import chain
+from multiprocessing import Pool
+
+# grabix stores the offset of every GRABIX_CHUNK_SIZE-th line in its index
+GRABIX_CHUNK_SIZE = 10000
 
 
 def load(parser, args):
+    if args.replay:
+        write_control.replay(args)
+        return
     #if (args.db is None or args.vcf is None):
     if args.vcf is None:
         parser.print_help()
         exit("ERROR: load needs both a VCF file\n")
+    if args.append and args.total_nodes > 1:
+        exit("ERROR: --append loads on a single node.\n")
+    if args.resume and args.sstable_out is not None:
+        exit("ERROR: --sstable-out loads cannot be resumed.\n")
     
     start_time = time.time()
     annos = annotations.get_anno_files( args )
@@ -47,18 +66,65 @@ def load(parser, args):
     if(args.node_num == 1):
         gemini_loader = GeminiLoader(args)
         gemini_loader.setup_db()
-        time_2 = time.time()
-        gemini_loader.single_core_stuff()
-        time_3 = time.time()
+        session = gemini_loader.session
+    else:
+        session = get_session(args.contact_points, args.keyspace)
+        if not args.no_genotypes and not args.no_load_genotypes:
+            check_gt_counts_table(session.cluster, args.keyspace)
+
+    # the checkpoints of the load, see load_progress. The rows exported
+    # with --sstable-out are only safe once the runs are merged, so
+    # those loads keep none.
+    journal = None
+    setup = None
+    if args.sstable_out is None:
+        args.load_id = get_load_id(args)
+        journal = LoadJournal(session, args.load_id)
+        if args.resume:
+            setup = journal.get_setup()
+            if setup is None:
+                sys.stderr.write("No earlier load of %s to resume, starting it over.\n" % args.vcf)
+    checkpoints = {}
+    if setup is not None:
+        (decisions, done) = setup
+        if done:
+            print "The load of %s has finished before, nothing to resume." % args.vcf
+            return
+        if not all(name in decisions for name in LAYOUT_ARGS):
+            exit("ERROR: the checkpoints of the load of %s do not record its chunks, "
+                 "it has to be started over (without --resume).\n" % args.vcf)
+        restore_setup(args, decisions)
+        checkpoints = journal.get_checkpoints()
+        print "Resuming the load of %s." % args.vcf
+    else:
+        if journal is not None:
+            journal.clear()
+        if(args.node_num == 1):
+            if args.append:
+                gemini_loader.prepare_append(count_vcf_lines(args))
+            time_2 = time.time()
+            gemini_loader.single_core_stuff()
+            time_3 = time.time()
+        if journal is not None:
+            journal.save_setup(args)
         
-    n_variants = 0
-    
     if args.cores > 1:
-        n_variants = load_multicore(args)
+        # the chunks are loaded by forked workers, which must not inherit
+        # the running driver threads of the setup connection;
+        # load_chunks_multicore reconnects the journal once they are done
+        session.cluster.shutdown()
+        (n_variants, n_new_variants) = load_multicore(args, checkpoints, journal)
     else:
-        n_variants = load_singlecore(args)
+        (n_variants, n_new_variants) = load_singlecore(args, checkpoints, journal)
+
+    if args.sstable_out is not None:
+        bulk_export.merge_runs(args.sstable_out, args.keyspace)
         
-    insert_n_variants(map(strip, args.contact_points.split(',')), args.keyspace, n_variants)
+    store_n_variants(args, n_variants, n_new_variants)
+    if journal is not None:
+        journal.finish()
+        if args.cores > 1:
+            journal.session.cluster.shutdown()
         
     end_time = time.time()
     total_time = str(end_time - start_time)
@@ -70,155 +136,246 @@ def load(parser, args):
         with open(args.timing_log, "a") as myfile:
             myfile.write(",".join([args.exp_id, total_time, db_creation_time, single_core_time, parallel_time]) + "\n")        
 
-def load_singlecore(args):
+def load_singlecore(args, checkpoints, journal=None):
     # create a new geminicassandra loader and populate
-    # the geminicassandra db and files from the VCF
-    gemini_loader = GeminiLoader(args)
+    # the geminicassandra db and files from the VCF, or go on
+    # from the checkpoint of an earlier load
+    checkpoint = checkpoints.get(0)
+    vcf_lines = None
+    if checkpoint is not None:
+        vcf_lines = vcf_lines_from(args.vcf, checkpoint.next_line)
+    gemini_loader = GeminiLoader(args, vcf_lines)
     gemini_loader.connect_to_db()
     if not args.no_genotypes and not args.no_load_genotypes:
         gemini_loader._init_sample_gt_counts()
+    if checkpoint is not None:
+        gemini_loader.resume_from(checkpoint)
         
-    gemini_loader.populate_from_vcf()
+    if checkpoint is None or not checkpoint.done:
+        n_variants = gemini_loader.populate_from_vcf()
+    else:
+        n_variants = checkpoint.n_variants
+        gemini_loader.new_variants = checkpoint.n_new_variants
 
 
     '''if not args.skip_gene_tables and not args.test_mode:
         gemini_loader.update_gene_table()'''
     
     if not args.no_genotypes and not args.no_load_genotypes:
-        gemini_loader.store_sample_gt_counts()
+        store_gt_counts(gemini_loader, journal)
     if not args.test_mode:
         gemini_loader.disconnect()
+    return (n_variants, gemini_loader.new_variants)
         
     #geminicassandra.add_extras(args.db, [args.db])
 
-def insert_n_variants(db, ks, n):
-    session = Cluster(db).connect(ks)
-    from database_cassandra import insert
-    insert(session, 'row_counts', ['table_name', 'n_rows'], ['variants', n])
-
-def load_multicore(args):
-    grabix_file = bgzip(args.vcf)
-    return load_chunks_multicore(grabix_file, args)
-    # geminicassandra.add_extras(args.db, chunks)
-
-
-def get_chunk_name(chunk):
-    return "--chunkdb " + chunk
-
-def load_chunks_multicore(grabix_file, args):
-    cores = args.cores
-
-    # specify the PED file if given one
-    ped_file = ""
-    if args.ped_file is not None:
-        ped_file = "-p " + args.ped_file
-
-    # specify the annotation type if given one
-    anno_type = ""
-    if args.anno_type is not None:
-        anno_type = "-t " + args.anno_type
-
-    no_genotypes = ""
-    if args.no_genotypes is True:
-        no_genotypes = "--no-genotypes"
-
-    no_load_genotypes = ""
-    if args.no_load_genotypes is True:
-        no_load_genotypes = "--no-load-genotypes"
+def store_gt_counts(gemini_loader, journal):
+    """
+    Add the genotype counts of the load to the sample_genotype_counts
+    counters, unless the load being resumed did so before (see
+    LoadJournal.mark_counts_stored).
+    """
+    if journal is not None:
+        if journal.counts_stored():
+            print "The genotype counts were stored before."
+            return
+        journal.mark_counts_stored()
+    gemini_loader.store_sample_gt_counts()
+
+def store_n_variants(args, n_variants, n_new_variants):
+    """
+    Record the number of variants in row_counts and the variant_ids
+    used in id_ranges. An --append load adds its new variants to the
+    count; their ids were reserved by GeminiLoader.prepare_append.
+    """
+    session = get_session(map(strip, args.contact_points.split(',')), args.keyspace)
+    if args.append:
+        add_to_row_count(session, 'variants', n_new_variants)
+    else:
+        insert(session, 'row_counts', ['table_name', 'n_rows'], ['variants', n_variants])
+        # the variant_ids are at most the line numbers of the VCF
+        mark_ids_used(session, 'variants', n_variants + 1)
+    session.cluster.shutdown()
 
-    skip_gerp_bp = ""
-    if args.skip_gerp_bp is True:
-        skip_gerp_bp = "--skip-gerp-bp"
+def vcf_lines_from(vcf, first_line):
+    """
+    Yield the header of a (gzipped) VCF, then its lines from first_line
+    (1-based, header excluded) on.
+    """
+    opener = gzip.open if is_gz_file(vcf) else open
+    with opener(vcf) as vcf_file:
+        line_num = 0
+        for line in vcf_file:
+            if line.startswith("#"):
+                yield line
+                continue
+            line_num += 1
+            if line_num >= first_line:
+                yield line
+
+def count_vcf_lines(args):
+    """
+    The number of variant lines in the VCF, from the grabix index when
+    loading on several cores.
+    """
+    if args.cores > 1:
+        return get_num_lines(grabix_index(bgzip(args.vcf)))
+    opener = gzip.open if is_gz_file(args.vcf) else open
+    with opener(args.vcf) as vcf_file:
+        return sum(1 for line in vcf_file if not line.startswith("#"))
 
-    skip_gene_tables = ""
-    if args.skip_gene_tables is True:
-        skip_gene_tables = "--skip-gene-tables"
+def load_multicore(args, checkpoints, journal=None):
+    grabix_file = bgzip(args.vcf)
+    return load_chunks_multicore(grabix_file, args, checkpoints, journal)
 
-    skip_cadd = ""
-    if args.skip_cadd is True:
-        skip_cadd = "--skip-cadd"
-    
-    test_mode = ""
-    if args.test_mode is True:
-        test_mode = "--test-mode"
 
-    passonly = ""
-    if args.passonly is True:
-        passonly = "--passonly"
+def load_chunks_multicore(grabix_file, args, checkpoints, journal=None):
+    """
+    Load the chunks of the bgzipped VCF with a pool of forked worker
+    processes. The statements are prepared once, here, and the workers
+    read their chunk straight from the bgzipped file using the grabix
+    index, so a chunk costs no interpreter start-up, no re-import and
+    no re-prepare. Chunks whose last checkpoint is done are skipped,
+    the others go on from their last checkpoint.
+    """
+    global _chunk_args, _chunk_loader, _grabix_file, _vcf_header, _chunk_offsets
 
-    skip_info_string = ""
-    if args.skip_info_string is True:
-        skip_info_string = "--skip-info-string"
-        
-    contact_points = "-db " + args.contact_points 
-    keyspace = "-ks " + args.keyspace
-    buffer_size = "--buffer-size " + str(args.buffer_size)
-    max_queue = "--max_queue " + str(args.max_queue)
-    node_num = "--node_num "
-    
-    submit_command = "{cmd}"
-    vcf, _ = os.path.splitext(grabix_file)
     n_lines, chunk_steps = get_chunk_steps(grabix_file, args)
-    chunk_vcfs = []
-    procs = []
-
-    for chunk_num, chunk in chunk_steps:
-        node_num = node_num + str(chunk_num)
-        start, stop = chunk
-        gemini_load = gemini_pipe_load_cmd().format(**locals())
-        procs.append(subprocess.Popen(submit_command.format(cmd=gemini_load),
-                                      shell=True))
-
-        chunk_vcf = vcf + ".chunk" + str(chunk_num)
-        chunk_vcfs.append(chunk_vcf)
-        node_num = "--node_num "
-
-    wait_until_finished(procs)
-    print "Done loading {0} variants in {1} chunks.".format(stop, chunk_num+1)
-    return n_lines
-
-
-
-def load_chunk(chunk_step, kwargs):
-    chunk_num, chunk = chunk_step
-    start, stop = chunk
-    args = combine_dicts(locals(), kwargs)
-    gemini_load = gemini_pipe_load_cmd().format(**args)
-    subprocess.check_call(gemini_load, shell=True)
-    chunk_db = args["vcf"] + ".chunk" + str(chunk_num) + ".db"
-    return chunk_db
-
-def wait_until_finished(procs):
-    [p.wait() for p in procs]
-
-def gemini_pipe_load_cmd():
-    grabix_cmd = "grabix grab {grabix_file} {start} {stop}"
-    gemini_load_cmd = ("geminicassandra load_chunk -v - {anno_type} {ped_file}"
-                       " {no_genotypes} {no_load_genotypes} {no_genotypes}"
-                       " {skip_gerp_bp} {skip_gene_tables} {skip_cadd}"
-                       " {passonly} {skip_info_string} {test_mode}"
-                       " -o {start} {contact_points} {keyspace} {buffer_size} {max_queue} {node_num}")
-    return " | ".join([grabix_cmd, gemini_load_cmd])
+    _chunk_args = args
+    _grabix_file = grabix_file
+    _vcf_header = read_bgzf_header(grabix_file)
+    _chunk_offsets = get_chunk_offsets(grabix_file + ".gbi")
+
+    # prepare the insert statements once; the workers inherit them. The
+    # connection is closed before forking, like that of the setup (see
+    # load), so no driver thread is running (and possibly holding a
+    # lock) when the workers are created.
+    _chunk_loader = GeminiLoader(args)
+    _chunk_loader.connect_to_db()
+    _chunk_loader.prepare_insert_queries()
+    _chunk_loader.cluster.shutdown()
+
+    chunk_log = None
+    if args.timing_log != None:
+        chunk_log = open(args.timing_log + ".chunks", "a")
+    gt_counts = None
+    n_new_variants = 0
+    to_load = []
+    for (chunk_num, (start, stop)) in chunk_steps:
+        checkpoint = checkpoints.get(chunk_num)
+        if checkpoint is not None and checkpoint.done:
+            n_new_variants += checkpoint.n_new_variants
+            if checkpoint.gt_counts is not None:
+                gt_counts = checkpoint.gt_counts if gt_counts is None else gt_counts + checkpoint.gt_counts
+        else:
+            to_load.append((chunk_num, (start, stop), checkpoint))
+    if len(to_load) < len(chunk_steps):
+        print "Resuming: {0} of {1} chunks were loaded before.".format(len(chunk_steps) - len(to_load), len(chunk_steps))
+
+    pool = Pool(processes=args.cores, initializer=init_chunk_worker)
+    worker_stats = {}
+    try:
+        for (pid, chunk_step, n_variants, n_chunk_new_variants, elapsed, chunk_gt_counts) in \
+                pool.imap_unordered(load_chunk, to_load):
+            chunk_num, (start, stop), checkpoint = chunk_step
+            print "Chunk %d: %d variants loaded in %.2f s by pid %d." % (chunk_num, n_variants, elapsed, pid)
+            (total_variants, total_time) = worker_stats.get(pid, (0, 0.0))
+            worker_stats[pid] = (total_variants + n_variants, total_time + elapsed)
+            n_new_variants += n_chunk_new_variants
+            if chunk_log is not None:
+                chunk_log.write(",".join([args.exp_id, str(args.node_num), str(chunk_num), str(start), str(stop),
+                                          str(n_variants), str(pid), "%.2f" % elapsed]) + "\n")
+                chunk_log.flush()
+            if chunk_gt_counts is not None:
+                gt_counts = chunk_gt_counts if gt_counts is None else gt_counts + chunk_gt_counts
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        if chunk_log is not None:
+            chunk_log.close()
+
+    if journal is not None:
+        journal.reconnect(get_session(args.contact_points, args.keyspace))
+
+    # the genotype counts of all chunks are stored in one go, rather than
+    # once per chunk, as that is an update per sample
+    if gt_counts is not None:
+        _chunk_loader.connect_to_db()
+        _chunk_loader._init_sample_gt_counts()
+        _chunk_loader.sample_gt_counts += gt_counts
+        store_gt_counts(_chunk_loader, journal)
+        _chunk_loader.disconnect()
+
+    for pid in sorted(worker_stats):
+        (total_variants, total_time) = worker_stats[pid]
+        print "Worker %d: %d variants in %.2f s (%.1f variants/s)." % \
+            (pid, total_variants, total_time, total_variants / max(total_time, 1e-9))
+    print "Done loading {0} variants in {1} chunks.".format(n_lines, len(chunk_steps))
+    return (n_lines, n_new_variants)
+
+def init_chunk_worker():
+    """
+    Set up a freshly forked worker. Tabix handles share their file offset
+    with the parent's after a fork, so the annotation files are reopened,
+    and the driver's sockets and threads don't survive a fork either, so
+    each worker has its own connection.
+    """
+    global _worker_cluster, _worker_session
+    annotations.load_annos(_chunk_args)
+    _worker_session = get_session(_chunk_args.contact_points, _chunk_args.keyspace)
+    _worker_cluster = _worker_session.cluster
+
+def load_chunk(chunk_step):
+    """
+    Load the VCF lines start..stop (1-based, inclusive) in a worker,
+    from the line of its checkpoint on if it has one. The genotype
+    counts of the chunk are returned to the parent.
+    """
+    chunk_num, (start, stop), checkpoint = chunk_step
+    start_time = time.time()
+    args = copy.copy(_chunk_args)
+    args.offset = start
+    args.node_num = chunk_num
+    args.chunk = chunk_num
+    first_line = start if checkpoint is None else checkpoint.next_line
+    vcf_lines = chain(_vcf_header, grab_lines(_grabix_file, _chunk_offsets, first_line, stop))
+    gemini_loader = GeminiLoader(args, vcf_lines)
+    gemini_loader.cluster = _worker_cluster
+    gemini_loader.session = _worker_session
+    gemini_loader.adopt_insert_queries(_chunk_loader)
+    if not args.no_genotypes and not args.no_load_genotypes:
+        gemini_loader._init_sample_gt_counts()
+    if checkpoint is not None:
+        gemini_loader.resume_from(checkpoint)
+    n_variants = gemini_loader.populate_from_vcf()
+    gt_counts = None
+    if not args.no_genotypes and not args.no_load_genotypes:
+        gemini_loader._flush_sample_gt_counts()
+        gt_counts = gemini_loader.sample_gt_counts
+    return (os.getpid(), chunk_step, n_variants, gemini_loader.new_variants, time.time() - start_time, gt_counts)
 
 def get_chunk_steps(grabix_file, args):
+    """
+    Split the VCF into chunks of --chunk-size lines. The cores of a node
+    pull the next chunk as soon as they finish one, so a slow region only
+    holds up its own small chunk. With several nodes, node n takes every
+    total_nodes-th chunk, which spreads the dense regions over the nodes.
+    """
     index_file = grabix_index(grabix_file)
     num_lines = get_num_lines(index_file)
     print "Importing %d variants." % num_lines
-    chunk_size = int(num_lines) / int(args.cores * args.total_nodes)
-    print "Breaking {0} into {1} chunks.".format(grabix_file, args.cores)
-    offset = (args.node_num - 1) * args.cores
-    starts = []
-    stops = []
-    for chunk in range(offset, offset + int(args.cores)):
+    chunk_size = max(1, args.chunk_size)
+    n_chunks = (num_lines + chunk_size - 1) / chunk_size
+    steps = []
+    for chunk in range(args.node_num - 1, n_chunks, args.total_nodes):
         start = (chunk * chunk_size) + 1
-        stop  = start + chunk_size - 1
-        # make sure the last chunk covers the remaining lines
-        if chunk >= (args.cores * args.total_nodes - 1) and stop < num_lines:
-            stop = num_lines
-        print "Chunk %d from line %d to %d. Length = %d" % (chunk, start, stop, stop - start)
-        starts.append(start)
-        stops.append(stop)
-    return num_lines, list(enumerate(zip(starts, stops)))
+        stop = min(start + chunk_size - 1, num_lines)
+        steps.append((chunk, (start, stop)))
+    print "Breaking {0} into {1} chunks of {2} lines, {3} of them on this node.".format(grabix_file, n_chunks, chunk_size, len(steps))
+    return num_lines, steps
 
 def get_num_lines(index_file):
     with open(index_file) as index_handle:
@@ -226,6 +383,74 @@ def get_num_lines(index_file):
         num_lines = int(index_handle.next().strip())
     return num_lines
 
+def get_chunk_offsets(index_file):
+    """
+    Read the BGZF virtual offsets from a grabix index. The index holds
+    the end of the header, the number of lines and then the offset of
+    every GRABIX_CHUNK_SIZE-th line, starting with the first line after
+    the header.
+    """
+    with open(index_file) as index_handle:
+        index_handle.next()
+        index_handle.next()
+        return [int(line) for line in index_handle if line.strip()]
+
+def grab_lines(bgzf_file, chunk_offsets, start, stop):
+    """
+    Yield lines start..stop (1-based, header excluded) of a bgzipped file,
+    like `grabix grab`, seeking straight to the nearest indexed line.
+    """
+    chunk = (start - 1) / GRABIX_CHUNK_SIZE
+    line_num = chunk * GRABIX_CHUNK_SIZE + 1
+    for line in bgzf_lines(bgzf_file, chunk_offsets[chunk]):
+        if line_num > stop:
+            break
+        if line_num >= start:
+            yield line
+        line_num += 1
+
+def read_bgzf_header(bgzf_file):
+    """
+    Return the header lines (those starting with #) of a bgzipped VCF.
+    """
+    header = []
+    for line in bgzf_lines(bgzf_file, 0):
+        if not line.startswith("#"):
+            break
+        header.append(line)
+    return header
+
+def bgzf_lines(bgzf_file, virtual_offset):
+    """
+    Yield the lines of a bgzipped file from the given BGZF virtual offset
+    (the file offset of a block shifted left by 16 bits, plus the offset
+    within the uncompressed block).
+    """
+    with open(bgzf_file, 'rb') as handle:
+        handle.seek(virtual_offset >> 16)
+        rest = ""
+        skip = virtual_offset & 0xFFFF
+        for block in _bgzf_blocks(handle):
+            lines = (rest + block[skip:]).split("\n")
+            skip = 0
+            rest = lines.pop()
+            for line in lines:
+                yield line + "\n"
+        if rest:
+            yield rest
+
+def _bgzf_blocks(handle):
+    """
+    Yield the uncompressed contents of the BGZF blocks of an open file.
+    Every block is a gzip member whose size is stored in the BC extra field.
+    """
+    while True:
+        header = handle.read(18)
+        if len(header) < 18:
+            return
+        block_size = struct.unpack("<H", header[16:18])[0] + 1
+        yield zlib.decompress(header + handle.read(block_size - 18), 31)
+
 def grabix_index(fname):
     if not which("grabix"):
         print_cmd_not_found_and_exit("grabix")
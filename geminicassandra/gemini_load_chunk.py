@@ -3,17 +3,16 @@
 # native Python imports
 import os.path
 import sys
+import resource
 import numpy as np
 
-# third-party imports
-import cyvcf as vcf
-
 # geminicassandra modules
 import version
 from ped import load_ped_file
 import gene_table
 import infotag
-from database_cassandra import insert, batch_insert, create_tables
+from database_cassandra import insert, batch_insert, create_tables, get_session, \
+    reserve_ids, add_to_row_count
 import annotations
 import func_impact
 import severe_impact
@@ -21,33 +20,64 @@ import popgen
 import structural_variants as svs
 from geminicassandra.gemini_constants import HET, HOM_ALT, HOM_REF, UNKNOWN
 from compression import pack_blob
+from annotation_cache import AnnotationCache
+from write_control import AdaptiveWriter, get_replay_file
+from bulk_export import BulkExporter
+from genotype_parser import GenotypeReader
+from row_buffers import RowBuffers
+from load_progress import LoadJournal
 from geminicassandra.config import read_gemini_config
-from cassandra.cluster import Cluster
 from blist import blist
-from itertools import repeat
+from itertools import repeat, chain
 from geminicassandra.ped import get_ped_fields
 import time
 from string import strip
 from random import randint
 from geminicassandra.table_schemes import get_column_names
-from cassandra.query import BatchStatement, BatchType
 import Queue
 from cassandra.concurrent import execute_concurrent_with_args
-import cassandra
-from multiprocessing import cpu_count
-from time import sleep
+from cassandra.query import SimpleStatement
+from threading import Thread
 from sys import stderr
 
+# the prepared statements of GeminiLoader.prepare_insert_queries
+INSERT_QUERY_NAMES = ['insert_variants_query',
+                      'insert_variants_samples_gt_types_query',
+                      'insert_samples_variants_gt_types_query',
+                      'insert_variants_samples_gt_depths_query',
+                      'insert_variants_samples_gts_query',
+                      'insert_variant_impacts_query',
+                      'insert_variant_stcr_query',
+                      'insert_variant_gene_query',
+                      'insert_variant_chrom_start_query']
+
+# the statements prepared in addition for load --append
+APPEND_QUERY_NAMES = ['select_chrom_start_query',
+                      'select_alleles_query',
+                      'insert_variant_gts_query']
+
+# most rows per genotype batch (see GeminiLoader._write_variant_gts); all
+# rows of a batch go to the same partition
+GT_BATCH_ROWS = 100
+# rows per page of the scan for the highest variant_id
+VARIANT_SCAN_PAGE = 5000
+
 class GeminiLoader(object):
     """
     Object for creating and populating a geminicassandra
     database and auxillary data files.
     """
-    def __init__(self, args):
+    def __init__(self, args, vcf_lines=None):
         self.args = args
         
-        # create a reader for the VCF file
-        self.vcf_reader = self._get_vcf_reader()
+        # create a reader for the VCF file, or for the given lines
+        # (header included) of a VCF
+        if vcf_lines is not None:
+            self.vcf_reader = GenotypeReader(vcf_lines, 'rb')
+        else:
+            self.vcf_reader = self._get_vcf_reader()
+        # the genotypes are only parsed when they are loaded
+        self.vcf_reader.parse_genotypes = not args.no_genotypes and not args.no_load_genotypes
         
         self.buffer_size = args.buffer_size
         self.queue_length = args.max_queue
@@ -56,14 +86,28 @@ class GeminiLoader(object):
         self.keyspace = args.keyspace
         self.replication_factor = args.replication
         
+        # without genotypes (--no-genotypes), no samples and gt columns
+        self.samples = []
         self.typed_gt_column_names = []
         self.gt_column_names = []
         
         self.node_n = args.node_num
+        self.queries_prepared = False
+        self.anno_cache = None
+        # load into a keyspace that already holds variants (see prepare_append)
+        self.append = getattr(args, 'append', False)
+        # the chunk of the VCF and its first line, for the checkpoints
+        # of load --resume (see load_progress)
+        self.chunk = getattr(args, 'chunk', 0)
+        self.first_line = getattr(args, 'offset', 1)
+        self.checkpoint = None
+        self.new_sample_idx = []
+        self.new_gt_idx = []
         
         if not self.args.no_genotypes:
             self.samples = self.vcf_reader.samples
             self.gt_column_names, self.typed_gt_column_names = self._get_typed_gt_column_names()
+            self._init_sample_ids()
             print "# samples = %s" % len(self.samples)
             
         NUM_BUILT_IN = 6
@@ -84,7 +128,8 @@ class GeminiLoader(object):
             self._prepare_samples()
                 # initialize genotype counts for each sample 
             
-        if not self.args.skip_gene_tables:
+        # an --append load adds to the gene tables of the first load
+        if not self.args.skip_gene_tables and not self.append:
             self._get_gene_detailed()
             self._get_gene_summary()
 
@@ -103,7 +148,9 @@ class GeminiLoader(object):
         """
         insert(self.session, 'version', get_column_names('version'), [version.__version__])
     
-    def _get_typed_gt_column_names(self):
+    def _get_typed_gt_column_names(self, samples=None):
+        if samples is None:
+            samples = self.samples
             
         gt_cols = [('gts', 'text'),
                    ('gt_types', 'int'),
@@ -114,26 +161,104 @@ class GeminiLoader(object):
                    ('gt_quals', 'float'),
                    ('gt_copy_numbers', 'float')]
         
-        column_names = concat(map(lambda x: map(lambda y: x[0] + '_' + y, self.samples), gt_cols))
-        typed_column_names = concat(map(lambda x: map(lambda y: x[0] + '_' + y + ' ' + x[1], self.samples), gt_cols))
+        if self.args.packed_genotypes:
+            # one blob per genotype field, holding the values of all samples
+            column_names = map(lambda x: x[0], gt_cols)
+            typed_column_names = map(lambda x: x[0] + ' blob', gt_cols)
+        else:
+            column_names = concat(map(lambda x: map(lambda y: x[0] + '_' + y, samples), gt_cols))
+            typed_column_names = concat(map(lambda x: map(lambda y: x[0] + '_' + y + ' ' + x[1], samples), gt_cols))
         
         return (column_names, typed_column_names)
+
+    def _init_sample_ids(self):
+        """
+        The sample_id of each sample of the VCF and, with --append, which
+        samples are not in the keyspace yet and where their values are in
+        the gt columns of a variant row (see prepare_append).
+        """
+        self.loaded_samples = getattr(self.args, 'loaded_samples', set())
+        self.sample_ids = getattr(self.args, 'sample_ids', None) or range(1, len(self.samples) + 1)
+        self.new_sample_idx = [i for (i, sample) in enumerate(self.samples) if sample not in self.loaded_samples]
+        self.new_gt_idx = []
+        if not self.args.packed_genotypes:
+            # the columns are grouped by gt field, then ordered like the samples
+            n_fields = len(self.gt_column_names) / max(1, len(self.samples))
+            self.new_gt_idx = [field * len(self.samples) + i for field in range(n_fields) for i in self.new_sample_idx]
+
+    def prepare_append(self, n_lines):
+        """
+        Prepare loading the VCF into a keyspace that already holds
+        variants (load --append): reserve a variant_id for each of its
+        n_lines lines, number the samples that are not loaded yet after
+        those that are and add their gt columns to the variants table.
+        The loaders take the ids and samples from the args.
+        """
+        loaded = dict((name, sample_id) for (name, sample_id) in
+                      self.session.execute("SELECT name, sample_id FROM samples"))
+        if not self.args.no_genotypes:
+            if self.args.packed_genotypes and len(loaded) > 0 and \
+               sorted(loaded, key=loaded.get) != self.samples:
+                sys.exit("ERROR: with --packed-genotypes, --append needs the VCF to have the samples "
+                         "already loaded, in the same order.\n")
+            new_samples = [sample for sample in self.samples if sample not in loaded]
+            first_id = max(loaded.values() or [0]) + 1
+            sample_to_id = dict(loaded)
+            sample_to_id.update((sample, first_id + i) for (i, sample) in enumerate(new_samples))
+            self.args.loaded_samples = set(loaded)
+            self.args.sample_ids = [sample_to_id[sample] for sample in self.samples]
+            self._init_sample_ids()
+            if not self.args.packed_genotypes and len(new_samples) > 0:
+                columns = self.cluster.metadata.keyspaces[self.keyspace].tables['variants'].columns
+                for typed_column in self._get_typed_gt_column_names(new_samples)[1]:
+                    if typed_column.split(' ')[0].lower() not in columns:
+                        self.session.execute("ALTER TABLE variants ADD %s" % typed_column)
+            print "Appending %d new of %d samples." % (len(new_samples), len(self.samples))
+        self.args.variant_id_base = reserve_ids(self.session, 'variants', n_lines, self._get_first_free_variant_id)
+        print "Reserved variant_ids %d to %d." % (self.args.variant_id_base, self.args.variant_id_base + n_lines - 1)
+
+    def _get_first_free_variant_id(self):
+        """
+        One more than the highest variant_id, for keyspaces loaded before
+        the variant ids were recorded in id_ranges. The ids are streamed
+        page by page, as the variants table can hold millions of rows.
+        """
+        n_rows = [row[0] for row in
+                  self.session.execute("SELECT n_rows FROM row_counts WHERE table_name = 'variants'")]
+        sys.stderr.write("Scanning the %s variants for the highest variant_id. This reads the whole variants "
+                         "table, which takes minutes for a whole genome.\n" %
+                         (n_rows[0] if len(n_rows) > 0 and n_rows[0] is not None else "loaded"))
+        startt = time.time()
+        query = SimpleStatement("SELECT variant_id FROM variants", fetch_size=VARIANT_SCAN_PAGE)
+        first_free = max(chain([0], (row[0] for row in self.session.execute(query)))) + 1
+        sys.stderr.write("Scanned the variants in %.2f s.\n" % (time.time() - startt))
+        return first_free
     
+    def resume_from(self, checkpoint):
+        """
+        Go on from the last checkpoint of the chunk: the loader must read
+        the VCF from checkpoint.next_line on. Call after
+        _init_sample_gt_counts.
+        """
+        self.checkpoint = checkpoint
+        self.first_line = checkpoint.next_line
+        if checkpoint.gt_counts is not None:
+            self.sample_gt_counts += checkpoint.gt_counts
+
     def _get_vid(self):
+        if self.checkpoint is not None:
+            return self.checkpoint.next_variant_id
         if hasattr(self.args, 'offset'):
             v_id = int(self.args.offset)
         else:
             v_id = 1
-        return v_id
+        # with --append, the ids of the lines start at the reserved range
+        return v_id + getattr(self.args, 'variant_id_base', 1) - 1
     
     def prepare_insert_queries(self):
         
         basic_query = 'INSERT INTO %s ( %s ) VALUES ( %s  )'
         
-        if cpu_count() > 8:            
-            nap = 10 * (self.node_n % 11)
-            sleep(nap)
-        
         start_time = time.time()
         
         self.insert_variants_query = self.session.prepare(basic_query % \
@@ -154,201 +279,363 @@ class GeminiLoader(object):
                              ('variants_by_gene', 'variant_id, gene', ','.join(list(repeat("?", 2)))))
         self.insert_variant_chrom_start_query = self.session.prepare(basic_query % \
                              ('variants_by_chrom_start', 'variant_id, chrom, start', ','.join(list(repeat("?", 3)))))
+        if self.append:
+            self.select_chrom_start_query = self.session.prepare(
+                'SELECT variant_id FROM variants_by_chrom_start WHERE chrom = ? AND start = ?')
+            self.select_alleles_query = self.session.prepare(
+                'SELECT variant_id, chrom, start, ref, alt FROM variants WHERE variant_id = ?')
+            # the gt columns of the new samples, for the variants loaded before
+            new_gt_columns = ['variant_id'] + [self.gt_column_names[i] for i in self.new_gt_idx]
+            self.insert_variant_gts_query = self.session.prepare(basic_query % \
+                             ('variants', ','.join(new_gt_columns), ','.join(list(repeat("?", len(new_gt_columns))))))
         
         end_time = time.time()
-        
-        if cpu_count() > 8:            
-            nap = 10 * (11 - (self.node_n % 11))
-            sleep(nap)                       
+        self.queries_prepared = True
         
         print "Proc %s: preparing statements took %.2f s." % (os.getpid(), (end_time - start_time))
+        
+    def adopt_insert_queries(self, loader):
+        """
+        Use the insert statements prepared by another loader (typically
+        in the parent process, before forking) instead of preparing them
+        again. They are registered with this loader's cluster so the driver
+        can still re-prepare them on a node that has evicted them.
+        """
+        for name in INSERT_QUERY_NAMES + (APPEND_QUERY_NAMES if self.append else []):
+            query = getattr(loader, name)
+            self.cluster.add_prepared(query.query_id, query)
+            setattr(self, name, query)
+        self.queries_prepared = True
                                                  
     def populate_from_vcf(self):
         """
+        Parse and annotate the variants of the VCF and hand them to
+        the writer stage (see _start_writer), which inserts them into
+        Cassandra while the next variants are being parsed. With
+        --sstable-out, the writer stage exports the rows to sorted run
+        files for bulk import instead (see bulk_export).
         """
         self.v_id = self._get_vid()
-        self.var_buffer = blist([])
-        self.var_impacts_buffer = blist([])
-        self.var_subtypes_buffer = blist([])
-        self.var_gene_buffer = blist([])
-        self.var_chrom_start_buffer = blist([])
-        self.prepare_insert_queries()
-        self.leftover_types = blist([])
-        self.leftover_depths = blist([])
-        self.leftover_gts = blist([])
+        # the buffers the writer has written, to be reused (see _flush_buffers)
+        self.free_buffers = Queue.Queue()
+        self.buffers = self._get_free_buffers()
+        if not self.queries_prepared:
+            self.prepare_insert_queries()
         buffer_count = 0
+        buffers_flushed = 0
         self.skipped = 0
         self.counter = 0
+        self.new_variants = 0
+        self.lines_read = 0
+        if self.checkpoint is not None:
+            self.counter = self.checkpoint.n_variants
+            self.new_variants = self.checkpoint.n_new_variants
+        self.journal = None
+        if getattr(self.args, 'load_id', None) is not None:
+            self.journal = LoadJournal(self.session, self.args.load_id)
         start_time = time.time()
-        interval_start = time.time()
-        variants_gts_timer = 0
-        log_file = open("loading_logs/%s.csv" % str(os.getpid()), "w")
-        self.time_out_log = open("loading_logs/%s.err" % str(os.getpid()), "w")
-        vars_inserted = 0
-        for var in self.vcf_reader:
-            if self.args.passonly and (var.FILTER is not None and var.FILTER != "."):
-                self.skipped += 1
-                continue
-            (variant, variant_impacts, sample_info, extra_fields) = self._prepare_variation(var)  # @UnusedVariable
-            # add the core variant info to the variant buffer
-            self.var_buffer.append(variant)
-            self.var_subtypes_buffer.append([self.v_id, variant[11], variant[12]])
-            if variant[55] != None:
-                self.var_gene_buffer.append([self.v_id, variant[55]])
-            self.var_chrom_start_buffer.append([self.v_id, variant[1], variant[2]])
-        
-            var_sample_gt_types_buffer = blist([])
-            var_sample_gt_depths_buffer = blist([])
-            var_sample_gt_buffer = blist([])
-                
-            for sample in sample_info:
-                if sample[1] != None:
-                    var_sample_gt_depths_buffer.append([self.v_id, sample[0], sample[2]])
-                    var_sample_gt_types_buffer.append([self.v_id, sample[0], sample[1]])
-                    var_sample_gt_buffer.append([self.v_id, sample[0], sample[3]])        
-                             
-            stime = time.time()                       
-            self.prepared_batch_insert(var_sample_gt_types_buffer, var_sample_gt_depths_buffer, var_sample_gt_buffer, 25)
-            variants_gts_timer += (time.time() - stime)
-            
-                # add each of the impact for this variant (1 per gene/transcript)
-            for var_impact in variant_impacts:
-                self.var_impacts_buffer.append(var_impact)
+        # a worker process can load several chunks
+        self.log_file = open("loading_logs/%s.csv" % str(os.getpid()), "a")
+        self.time_out_log = open("loading_logs/%s.err" % str(os.getpid()), "a")
+        if getattr(self.args, 'sstable_out', None) is not None:
+            self.write_control = BulkExporter(self.args.sstable_out, self.cluster)
+        else:
+            self.write_control = AdaptiveWriter(self.session, get_replay_file(self.keyspace), self.time_out_log)
+        if self.args.anno_cache is not None:
+            self.anno_cache = AnnotationCache(self.args.anno_cache, self.args)
+        annotations.set_lookup_mode(self.args.anno_lookup)
+        self._start_writer()
+        for (var_block, gt_block) in self._read_var_blocks():
+            block_annos = self._annotate_block(var_block)
+            block_hwe = self._get_block_hwe(var_block)
+            block_loaded_ids = self._find_loaded_variants(var_block) if self.append else repeat(None)
+            for (var, genotypes, annos, hwe, loaded_id) in zip(var_block, gt_block, block_annos, block_hwe,
+                                                                block_loaded_ids):
+                (variant, variant_impacts, extra_fields) = self._prepare_variation(var, genotypes, annos, hwe)  # @UnusedVariable
+                if loaded_id is not None:
+                    self._add_to_loaded_variant(loaded_id, variant, genotypes)
+                else:
+                    self._add_variant(variant, variant_impacts, genotypes)
 
-            buffer_count += 1
-                # buffer full - start to insert into DB
+                buffer_count += 1
+                self.v_id += 1
+                self.counter += 1
+
+            # buffer full - hand it to the writer. The blocks are as
+            # big as the buffers, so they end together.
             if buffer_count >= self.buffer_size:
-                startt = time.time()
-                self.execute_concurrent_with_retry(self.insert_variants_query, self.var_buffer)
-                self.execute_concurrent_with_retry(self.insert_variant_impacts_query, self.var_impacts_buffer)
-                self.execute_concurrent_with_retry(self.insert_variant_stcr_query, self.var_subtypes_buffer)
-                self.execute_concurrent_with_retry(self.insert_variant_gene_query, self.var_gene_buffer)
-                self.execute_concurrent_with_retry(self.insert_variant_chrom_start_query, self.var_chrom_start_buffer)
-                endt = time.time()
-                    # binary.genotypes.append(var_buffer)
-                    # reset for the next batch
-                self.var_buffer = blist([])
-                self.var_subtypes_buffer = blist([])
-                self.var_impacts_buffer = blist([])
-                self.var_gene_buffer = blist([])
-                self.var_chrom_start_buffer = blist([])
-                vars_inserted += self.buffer_size   
-                log_file.write("%s;%.2f;%.2f;%.2f\n" % (self.buffer_size, endt - interval_start, endt - startt, variants_gts_timer)) 
-                log_file.flush()       
+                self._flush_buffers(False)
                 buffer_count = 0
-                interval_start = time.time()
-                variants_gts_timer = 0
-            self.v_id += 1
-            self.counter += 1
+                buffers_flushed += 1
+                if buffers_flushed == getattr(self.args, 'stop_after_buffers', None):
+                    self._stop_after_buffers()
             
         # final load to the database
+        self._flush_buffers(True)
         self.v_id -= 1
-        
-        startt = time.time()
-        self.execute_concurrent_with_retry(self.insert_variants_query, self.var_buffer)
-        self.execute_concurrent_with_retry(self.insert_variant_impacts_query, self.var_impacts_buffer)
-        self.execute_concurrent_with_retry(self.insert_variant_stcr_query, self.var_subtypes_buffer)
-        self.execute_concurrent_with_retry(self.insert_variant_gene_query, self.var_gene_buffer)
-        self.execute_concurrent_with_retry(self.insert_variant_chrom_start_query, self.var_chrom_start_buffer)
-        
-        #self.prepared_batch_insert(self.leftover_types, self.leftover_depths, self.leftover_gts)
+        self._stop_writer()
+        self.write_control.close()
         
         end_time = time.time()
-        vars_inserted += self.buffer_size   
-        log_file.write("%d;%.2f;%.2f;%.2f\n" % (len(self.var_buffer), end_time - interval_start, end_time - startt, variants_gts_timer))        
-        
         self.time_out_log.close()   
         elapsed_time = end_time - start_time            
         sys.stderr.write("pid " + str(os.getpid()) + ": " +
                          str(self.counter) + " variants processed in %s s.\n" % elapsed_time)
-        log_file.write(str(self.counter) + " variants processed in %s s.\n" % elapsed_time)
-        log_file.write("%d leftovers\n" % len(self.leftover_types))
-        log_file.close()     
+        self.log_file.write(str(self.counter) + " variants processed in %s s.\n" % elapsed_time)
+        if self.append:
+            report = "pid %d: %d new variants, %d loaded before.\n" % \
+                     (os.getpid(), self.new_variants, self.counter - self.new_variants)
+            sys.stderr.write(report)
+            self.log_file.write(report)
+        self._report_stage_throughput(elapsed_time)
+        (lookups, seeks) = annotations.get_lookup_counts()
+        report = "pid %d: %d annotation lookups (%s), %d Tabix seeks (%.2f per variant).\n" % \
+                 (os.getpid(), lookups, self.args.anno_lookup, seeks, seeks / float(max(1, self.counter)))
+        sys.stderr.write(report)
+        self.log_file.write(report)
+        if self.vcf_reader.parse_genotypes:
+            report = "pid %d: genotypes of %d variants parsed on the fast path, %d by cyvcf.\n" % \
+                     (os.getpid(), self.vcf_reader.fast_records, self.vcf_reader.slow_records)
+            sys.stderr.write(report)
+            self.log_file.write(report)
+        if self.anno_cache is not None:
+            self.anno_cache.close()
+            report = "pid %d: annotation cache: %d hits, %d misses.\n" % \
+                     (os.getpid(), self.anno_cache.hits, self.anno_cache.misses)
+            sys.stderr.write(report)
+            self.log_file.write(report)
+        report = "pid %d: writes: %s.\n" % (os.getpid(), self.write_control.report())
+        sys.stderr.write(report)
+        self.log_file.write(report)
+        report = "pid %d: peak memory %.1f MB.\n" % (os.getpid(), get_peak_memory())
+        sys.stderr.write(report)
+        self.log_file.write(report)
+        self.log_file.close()     
         if self.args.passonly:
             sys.stderr.write("pid " + str(os.getpid()) + ": " +
                              str(self.skipped) + " skipped due to having the "
                              "FILTER field set.\n")
             
         return self.counter
-            
-    def prepared_batch_insert(self, types_buf, depth_buf, gt_buffer, queue_length=40):
+    
+    def _flush_buffers(self, done):
         """
-        Populate the given table with the given values
+        Hand the buffers to the writer, followed by a checkpoint of the
+        chunk up to the last line read (see load_progress), and start
+        new ones.
         """
-        retry_threshold = 8
-        futures = Queue.Queue(maxsize=queue_length+1)
-        retries = {}
-        i = 0
-        while i < len(types_buf):
-            if i >= queue_length:
-                (old_i, old_future) = futures.get_nowait()
+        self._queue_write(self._write_variant_buffers, self.buffers)
+        gt_counts = None
+        if not self.args.no_genotypes and not self.args.no_load_genotypes:
+            self._flush_sample_gt_counts()
+            gt_counts = self.sample_gt_counts.copy()
+        if self.journal is not None:
+            self._queue_write(self.journal.checkpoint, self.chunk, self.first_line + self.lines_read, self.v_id,
+                              self.counter, self.new_variants, gt_counts, done)
+        if self.anno_cache is not None:
+            self.anno_cache.flush()
+        # reset for the next batch
+        self.buffers = self._get_free_buffers()
+
+    def _stop_after_buffers(self):
+        """
+        Interrupt the load once its first --stop-after-buffers buffers
+        and their checkpoints are written, for testing load --resume.
+        """
+        self._stop_writer()
+        sys.exit("Stopping the load after %d buffers (--stop-after-buffers).\n" % self.args.stop_after_buffers)
+
+    def _get_free_buffers(self):
+        """
+        Buffers the writer is done with, or new ones while it still has
+        all of them (at most --max_queue + 2 buffers are alive at once).
+        """
+        try:
+            return self.free_buffers.get_nowait()
+        except Queue.Empty:
+            return RowBuffers(self.samples, self.gt_column_names, self.args.packed_genotypes, self.buffer_size)
+
+    def _add_variant(self, variant, variant_impacts, genotypes):
+        """
+        Add the rows of a new variant to the buffers; genotypes is the
+        genotype_parser.Genotypes of its samples, None when genotypes
+        are not loaded.
+        """
+        # add the core variant info to the variant buffer
+        buffers = self.buffers
+        buffers.add_variant(variant, genotypes)
+        buffers.subtypes.append((self.v_id, variant[11], variant[12]))
+        if variant[55] != None:
+            buffers.genes.append((self.v_id, variant[55]))
+        buffers.chrom_starts.append((self.v_id, variant[1], variant[2]))
+
+        # add each of the impact for this variant (1 per gene/transcript)
+        buffers.impacts.extend(variant_impacts)
+
+        if genotypes is not None:
+            buffers.add_genotypes(self.v_id, genotypes)
+            # tally the genotypes
+            self._update_sample_gt_counts(genotypes.types_array())
+        self.new_variants += 1
+
+    def _add_to_loaded_variant(self, variant_id, variant, genotypes):
+        """
+        Add the genotypes of the new samples of a variant that was loaded
+        before (load --append) to the buffers; the rows it already has
+        are left alone.
+        """
+        if len(self.new_sample_idx) == 0 or genotypes is None:
+            return
+        if len(self.new_gt_idx) > 0:
+            gt_columns = concat(genotypes.column_values())
+            self.buffers.variant_gts.append(tuple([variant_id] + [gt_columns[i] for i in self.new_gt_idx]))
+        self.buffers.add_genotypes(variant_id, genotypes, self.new_sample_idx)
+        self._update_sample_gt_counts(genotypes.types_array(), loaded=True)
+
+    def _find_loaded_variants(self, var_block):
+        """
+        The variant_id of each variant of the block that is already in
+        the keyspace (with the same chrom, start, ref and alt), None for
+        the new ones. The ids at each position come from
+        variants_by_chrom_start, their alleles from variants.
+        """
+        # as _prepare_variation stores them
+        keys = [(var.CHROM if var.CHROM.startswith("chr") else "chr" + var.CHROM,
+                 var.start, var.REF, ','.join(var.ALT)) for var in var_block]
+        positions = list(set((chrom, start) for (chrom, start, ref, alt) in keys))
+        candidates = set()
+        for (success, rows) in execute_concurrent_with_args(self.session, self.select_chrom_start_query, positions):
+            candidates.update(row[0] for row in rows)
+        loaded = {}
+        for (success, rows) in execute_concurrent_with_args(self.session, self.select_alleles_query,
+                                                            [[variant_id] for variant_id in candidates]):
+            for (variant_id, chrom, start, ref, alt) in rows:
+                loaded[(chrom, start, ref, alt)] = variant_id
+        return [loaded.get(key) for key in keys]
+        
+    def _start_writer(self):
+        """
+        Start the writer stage: a thread that drains the write queue
+        into Cassandra while populate_from_vcf parses and annotates
+        the next variants. The queue holds at most --max_queue buffers
+        (of --buffer-size variants and their genotypes), so a slow
+        cluster makes the parser wait instead of piling up variants
+        in memory.
+        """
+        self.write_queue = Queue.Queue(maxsize=self.queue_length)
+        self.producer_wait = 0.0
+        self.writer_busy = 0.0
+        self.writer_idle = 0.0
+        self.writer_gts_timer = 0.0
+        self.writer_interval_start = time.time()
+        self.writer_error = None
+        self.writer = Thread(target=self._drain_write_queue, name="writer-%d" % os.getpid())
+        self.writer.daemon = True
+        self.writer.start()
+        
+    def _queue_write(self, write_fn, *contents):
+        """
+        Hand a write to the writer stage, blocking while the queue is full.
+        """
+        if self.writer_error is not None:
+            self._stop_writer()
+        startt = time.time()
+        self.write_queue.put((write_fn, contents))
+        self.producer_wait += time.time() - startt
+        
+    def _drain_write_queue(self):
+        while True:
+            startt = time.time()
+            item = self.write_queue.get()
+            stime = time.time()
+            self.writer_idle += stime - startt
+            if item is None:
+                break
+            # after a failure, keep draining so the parser never blocks on a full queue
+            if self.writer_error is None:
+                (write_fn, contents) = item
                 try:
-                    old_future.result()
-                    del retries[old_i]
-                except cassandra.WriteTimeout, cassandra.OperationTimedOut:
-                    if retries[old_i] < retry_threshold:
-                        if retries[old_i] == 0:
-                            self.write_to_timeoutlog("1::%s;%s;%s;%s;%s\n" % \
-                                                (types_buf[old_i][0], types_buf[old_i][1], types_buf[old_i][2], depth_buf[old_i][2], gt_buffer[old_i][2]))                        
-                        future = self.execute_var_gts_batch(types_buf[old_i], depth_buf[old_i], gt_buffer[old_i])      
-                        futures.put_nowait((old_i, future))
-                        retries[old_i] += 1
-                        continue
-                    else:
-                        self.leftover_types.append(types_buf[old_i])
-                        self.leftover_depths.append(depth_buf[old_i])
-                        self.leftover_gts.append(gt_buffer[old_i])
-                        self.write_to_timeoutlog("2::%s;%s;%s;%s;%s\n" % \
-                                                (types_buf[old_i][0], types_buf[old_i][1], types_buf[old_i][2], depth_buf[old_i][2], gt_buffer[old_i][2]))
-                        
-                except cassandra.InvalidRequest:
-                    if retries[old_i] < retry_threshold:
-                        if retries[old_i] == 0:
-                            self.write_to_timeoutlog("3::%s;%s;%s;%s;%s\n" % \
-                                                (types_buf[old_i][0], types_buf[old_i][1], types_buf[old_i][2], depth_buf[old_i][2], len(gt_buffer[old_i][2])))
-                        future = self.execute_var_gts_batch(types_buf[old_i], depth_buf[old_i], gt_buffer[old_i])      
-                        futures.put_nowait((old_i, future))
-                        retries[old_i] += 1
-                        continue
-                    else:
-                        self.leftover_types.append(types_buf[old_i])
-                        self.leftover_depths.append(depth_buf[old_i])
-                        self.leftover_gts.append(gt_buffer[old_i])
-                        self.write_to_timeoutlog("4::%s;%s;%s;%s;%s\n" % \
-                                                (types_buf[old_i][0], types_buf[old_i][1], types_buf[old_i][2], depth_buf[old_i][2], len(gt_buffer[old_i][2])))          
-                       
-            future = self.execute_var_gts_batch(types_buf[i], depth_buf[i], gt_buffer[i])
-            futures.put_nowait((i, future))
-            retries[i] = 0
-            i += 1   
+                    write_fn(*contents)
+                except Exception:
+                    self.writer_error = sys.exc_info()
+            self.writer_busy += time.time() - stime
             
-    def execute_var_gts_batch(self, type_info, depth, gt):
-        batch = BatchStatement(batch_type=BatchType.UNLOGGED)
-        batch.add(self.insert_samples_variants_gt_types_query, type_info)
-        batch.add(self.insert_variants_samples_gt_types_query, type_info)
-        batch.add(self.insert_variants_samples_gt_depths_query, depth)
-        batch.add(self.insert_variants_samples_gts_query, gt)
-        return self.session.execute_async(batch)
-            
-    def execute_concurrent_with_retry(self, insert_query, contents, retry=0):
-        try:
-            execute_concurrent_with_args(self.session, insert_query, contents)
-        except cassandra.WriteTimeout, cassandra.OperationTimedOut:
-            self.write_to_timeoutlog("5::%d\n" % contents[0][0])   
-            self.execute_concurrent_with_retry(insert_query, contents, retry)
-        except cassandra.InvalidRequest as e:
-            if retry < 8:
-                self.write_to_timeoutlog("6::%d\n" % contents[0][0])   
-                self.execute_concurrent_with_retry(insert_query, contents, retry+1)
-            else:
-                self.write_to_timeoutlog("63::Give up - too many invalid dink\n")
-                self.write_to_timeoutlog("63::%s" % str(e))
+    def _stop_writer(self):
+        """
+        Wait for the writer to finish all queued writes and re-raise
+        the error that stopped it, if any.
+        """
+        self.write_queue.put(None)
+        self.writer.join()
+        if self.writer_error is not None:
+            (exc_type, exc_value, exc_tb) = self.writer_error
+            raise exc_type, exc_value, exc_tb
+        
+    def _write_variant_gts(self, buffers):
+        """
+        Write the genotype rows of a buffer of variants to the genotype
+        index tables. The rows are grouped by table and partition key
+        (the sample for the variants_by_samples_* tables, the variant for
+        samples_by_variants_gt_type), so that each UNLOGGED batch goes to
+        a single partition and needs no fan-out by its coordinator.
+        """
+        stime = time.time()
+        writes = [(self.insert_samples_variants_gt_types_query, 'gt_types', 0),
+                  (self.insert_variants_samples_gt_types_query, 'gt_types', 1),
+                  (self.insert_variants_samples_gt_depths_query, 'gt_depths', 1),
+                  (self.insert_variants_samples_gts_query, 'gts', 1)]
+        for (query, column, key_column) in writes:
+            batches = chain(buffers.index_batches(column, key_column, GT_BATCH_ROWS),
+                            _partition_batches(buffers.slow_rows(column), key_column))
+            for rows in batches:
+                self.write_control.execute(query, rows)
+        self.write_control.wait()
+        self.writer_gts_timer += (time.time() - stime)
+        
+    def _write_variant_buffers(self, buffers):
+        """
+        Write a buffer of variants (a RowBuffers), then clear it for
+        _get_free_buffers. Each line of the log has the variants written,
+        the time since the last write and that of the variant and the
+        genotype rows, and the peak memory of the process in MB.
+        """
+        self._write_variant_gts(buffers)
+        startt = time.time()
+        writes = [(self.insert_variants_query, buffers.variant_rows()),
+                  (self.insert_variant_impacts_query, buffers.impacts),
+                  (self.insert_variant_stcr_query, buffers.subtypes),
+                  (self.insert_variant_gene_query, buffers.genes),
+                  (self.insert_variant_chrom_start_query, buffers.chrom_starts)]
+        if len(buffers.variant_gts) > 0:
+            # the gt columns of the new samples of variants loaded before (--append)
+            writes.append((self.insert_variant_gts_query, buffers.variant_gts))
+        for (query, contents) in writes:
+            for row in contents:
+                self.write_control.execute(query, [row])
+        self.write_control.wait()
+        endt = time.time()
+        self.log_file.write("%d;%.2f;%.2f;%.2f;%.1f\n" % (len(buffers), endt - self.writer_interval_start, endt - startt,
+                                                          self.writer_gts_timer, get_peak_memory()))
+        self.log_file.flush()
+        self.writer_interval_start = time.time()
+        self.writer_gts_timer = 0.0
+        buffers.clear()
+        self.free_buffers.put(buffers)
+        
+    def _report_stage_throughput(self, elapsed_time):
+        """
+        Report how busy each stage of the pipeline was. A parser that spends
+        much of its time waiting on a full queue points at Cassandra as the
+        bottleneck; an idle writer points at parsing and annotation.
+        """
+        parse_time = elapsed_time - self.producer_wait
+        report = "pid %d: parse+annotate %.2f s (%.1f variants/s), waited %.2f s on a full write queue; " \
+                 "writer busy %.2f s (%.1f variants/s), idle %.2f s.\n" % \
+                 (os.getpid(), parse_time, self.counter / max(parse_time, 1e-9), self.producer_wait,
+                  self.writer_busy, self.counter / max(self.writer_busy, 1e-9), self.writer_idle)
+        sys.stderr.write(report)
+        self.log_file.write(report)
             
-    def write_to_timeoutlog(self, message):
-        self.time_out_log.write(message)
-        self.time_out_log.flush()
-                   
-
     def _update_extra_headers(self, headers, cur_fields):
         """Update header information for extra fields.
         """
@@ -382,12 +669,12 @@ class GeminiLoader(object):
         # the VCF is a proper file
         if self.args.vcf != "-":
             if self.args.vcf.endswith(".gz"):
-                return vcf.VCFReader(open(self.args.vcf), 'rb', compressed=True)
+                return GenotypeReader(open(self.args.vcf), 'rb', compressed=True)
             else:
-                return vcf.VCFReader(open(self.args.vcf), 'rb')
+                return GenotypeReader(open(self.args.vcf), 'rb')
         # the VCF is being passed in via STDIN
         else:
-            return vcf.VCFReader(sys.stdin, 'rb')
+            return GenotypeReader(sys.stdin, 'rb')
 
     def _get_anno_version(self):
         """
@@ -447,8 +734,10 @@ class GeminiLoader(object):
         """
         Create keyspace named 'gemini_keyspace' and all tables. (IF NOT EXISTS)
         """
-        self.cluster = Cluster(self.contact_points)
-        self.session = self.cluster.connect()
+        self.session = get_session(self.contact_points)
+        self.cluster = self.session.cluster
+        if not self.args.no_genotypes and not self.args.no_load_genotypes:
+            check_gt_counts_table(self.cluster, self.keyspace)
         query = "CREATE KEYSPACE IF NOT EXISTS %s WITH replication = {'class': 'SimpleStrategy', 'replication_factor' : %d}" % (self.keyspace, self.replication_factor)
         self.session.execute(query)
         self.session.set_keyspace(self.keyspace)
@@ -457,13 +746,17 @@ class GeminiLoader(object):
         
     def connect_to_db(self):
         
-        self.cluster = Cluster(self.contact_points)
-        self.session = self.cluster.connect(self.keyspace)        
+        self.session = get_session(self.contact_points, self.keyspace)
+        self.cluster = self.session.cluster
 
-    def _prepare_variation(self, var):
+    def _prepare_variation(self, var, genotypes, annos, hwe):
         """private method to collect metrics for a single variant (var) in a VCF file.
 
         Extracts variant information, variant impacts and extra fields for annotation.
+        The variant row leaves out the genotype columns, which the RowBuffers add.
+        genotypes are the variant's genotypes (see genotype_parser), annos its
+        annotations (see _annotate_block), hwe its HWE p-value and inbreeding
+        coefficient (see _get_block_hwe).
         """
         extra_fields = {}
         # these metrics require that genotypes are present in the file
@@ -474,90 +767,30 @@ class GeminiLoader(object):
         hom_ref = het = hom_alt = unknown = None
 
         # only compute certain metrics if genotypes are available
-        if not self.args.no_genotypes and not self.args.no_load_genotypes:
+        if genotypes is not None:
             hom_ref = var.num_hom_ref
             hom_alt = var.num_hom_alt
             het = var.num_het
             unknown = var.num_unknown
             
             try:
-                call_rate = var.call_rate
+                call_rate = genotypes.call_rate
             except ValueError:  #TODO: catch error instead of bogus value
                 call_rate = -43.0
             aaf = var.aaf
-            hwe_p_value, inbreeding_coeff = \
-                popgen.get_hwe_likelihood(hom_ref, het, hom_alt, aaf)
+            hwe_p_value, inbreeding_coeff = hwe
             pi_hat = var.nucl_diversity
         else:
             aaf = infotag.extract_aaf(var)
 
         ############################################################
-        # collect annotations from geminicassandra's custom annotation files
-        # but only if the size of the variant is <= 50kb
+        # annotations from geminicassandra's custom annotation files
         ############################################################
-        if var.end - var.POS < 50000:
-            pfam_domain = annotations.get_pfamA_domains(var)
-            cyto_band = annotations.get_cyto_info(var)
-            rs_ids = annotations.get_dbsnp_info(var)
-            clinvar_info = annotations.get_clinvar_info(var)
-            in_dbsnp = 0 if rs_ids is None else 1
-            rmsk_hits = annotations.get_rmsk_info(var)
-            in_cpg = annotations.get_cpg_island_info(var)
-            in_segdup = annotations.get_segdup_info(var)
-            is_conserved = annotations.get_conservation_info(var)
-            esp = annotations.get_esp_info(var)
-            thousandG = annotations.get_1000G_info(var)
-            recomb_rate = annotations.get_recomb_info(var)
-            gms = annotations.get_gms(var)
-            grc = annotations.get_grc(var)
-            in_cse = annotations.get_cse(var)
-            encode_tfbs = annotations.get_encode_tfbs(var)
-            encode_dnaseI = annotations.get_encode_dnase_clusters(var)
-            encode_cons_seg = annotations.get_encode_consensus_segs(var)
-            gerp_el = annotations.get_gerp_elements(var)
-            vista_enhancers = annotations.get_vista_enhancers(var)
-            cosmic_ids = annotations.get_cosmic_info(var)
-            fitcons = annotations.get_fitcons(var)
-            Exac = annotations.get_exac_info(var)
-
-            #load CADD scores by default
-            if self.args.skip_cadd is False:
-                (cadd_raw, cadd_scaled) = annotations.get_cadd_scores(var)
-            else:
-                (cadd_raw, cadd_scaled) = (None, None)
-
-            # load the GERP score for this variant by default.
-            gerp_bp = None
-            if self.args.skip_gerp_bp is False:
-                gerp_bp = annotations.get_gerp_bp(var)
-        # the variant is too big to annotate
-        else:
-            pfam_domain = None
-            cyto_band = None
-            rs_ids = None
-            clinvar_info = annotations.ClinVarInfo()
-            in_dbsnp = None
-            rmsk_hits = None
-            in_cpg = None
-            in_segdup = None
-            is_conserved = None
-            esp = annotations.ESPInfo(None, None, None, None, None)
-            thousandG = annotations.ThousandGInfo(None, None, None, None, None, None, None)
-            Exac = annotations.ExacInfo(None, None, None, None, None, None, None, None, None, None)
-            recomb_rate = None
-            gms = annotations.GmsTechs(None, None, None)
-            grc = None
-            in_cse = None
-            encode_tfbs = None
-            encode_dnaseI = annotations.ENCODEDnaseIClusters(None, None)
-            encode_cons_seg = annotations.ENCODESegInfo(None, None, None, None, None, None)
-            gerp_el = None
-            vista_enhancers = None
-            cosmic_ids = None
-            fitcons = None                
-            cadd_raw = None
-            cadd_scaled = None
-            gerp_bp = None
+        (pfam_domain, cyto_band, rs_ids, clinvar_info, in_dbsnp, rmsk_hits,
+         in_cpg, in_segdup, is_conserved, esp, thousandG, recomb_rate, gms,
+         grc, in_cse, encode_tfbs, encode_dnaseI, encode_cons_seg, gerp_el,
+         vista_enhancers, cosmic_ids, fitcons, Exac, cadd_raw, cadd_scaled,
+         gerp_bp) = annos
 
         # impact is a list of impacts for this variant
         impacts = None
@@ -607,28 +840,6 @@ class GeminiLoader(object):
         if var.ID is not None and var.ID != ".":
             vcf_id = var.ID
 
-        # build up numpy arrays for the genotype information.
-        sample_info = blist([])
-        if not self.args.no_genotypes and not self.args.no_load_genotypes:
-            gt_bases = var.gt_bases  # 'A/G', './.'
-            gt_types = var.gt_types  # -1, 0, 1, 2
-            gt_phases = var.gt_phases  # T F F
-            gt_depths = var.gt_depths  # 10 37 0
-            gt_ref_depths = var.gt_ref_depths  # 2 21 0 -1
-            gt_alt_depths = var.gt_alt_depths  # 8 16 0 -1
-            gt_quals = var.gt_quals  # 10.78 22 99 -1
-            gt_copy_numbers = var.gt_copy_numbers  # 1.0 2.0 2.1 -1
-            gt_columns = concat([gt_bases, gt_types, gt_phases, gt_depths, gt_ref_depths, gt_alt_depths, gt_quals, gt_copy_numbers])
-
-            for entry in var.samples:
-                sample_info.append((entry.sample, entry.gt_type, entry.gt_depth, entry.gt_bases))
-
-            # tally the genotypes            
-            self._update_sample_gt_counts(np.array(var.gt_types, np.int8))
-            
-        else:
-            gt_columns= []            
-        
         if self.args.skip_info_string is False:
             info = var.INFO
         else:
@@ -739,21 +950,89 @@ class GeminiLoader(object):
                    Exac.aaf_AFR, Exac.aaf_AMR,
                    Exac.aaf_EAS, Exac.aaf_FIN,
                    Exac.aaf_NFE, Exac.aaf_OTH,
-                   Exac.aaf_SAS] + gt_columns
+                   Exac.aaf_SAS]
                    
         
             
-        return variant, variant_impacts, sample_info, extra_fields
+        return variant, variant_impacts, extra_fields
     
     
+    def _read_var_blocks(self):
+        """
+        Yield the variants to load in blocks of buffer_size, with the
+        blocks of their genotypes (see genotype_parser).
+        """
+        var_block = []
+        gt_block = []
+        for var in self.vcf_reader:
+            self.lines_read += 1
+            if self.args.passonly and (var.FILTER is not None and var.FILTER != "."):
+                self.skipped += 1
+                continue
+            var_block.append(var)
+            gt_block.append(self.vcf_reader.genotypes)
+            if len(var_block) >= self.buffer_size:
+                yield (var_block, gt_block)
+                var_block = []
+                gt_block = []
+        if len(var_block) > 0:
+            yield (var_block, gt_block)
+
+    def _annotate_block(self, var_block):
+        """
+        Look up the variants of the block in the annotation files, or in
+        the annotation cache if one was given with --anno-cache. With
+        --anno-lookup block the whole block is looked up at once.
+        Variants that are too big to annotate (> 50kb) get no annotations.
+        """
+        block_annos = [None] * len(var_block)
+        to_lookup = []
+        for (idx, var) in enumerate(var_block):
+            if var.end - var.POS >= 50000:
+                block_annos[idx] = annotations.no_annotations()
+            elif self.anno_cache is not None:
+                block_annos[idx] = self.anno_cache.get(var)
+                if block_annos[idx] is None:
+                    to_lookup.append(idx)
+            else:
+                to_lookup.append(idx)
+
+        lookup_vars = [var_block[idx] for idx in to_lookup]
+        if self.args.anno_lookup == "block":
+            looked_up = annotations.annotate_block(lookup_vars, self.args.skip_cadd, self.args.skip_gerp_bp)
+        else:
+            looked_up = [annotations.annotate_variant(var, self.args.skip_cadd, self.args.skip_gerp_bp)
+                         for var in lookup_vars]
+        for (idx, annos) in zip(to_lookup, looked_up):
+            block_annos[idx] = annos
+            if self.anno_cache is not None:
+                self.anno_cache.put(var_block[idx], annos)
+        return block_annos
+
+    def _get_block_hwe(self, var_block):
+        """
+        The (HWE p-value, inbreeding coefficient) of each variant of the
+        block, computed for the whole block at once (see
+        popgen.get_hwe_likelihoods). (None, None) where undefined or
+        when genotypes are not loaded.
+        """
+        if self.args.no_genotypes or self.args.no_load_genotypes:
+            return [(None, None)] * len(var_block)
+        counts = np.array([(var.num_hom_ref, var.num_het, var.num_hom_alt,
+                            np.nan if var.aaf is None else var.aaf) for var in var_block],
+                          dtype=np.float64).reshape(-1, 4)
+        (hwe_p_values, inbreeding_coeffs) = \
+            popgen.get_hwe_likelihoods(counts[:, 0], counts[:, 1], counts[:, 2], counts[:, 3])
+        # NaN (undefined) is the only value not equal to itself
+        return [(p if p == p else None, f if f == f else None)
+                for (p, f) in zip(hwe_p_values.tolist(), inbreeding_coeffs.tolist())]
+
     def _prepare_samples(self):
         """
         private method to load sample information
         """
         if not self.args.no_genotypes:
-            self.sample_to_id = {}
-            for idx, sample in enumerate(self.samples):
-                self.sample_to_id[sample] = idx + 1
+            self.sample_to_id = dict(zip(self.samples, self.sample_ids))
 
         self.ped_hash = {}
         if self.args.ped_file is not None:
@@ -762,6 +1041,8 @@ class GeminiLoader(object):
         samples_buffer = blist([])
         buffer_counter = 0
         for sample in self.samples:
+            if sample in self.loaded_samples:
+                continue
             sample_list = []
             i = self.sample_to_id[sample]
             if sample in self.ped_hash:
@@ -788,7 +1069,10 @@ class GeminiLoader(object):
         batch_insert(self.session, 'samples_by_phenotype', column_names, samples_buffer)
         batch_insert(self.session, 'samples_by_sex', column_names, samples_buffer)    
         
-        insert(self.session, 'row_counts', ['table_name', 'n_rows'], ['samples', len(self.samples)])
+        if self.append:
+            add_to_row_count(self.session, 'samples', len(self.new_sample_idx))
+        else:
+            insert(self.session, 'row_counts', ['table_name', 'n_rows'], ['samples', len(self.samples)])
         
     def _get_gene_detailed(self):
         """
@@ -880,79 +1164,81 @@ class GeminiLoader(object):
         """
         self.sample_gt_counts = np.array(np.zeros((len(self.samples), 4)),
                                          dtype='uint32')
+        # offset of each sample's first bucket in the flattened count array
+        self._gt_count_offsets = np.arange(len(self.samples), dtype=np.int64) * 4
+        self._pending_gt_types = []
+        self._pending_loaded_gt_types = []
 
-    def _update_sample_gt_counts(self, gt_types):
+    def _update_sample_gt_counts(self, gt_types, loaded=False):
+        """
+        Queue the gt types of a single variant for tallying.
+        The counts themselves are updated once per buffer
+        by _flush_sample_gt_counts. Of a variant loaded before
+        (load --append), only the new samples are counted.
         """
-        Update the count of each gt type for each sample
+        if loaded:
+            self._pending_loaded_gt_types.append(gt_types)
+        else:
+            self._pending_gt_types.append(gt_types)
+
+    def _flush_sample_gt_counts(self):
+        """
+        Update the count of each gt type for each sample with
+        all the variants queued since the previous flush.
+
+        Every (sample, gt_type) pair is packed into a single index
+        into the flattened count array, so the whole buffer is
+        tallied with one bincount instead of a Python loop over
+        every sample of every variant.
         """
-        for idx, gt_type in enumerate(gt_types):
-            self.sample_gt_counts[idx][gt_type] += 1
+        if len(self._pending_gt_types) > 0:
+            self._tally_gt_types(np.vstack(self._pending_gt_types), self._gt_count_offsets)
+            self._pending_gt_types = []
+        if len(self._pending_loaded_gt_types) > 0:
+            new = self.new_sample_idx
+            self._tally_gt_types(np.vstack(self._pending_loaded_gt_types)[:, new], self._gt_count_offsets[new])
+            self._pending_loaded_gt_types = []
+
+    def _tally_gt_types(self, gt_block, offsets):
+        # & 3 sends -1 to the last bucket, as the old per-sample
+        # indexing with a negative gt_type did.
+        packed = (offsets + (gt_block & 3)).ravel()
+        counts = np.bincount(packed, minlength=self.sample_gt_counts.size)
+        self.sample_gt_counts += counts.reshape(self.sample_gt_counts.shape).astype('uint32')
 
     def store_sample_gt_counts(self):
         """
-        Update the count of each gt type for each sample
+        Add the count of each gt type for each sample to the
+        sample_genotype_counts counters, which are keyed by the
+        index of the sample (its sample_id - 1).
         """
-        samples_buffer = blist([])
-        buffer_count = 0
-        for idx, gt_counts in enumerate(self.sample_gt_counts):
-            if buffer_count < 10000:
-                samples_buffer.append([int(gt_counts[HOM_REF]),  # hom_ref
-                                int(gt_counts[HET]),  # het
-                                int(gt_counts[HOM_ALT]),  # hom_alt
-                                int(gt_counts[UNKNOWN]), #missing
-                                idx])
-                buffer_count += 1
-            else:
-                self.batch_insert_gt_counts(samples_buffer)
-                samples_buffer = blist([])
-                buffer_count = 0
-        self.batch_insert_gt_counts(samples_buffer)   
+        self._flush_sample_gt_counts()
+        contents = [[int(gt_counts[HOM_REF]),  # hom_ref
+                     int(gt_counts[HET]),  # het
+                     int(gt_counts[HOM_ALT]),  # hom_alt
+                     int(gt_counts[UNKNOWN]), #missing
+                     sample_id - 1]
+                    for sample_id, gt_counts in zip(self.sample_ids, self.sample_gt_counts)]
+        self.batch_insert_gt_counts(contents)
             
     def batch_insert_gt_counts(self, contents):
-        
+        """
+        Increment the counters of the samples. Counter updates are not
+        idempotent, so failed ones are reported instead of retried.
+        """
         update_query = self.session.prepare('''UPDATE sample_genotype_counts    \
-                                               SET num_hom_ref = ?,\
-                                               num_het = ?,            \
-                                               num_hom_alt = ?,    \
-                                               num_unknown = ?,    \
-                                               version = ?   \
-                                               WHERE sample_id = ? \
-                                               IF version = ?''')
-        
-        create_query = self.session.prepare('''INSERT INTO sample_genotype_counts \
-                                               (num_hom_ref,\
-                                               num_het,            \
-                                               num_hom_alt,    \
-                                               num_unknown,    \
-                                               sample_id, \
-                                               version)    \
-                                               VALUES (?,?,?,?,?,?) IF NOT EXISTS''')
-        
-        get_query = self.session.prepare("SELECT * FROM sample_genotype_counts WHERE sample_id = ?")
-        
-        def get_version(sample_id):
-            res = self.session.execute(get_query, [sample_id])
-            if len(res) > 0:
-                return res[0]
-            else:
-                return []
-        
-        retries = []
-        for entry in contents:
-            vals = get_version(entry[4])
-            versioned_entry = entry
-            if vals == []:
-                versioned_entry.append(0)
-                res = self.session.execute(create_query, versioned_entry)
-            else:
-                updated_contents = [entry[0]+vals.num_hom_ref, entry[1]+vals.num_het, entry[2]+vals.num_hom_alt,\
-                                    entry[3]+vals.num_unknown, vals.version + 1, entry[4],  vals.version]
-                res = self.session.execute(update_query, updated_contents)
-            if not res[0].applied:
-                retries.append(entry)  
-                
-        if len(retries) > 0:
-            self.batch_insert_gt_counts(retries)   
+                                               SET num_hom_ref = num_hom_ref + ?,\
+                                               num_het = num_het + ?,            \
+                                               num_hom_alt = num_hom_alt + ?,    \
+                                               num_unknown = num_unknown + ?    \
+                                               WHERE sample_id = ?''')
+        
+        results = execute_concurrent_with_args(self.session, update_query, contents,
+                                               raise_on_first_error=False)
+        for (entry, (success, result)) in zip(contents, results):
+            if not success:
+                sys.stderr.write("WARNING: the genotype counts of sample %d may not have been stored: %s\n" %
+                                 (entry[4], result))
             
 def concat(l):
         return reduce(lambda x, y: x + y, l, [])
@@ -976,6 +1262,53 @@ def parse_int(s):
     except TypeError:
         return -43
 
+def get_peak_memory():
+    """
+    The peak resident memory of the process so far, in MB.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # in bytes on OS X, in KB elsewhere
+    return peak / 1048576.0 if sys.platform == 'darwin' else peak / 1024.0
+
+def _partition_batches(rows, key_column):
+    """
+    Split the rows into lists of at most GT_BATCH_ROWS rows that share
+    the partition key in column key_column.
+    """
+    partitions = {}
+    for row in rows:
+        partitions.setdefault(row[key_column], []).append(row)
+    for partition in partitions.itervalues():
+        for i in xrange(0, len(partition), GT_BATCH_ROWS):
+            yield partition[i:i + GT_BATCH_ROWS]
+
+def check_gt_counts_table(cluster, keyspace_name):
+    """
+    Exit if sample_genotype_counts has the int columns of keyspaces
+    loaded before the genotype counts were counters. CREATE TABLE IF
+    NOT EXISTS leaves them as they are, and the counter updates at the
+    end of the load would fail on them after all rows are written.
+    """
+    keyspace = cluster.metadata.keyspaces.get(keyspace_name)
+    if keyspace is None or 'sample_genotype_counts' not in keyspace.tables:
+        return
+    columns = keyspace.tables['sample_genotype_counts'].columns
+    not_counters = [name for name in ('num_hom_ref', 'num_het', 'num_hom_alt', 'num_unknown')
+                    if name in columns and _column_type(columns[name]) != 'counter']
+    if len(not_counters) > 0:
+        sys.exit("ERROR: the columns %s of sample_genotype_counts in keyspace %s are not counters, as "
+                 "those of keyspaces loaded by earlier versions. Loading into it would lose the genotype "
+                 "counts; load into a new keyspace, or load with --no-load-genotypes.\n" %
+                 (", ".join(not_counters), keyspace_name))
+
+def _column_type(column):
+    """
+    The CQL type of the metadata of a column, with the driver 2.x and 3.x.
+    """
+    if hasattr(column, 'cql_type'):
+        return column.cql_type
+    return column.typestring
+
 def load(parser, args):
     if args.vcf is None:
         parser.print_help()
@@ -998,8 +1331,6 @@ def load(parser, args):
     #gemini_loader.update_gene_table()
     
     if not args.no_genotypes and not args.no_load_genotypes:
-        if cpu_count() > 8:
-            sleep(randint(0,8)*20)
         gemini_loader.store_sample_gt_counts()
         
     gemini_loader.disconnect()
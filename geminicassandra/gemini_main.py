@@ -45,6 +45,47 @@ def examples(parser, args):
 
     exit()
 
+def add_connection_arguments(subparser):
+    """
+    Options of the connections to the Cassandra cluster (see
+    database_cassandra.set_connection_options). When not given, they
+    are read from the 'cassandra' section of the config file.
+    """
+    subparser.add_argument('--local-dc',
+                           dest='local_dc',
+                           default=None,
+                           help='Data center whose nodes get the requests (default: that of the contact points).')
+    subparser.add_argument('--core-connections',
+                           dest='core_connections',
+                           default=None,
+                           type=int,
+                           help='Connections to open to each host of the local data center (protocol versions 1 and 2 only).')
+    subparser.add_argument('--max-connections',
+                           dest='max_connections',
+                           default=None,
+                           type=int,
+                           help='Most connections to each host of the local data center (protocol versions 1 and 2 only).')
+    subparser.add_argument('--protocol-version',
+                           dest='protocol_version',
+                           default=None,
+                           type=int,
+                           help='Native protocol version to use (default: negotiated with the cluster).')
+    subparser.add_argument('--compression',
+                           dest='compression',
+                           default=None,
+                           choices=['auto', 'lz4', 'snappy', 'none'],
+                           help='Compression of the traffic with the cluster (default: auto).')
+    subparser.add_argument('--connect-timeout',
+                           dest='connect_timeout',
+                           default=None,
+                           type=float,
+                           help='Timeout in seconds for opening connections.')
+    subparser.add_argument('--request-timeout',
+                           dest='request_timeout',
+                           default=None,
+                           type=float,
+                           help='Timeout in seconds for requests.')
+
 def main():
     #########################################
     # create the top-level parser
@@ -117,10 +158,70 @@ def main():
                              action='store_true',
                              help='There are no genotypes in the file (e.g. some 1000G VCFs)',
                              default=False)
+    parser_load.add_argument('--packed-genotypes',
+                             dest='packed_genotypes',
+                             action='store_true',
+                             help='Store each genotype field as one compressed blob per variant '
+                                  'instead of one column per sample.',
+                             default=False)
+    parser_load.add_argument('--anno-lookup',
+                             dest='anno_lookup',
+                             choices=['fetch', 'stream', 'block'],
+                             default='fetch',
+                             help='How to look up variants in the annotation files: a Tabix fetch per '
+                                  'variant (default), one sorted sweep per file for coordinate-sorted VCFs, '
+                                  'or one fetch per file for each block of nearby variants in a buffer.')
+    parser_load.add_argument('--anno-cache',
+                             dest='anno_cache',
+                             metavar='PATH',
+                             default=None,
+                             help='sqlite file caching the annotations of loaded variants, '
+                                  'to speed up loading the same regions again.')
+    parser_load.add_argument('--replay',
+                             dest='replay',
+                             action='store_true',
+                             default=False,
+                             help='Instead of loading a VCF, write the inserts that kept failing in earlier loads '
+                                  '(saved in loading_logs/*.replay) to the database. Only the inserts into the '
+                                  'keyspace given with -ks are written, and not those of loads that are still '
+                                  'running.')
+    parser_load.add_argument('--append',
+                             dest='append',
+                             action='store_true',
+                             default=False,
+                             help='Add the variants and samples of the VCF to a keyspace that was loaded before. '
+                                  'Variants already loaded (same chrom, start, ref and alt) only get the genotypes '
+                                  'of the new samples; new variants get ids from a newly reserved range.')
+    parser_load.add_argument('--resume',
+                             dest='resume',
+                             action='store_true',
+                             default=False,
+                             help='Go on with an interrupted load of the VCF from its last checkpoints '
+                                  '(kept in the load_progress table), skipping the chunks that were loaded.')
+    # for the tests of --resume: interrupt the load after this many buffers
+    parser_load.add_argument('--stop-after-buffers',
+                             dest='stop_after_buffers',
+                             type=int,
+                             default=None,
+                             help=argparse.SUPPRESS)
+    parser_load.add_argument('--sstable-out',
+                             dest='sstable_out',
+                             metavar='DIR',
+                             default=None,
+                             help='Instead of inserting them, write the rows of variants, variant_impacts and '
+                                  'the variant/sample index tables to one CSV file per table in DIR, sorted by '
+                                  'token, with a cqlsh script to import them (or to feed to CQLSSTableWriter '
+                                  'for sstableloader). The schema and the other tables still go to the cluster.')
     parser_load.add_argument('--cores', dest='cores',
                              default=1,
                              type=int,
                              help="Number of cores to use to load in parallel.")
+    parser_load.add_argument('--chunk-size', dest='chunk_size',
+                             default=10000,
+                             type=int,
+                             help="Number of VCF lines per chunk handed to a loading core. "
+                                  "Multiples of 10000 let the cores seek straight to their "
+                                  "first line in the grabix index.")
     parser_load.add_argument('--scheduler', dest='scheduler', default=None,
                              choices=["lsf", "sge", "slurm", "torque"],
                              help='Cluster scheduler to use.')
@@ -156,9 +257,9 @@ def main():
                              help="replication factor for the Cassandra cluster")
     parser_load.add_argument('--max_queue',
                              dest= "max_queue",
-                             default = 120,
+                             default = 4,
                              type=int,
-                             help="queue length (per core) for batched inserts to Cassandra")
+                             help="maximum number of buffers (of --buffer-size variants) queued between the VCF parser and the Cassandra writer (per core)")
     parser_load.add_argument('--node_num',
                              dest="node_num",
                              default = 1,
@@ -172,6 +273,7 @@ def main():
         import gemini_load
         gemini_load.load(parser, args)
 
+    add_connection_arguments(parser_load)
     parser_load.set_defaults(func=load_fn)
 
     #########################################
@@ -233,6 +335,25 @@ def main():
                                   action='store_true',
                                   help='There are no genotypes in the file (e.g. some 1000G VCFs)',
                                   default=False)
+    parser_loadchunk.add_argument('--packed-genotypes',
+                                  dest='packed_genotypes',
+                                  action='store_true',
+                                  help='Store each genotype field as one compressed blob per variant '
+                                       'instead of one column per sample.',
+                                  default=False)
+    parser_loadchunk.add_argument('--anno-lookup',
+                                  dest='anno_lookup',
+                                  choices=['fetch', 'stream', 'block'],
+                                  default='fetch',
+                                  help='How to look up variants in the annotation files: a Tabix fetch per '
+                                       'variant (default), one sorted sweep per file for coordinate-sorted VCFs, '
+                                       'or one fetch per file for each block of nearby variants in a buffer.')
+    parser_loadchunk.add_argument('--anno-cache',
+                                  dest='anno_cache',
+                                  metavar='PATH',
+                                  default=None,
+                                  help='sqlite file caching the annotations of loaded variants, '
+                                       'to speed up loading the same regions again.')
     parser_loadchunk.add_argument('--skip-gerp-bp',
                                   dest='skip_gerp_bp',
                                   action='store_true',
@@ -275,9 +396,9 @@ def main():
                              help="replication factor for the Cassandra cluster")
     parser_loadchunk.add_argument('--max_queue',
                              dest= "max_queue",
-                             default = 120,
+                             default = 4,
                              type=int,
-                             help="queue length (per core) for batched inserts to Cassandra")
+                             help="maximum number of buffers (of --buffer-size variants) queued between the VCF parser and the Cassandra writer (per core)")
     parser_loadchunk.add_argument('--node_num',
                              dest="node_num",
                              default = 1,
@@ -287,6 +408,7 @@ def main():
     def loadchunk_fn(parser, args):
         import gemini_load_chunk
         gemini_load_chunk.load(parser, args)
+    add_connection_arguments(parser_loadchunk)
     parser_loadchunk.set_defaults(func=loadchunk_fn)
 
     #########################################
@@ -342,7 +464,7 @@ def main():
                              dest='cores',
                              default=1,
                              type=int,
-                             help="Number of cores to use to interpret gt-filter wildcards in parallel.")
+                             help="Number of cores to use to fetch the matching rows in parallel.")
 
     parser_query.add_argument('--header',
                               dest='use_header',
@@ -396,11 +518,23 @@ def main():
                               dest='batch_size',
                               default=50,
                               type=int)
+    parser_query.add_argument('--explain',
+                              dest='explain',
+                              action='store_true',
+                              help='Print the evaluation plan of the filters, with the estimated number '
+                                   'of variants each one matches, instead of running the query.',
+                              default=False)
+    parser_query.add_argument('-max_concurrent_queries',
+                              dest='max_concurrent_queries',
+                              help='The most queries the filters run at once (default 32).',
+                              default=None,
+                              type=int)
     
     def query_fn(parser, args):
         import gemini_query
         gemini_query.query(parser, args)
 
+    add_connection_arguments(parser_query)
     parser_query.set_defaults(func=query_fn)
 
     
@@ -448,6 +582,7 @@ def main():
     def region_fn(parser, args):
         import gemini_region
         gemini_region.region(parser, args)
+    add_connection_arguments(parser_region)
     parser_region.set_defaults(func=region_fn)
 
     #########################################
@@ -510,6 +645,7 @@ def main():
     def stats_fn(parser, args):
         import gemini_stats
         gemini_stats.stats(parser, args)
+    add_connection_arguments(parser_stats)
     parser_stats.set_defaults(func=stats_fn)
 
     #########################################
@@ -653,6 +789,9 @@ def main():
             parser.error("If you are using the IPython parallel loading, you "
                          "must specify both a scheduler with --scheduler and a "
                          "queue to use with --queue.")
+    if hasattr(args, "contact_points"):
+        from geminicassandra import database_cassandra
+        database_cassandra.set_connection_options(args)
     try:
         args.func(parser, args)
     except IOError, e:
@@ -121,7 +121,7 @@ def run_query(args):
            gene_needed, args.show_families, args.testing, 
            sample_names_needed, args.cores, start_time, 
            args.use_header, args.exp_id, args.timeout,
-           args.batch_size)
+           args.batch_size, args.explain, args.max_concurrent_queries)
 
 def query(parser, args):
     run_query(args)
@@ -0,0 +1,311 @@
+#!/usr/bin/env python
+"""
+Fast path for the genotypes of the VCF records.
+
+cyvcf parses the sample columns of a record into one _Call object per
+sample, and then into the per-sample lists of the record (gt_bases,
+gt_types, ...). For VCFs with thousands of samples, creating these objects
+is most of the loading time. A GenotypeReader is a cyvcf Reader that
+parses the sample columns of a record at once into numpy arrays instead:
+the fields are split with one str.split over all samples, the numeric
+fields (DP, AD, GQ, CN) are converted as arrays and the genotype fields
+are interpreted once per distinct value. The arrays of the last record
+read are in reader.genotypes (a Genotypes, None for a record without
+samples); the record itself only gets the genotype counts (num_hom_ref,
+...), so that aaf and nucl_diversity work, and no samples.
+
+The values are those cyvcf would give. The records with fields the fast
+path does not handle (RO/AO depths, non-integer DP, ploidy > 2, missing
+values in AD) are parsed by cyvcf, and their Genotypes hold its lists.
+
+The fast path stands in for cyvcf's private Reader._parse_samples and
+returns its private _SampleInfo. If the fields of _SampleInfo are not
+those of the cyvcf releases it was written for (0.1.14 to 0.1.16), every
+record is parsed by cyvcf.
+"""
+import re
+import sys
+
+import numpy as np
+from cyvcf import parser
+
+from gemini_constants import HOM_REF, HET, UNKNOWN, HOM_ALT
+
+# the fields of a Genotypes, in the order of the genotype columns
+# (see GeminiLoader._get_typed_gt_column_names)
+GT_FIELDS = ['gt_bases', 'gt_types', 'gt_phases', 'gt_depths', 'gt_ref_depths',
+             'gt_alt_depths', 'gt_quals', 'gt_copy_numbers']
+
+# the fields of cyvcf's _SampleInfo the fast path fills in
+_SAMPLE_INFO_FIELDS = ('samples', 'gt_bases', 'gt_types', 'gt_phases', 'gt_depths', 'gt_ref_depths',
+                       'gt_alt_depths', 'gt_quals', 'gt_copy_numbers', 'gt_phred_likelihoods',
+                       'num_hom_ref', 'num_het', 'num_hom_alt', 'num_unknown', 'num_called')
+_COUNT_FIELDS = _SAMPLE_INFO_FIELDS[10:]
+
+FAST_PATH = tuple(getattr(getattr(parser, '_SampleInfo', None), '_fields', ())) == _SAMPLE_INFO_FIELDS
+if not FAST_PATH:
+    sys.stderr.write("WARNING: this cyvcf does not parse the samples as genotype_parser expects, "
+                     "the genotypes are parsed by cyvcf (slowly).\n")
+
+# FORMAT fields whose depths cyvcf takes when there is no AD
+_OTHER_DEPTH_FIELDS = set(['RO', 'AO'])
+
+# an AD field that does not have two values
+_IRREGULAR_DEPTHS = re.compile(r';[^;,]*;|;[^;,]*,[^;,]*,')
+
+
+class Genotypes(object):
+    """
+    The genotypes of the samples of one record: one numpy array (or, for
+    the records cyvcf parsed, list) per field of GT_FIELDS, and the
+    genotype counts. On the fast path, the gt_bases are kept as the
+    distinct values (bases_values) and the index of the value of each
+    sample (bases_index).
+    """
+    __slots__ = GT_FIELDS[1:] + ['bases_values', 'bases_index', 'counts', 'fast']
+
+    def __init__(self, values, counts, fast):
+        for (field, value) in zip(GT_FIELDS[1:], values[1:]):
+            setattr(self, field, value)
+        if fast:
+            (self.bases_values, self.bases_index) = values[0]
+        else:
+            (self.bases_values, self.bases_index) = (values[0], None)
+        # (num_hom_ref, num_het, num_hom_alt, num_unknown, num_called)
+        self.counts = counts
+        self.fast = fast
+
+    @property
+    def gt_bases(self):
+        if self.bases_index is None:
+            return self.bases_values
+        return np.array(self.bases_values, dtype=object)[self.bases_index].tolist()
+
+    @property
+    def columns(self):
+        return [getattr(self, field) for field in GT_FIELDS]
+
+    @property
+    def call_rate(self):
+        return float(self.counts[4]) / len(self.gt_types)
+
+    def types_array(self):
+        return np.asarray(self.gt_types, dtype=np.int8)
+
+    def called(self):
+        """
+        The (index, gt_type, gt_depth, gt_bases) of the samples whose
+        genotype is known, as Python values.
+        """
+        if self.fast:
+            called = np.flatnonzero(self.gt_types != UNKNOWN)
+            bases = np.array(self.bases_values, dtype=object)[self.bases_index[called]]
+            return zip(called.tolist(), self.gt_types[called].tolist(), self.gt_depths[called].tolist(),
+                       bases.tolist())
+        return [(i, gt_type, gt_depth, gt_bases) for (i, (gt_type, gt_depth, gt_bases))
+                in enumerate(zip(self.gt_types, self.gt_depths, self.gt_bases))
+                if gt_type is not None and gt_type != UNKNOWN]
+
+    def column_values(self):
+        """
+        The values of the genotype columns, as Python values.
+        """
+        if self.fast:
+            return [self.gt_bases] + [getattr(self, field).tolist() for field in GT_FIELDS[1:]]
+        return self.columns
+
+
+class GenotypeReader(parser.Reader):
+    """
+    A cyvcf Reader that parses the genotypes of the records with the fast
+    path (see the module). With parse_genotypes False, the sample columns
+    are not parsed at all.
+    """
+    parse_genotypes = True
+    genotypes = None
+    fast_records = 0
+    slow_records = 0
+
+    def next(self):
+        self.genotypes = None
+        return parser.Reader.next(self)
+
+    def _parse_samples(self, samples, fmt):
+        if not FAST_PATH:
+            info = parser.Reader._parse_samples(self, samples, fmt)
+            self.genotypes = None
+            if self.parse_genotypes:
+                self.genotypes = _cyvcf_genotypes(info)
+                self.slow_records += 1
+            return info
+        if not self.parse_genotypes:
+            self.genotypes = None
+            return parser._SampleInfo([], [], [], [], [], [], [], [], [], [], 0, 0, 0, 0, 0)
+        values = _parse_fast(samples, fmt, self.curr_record.alleles)
+        if values is None:
+            info = parser.Reader._parse_samples(self, samples, fmt)
+            self.genotypes = _cyvcf_genotypes(info)
+            self.slow_records += 1
+            return info
+        counts = np.bincount(values[1], minlength=4)
+        counts = (int(counts[HOM_REF]), int(counts[HET]), int(counts[HOM_ALT]), int(counts[UNKNOWN]),
+                  len(samples) - int(counts[UNKNOWN]))
+        self.genotypes = Genotypes(values, counts, True)
+        self.fast_records += 1
+        return parser._SampleInfo([], [], [], [], [], [], [], [], [], [], *counts)
+
+
+def _cyvcf_genotypes(info):
+    """
+    The Genotypes of the samples cyvcf parsed into info.
+    """
+    return Genotypes([getattr(info, field) for field in GT_FIELDS],
+                     tuple(getattr(info, field) for field in _COUNT_FIELDS), False)
+
+
+def _parse_fast(samples, fmt, alleles):
+    """
+    The values of GT_FIELDS of the samples, as numpy arrays (gt_bases as
+    in _parse_gts), None if the record needs cyvcf.
+    """
+    keys = fmt.split(':')
+    if 'GT' not in keys or ('AD' not in keys and _OTHER_DEPTH_FIELDS.intersection(keys)):
+        return None
+    if any(not isinstance(allele, str) for allele in alleles):
+        return None
+    n_samples = len(samples)
+    n_keys = len(keys)
+    fields = ':'.join(samples).split(':')
+    if len(fields) != n_samples * n_keys:
+        fields = _pad_samples(samples, n_keys)
+        if fields is None:
+            return None
+
+    def column(key):
+        if key not in keys:
+            return None
+        return fields[keys.index(key)::n_keys]
+
+    gt_values = _parse_gts(column('GT'), alleles)
+    if gt_values is None:
+        return None
+    (gt_bases, gt_types, gt_phases) = gt_values
+    try:
+        gt_depths = _parse_numbers(column('DP'), n_samples, np.int32)
+        gt_quals = _parse_numbers(column('GQ'), n_samples, np.float64)
+        gt_copy_numbers = _parse_numbers(column('CN'), n_samples, np.float64)
+        depths = _parse_allele_depths(column('AD'), n_samples)
+    except ValueError:
+        return None
+    return [gt_bases, gt_types, gt_phases, gt_depths, depths[:, 0], depths[:, 1], gt_quals, gt_copy_numbers]
+
+
+def _pad_samples(samples, n_keys):
+    """
+    The fields of the samples, the samples that leave out trailing fields
+    (mostly ./.) getting empty ones, which cyvcf takes as missing. None
+    if a sample has too many fields.
+    """
+    # the bare missing calls are padded at once
+    text = '\t%s\t' % '\t'.join(samples)
+    for call in ('./.', '.'):
+        (bare, padded) = ('\t%s\t' % call, '\t%s%s\t' % (call, ':' * (n_keys - 1)))
+        text = text.replace(bare, padded).replace(bare, padded)
+    fields = text[1:-1].replace('\t', ':').split(':')
+    if len(fields) == len(samples) * n_keys:
+        return fields
+    samples = text[1:-1].split('\t')
+    if any(sample.count(':') >= n_keys for sample in samples):
+        return None
+    return ':'.join(sample + ':' * (n_keys - 1 - sample.count(':')) for sample in samples).split(':')
+
+
+def _parse_gts(gts, alleles):
+    """
+    The (gt_bases, gt_types, gt_phases) of the GT fields, each distinct
+    value being interpreted once, the gt_bases as (distinct values, index
+    of each sample); None if one is not haploid or diploid.
+    """
+    (distinct, index) = np.unique(np.array(gts), return_inverse=True)
+    index = index.astype(np.int16 if len(distinct) < 2 ** 15 else np.int32)
+    bases = []
+    types = np.empty(len(distinct), dtype=np.int8)
+    phases = np.empty(len(distinct), dtype=np.int8)
+    for (i, gt) in enumerate(distinct.tolist()):
+        value = _interpret_gt(gt, alleles)
+        if value is None:
+            return None
+        (gt_bases, types[i], phases[i]) = value
+        bases.append(gt_bases)
+    return ((bases, index), types[index], phases[index])
+
+
+def _interpret_gt(gt, alleles):
+    """
+    The (gt_bases, gt_type, gt_phase) of a GT field, as cyvcf has them.
+    """
+    phased = '|' in gt
+    calls = gt.split('|' if phased else '/')
+    if len(calls) > 2 or (phased and '/' in gt):
+        return None
+    if all(call in ('.', '') for call in calls):
+        return ('./.', UNKNOWN, False)
+    try:
+        calls = [None if call == '.' else int(call) for call in calls]
+        bases = ['.' if call is None else alleles[call] for call in calls]
+    except (ValueError, IndexError):
+        return None
+    if len(calls) == 2 and calls[0] != calls[1]:
+        gt_type = HET
+    else:
+        gt_type = HOM_REF if calls[0] == 0 else HOM_ALT
+    return (('|' if phased else '/').join(bases), gt_type, phased)
+
+
+def _parse_numbers(values, n_samples, dtype):
+    """
+    The numbers of a numeric field, -1 where missing. Raises a ValueError
+    for the values that are not numbers of dtype.
+    """
+    if values is None:
+        return np.repeat(np.array(-1, dtype=dtype), n_samples)
+    text = _fill_missing(','.join(values), ',', '-1')
+    if dtype == np.int32 and '.' in text:
+        raise ValueError
+    return _read_numbers(text, n_samples, dtype)
+
+
+def _parse_allele_depths(values, n_samples):
+    """
+    The (ref depth, alt depth) of each sample, from its AD field: cyvcf
+    only takes two values, other ones get -1. Raises a ValueError if
+    one of two values is missing.
+    """
+    if values is None:
+        return np.repeat(np.array([[-1, -1]], dtype=np.int32), n_samples, axis=0)
+    text = _fill_missing(';'.join(values), ';', '-1,-1')
+    if _IRREGULAR_DEPTHS.search(';%s;' % text):
+        text = ';'.join(value if value.count(',') == 1 else '-1,-1' for value in text.split(';'))
+    text = text.replace(';', ',')
+    if '.' in text or ',,' in ',%s,' % text:
+        raise ValueError
+    return _read_numbers(text, 2 * n_samples, np.int32).reshape(n_samples, 2)
+
+
+def _fill_missing(text, sep, fill):
+    """
+    Replace the missing values ('.' or empty) of text, separated by sep,
+    by fill.
+    """
+    text = '%s%s%s' % (sep, text, sep)
+    for missing in (sep + '.' + sep, sep + sep):
+        # replace leaves every other one of adjacent missing values
+        text = text.replace(missing, sep + fill + sep).replace(missing, sep + fill + sep)
+    return text[1:-1]
+
+
+def _read_numbers(text, n_numbers, dtype):
+    numbers = np.fromstring(text, dtype=dtype, sep=',')
+    if len(numbers) != n_numbers:
+        raise ValueError
+    return numbers
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+"""
+Checkpoint journal of the loads, for load --resume.
+
+Each load has a partition of the load_progress table, keyed by its VCF
+and node (see get_load_id). Whenever the writer stage has written a
+buffer of variants, the loader of a chunk records the line and variant_id
+to go on from, the number of variants it loaded and the genotype counts
+of its samples so far; the last checkpoint of a chunk is marked done.
+The row of chunk SETUP_CHUNK holds the decisions of the setup of the load
+(the ids of load --append) and the layout of its chunks (--cores,
+--chunk-size, --total_nodes), so that a resumed load takes the same ones
+and its checkpoints are of the same lines, and is marked done once the
+whole load is.
+
+Reloading the variants after the last checkpoint of a chunk is harmless,
+as the inserts are idempotent. The genotype counts of the samples are
+counter updates, which are not: the row of chunk COUNTS_CHUNK records
+that the load is about to add them, and a resumed load that finds it
+does not add them again.
+"""
+import os
+import zlib
+import sqlite3
+import cPickle
+from collections import namedtuple
+
+import numpy as np
+
+SETUP_CHUNK = -1
+COUNTS_CHUNK = -2
+
+# the setup decisions of a load that its loaders take from the args
+SETUP_ARGS = ['variant_id_base', 'loaded_samples', 'sample_ids']
+# the args that decide which lines the chunks of a load are
+LAYOUT_ARGS = ['cores', 'chunk_size', 'total_nodes']
+
+Checkpoint = namedtuple('Checkpoint', ['chunk', 'next_line', 'next_variant_id', 'n_variants',
+                                       'n_new_variants', 'gt_counts', 'done'])
+
+
+def get_load_id(args):
+    """
+    The VCF and node of the load.
+    """
+    return "%s:%d" % (os.path.abspath(args.vcf), args.node_num)
+
+
+def restore_setup(args, setup):
+    """
+    Take the setup decisions and chunk layout of a load (see
+    LoadJournal.get_setup) into args.
+    """
+    for (name, value) in setup.iteritems():
+        if name in LAYOUT_ARGS and getattr(args, name, value) != value:
+            print "Resuming with the %s of the interrupted load: %s, not %s." % (name, value, getattr(args, name))
+        setattr(args, name, value)
+
+
+class LoadJournal(object):
+    """
+    The load_progress rows of one load.
+    """
+    def __init__(self, session, load_id):
+        self.load_id = load_id
+        self.reconnect(session)
+
+    def reconnect(self, session):
+        """
+        Go on with another session, once that of the journal is shut down.
+        """
+        self.session = session
+        self.checkpoint_query = session.prepare('''INSERT INTO load_progress
+            (load_id, chunk, next_line, next_variant_id, n_variants, n_new_variants, gt_counts, done)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)''')
+
+    def checkpoint(self, chunk, next_line, next_variant_id, n_variants, n_new_variants, gt_counts, done=False):
+        self.session.execute(self.checkpoint_query,
+                             [self.load_id, chunk, next_line, next_variant_id, n_variants, n_new_variants,
+                              _pack_counts(gt_counts), done])
+
+    def get_checkpoints(self):
+        """
+        The last checkpoint of each chunk, by chunk.
+        """
+        rows = self.session.execute("SELECT chunk, next_line, next_variant_id, n_variants, n_new_variants, "
+                                    "gt_counts, done FROM load_progress WHERE load_id = %s", [self.load_id])
+        return dict((row[0], Checkpoint(row[0], row[1], row[2], row[3], row[4], _unpack_counts(row[5]), row[6]))
+                    for row in rows if row[0] >= 0)
+
+    def save_setup(self, args):
+        setup = dict((name, getattr(args, name)) for name in SETUP_ARGS + LAYOUT_ARGS if hasattr(args, name))
+        self.session.execute("INSERT INTO load_progress (load_id, chunk, setup, done) VALUES (%s, %s, %s, %s)",
+                             [self.load_id, SETUP_CHUNK, sqlite3.Binary(cPickle.dumps(setup, 2)), False])
+
+    def get_setup(self):
+        """
+        The (setup decisions, done) of the load, None if its setup did
+        not finish.
+        """
+        rows = list(self.session.execute("SELECT setup, done FROM load_progress WHERE load_id = %s AND chunk = %s",
+                                         [self.load_id, SETUP_CHUNK]))
+        if len(rows) == 0:
+            return None
+        return (cPickle.loads(str(rows[0][0])), rows[0][1])
+
+    def mark_counts_stored(self):
+        """
+        Record that the genotype counts of the load are added to the
+        sample_genotype_counts counters. This is done before they are,
+        as adding them twice is worse than a load that fails halfway
+        losing them.
+        """
+        self.session.execute("INSERT INTO load_progress (load_id, chunk, done) VALUES (%s, %s, %s)",
+                             [self.load_id, COUNTS_CHUNK, True])
+
+    def counts_stored(self):
+        rows = self.session.execute("SELECT done FROM load_progress WHERE load_id = %s AND chunk = %s",
+                                    [self.load_id, COUNTS_CHUNK])
+        return len(list(rows)) > 0
+
+    def finish(self):
+        self.session.execute("UPDATE load_progress SET done = true WHERE load_id = %s AND chunk = %s",
+                             [self.load_id, SETUP_CHUNK])
+
+    def clear(self):
+        self.session.execute("DELETE FROM load_progress WHERE load_id = %s", [self.load_id])
+
+
+def _pack_counts(gt_counts):
+    if gt_counts is None:
+        return None
+    return sqlite3.Binary(zlib.compress(np.asarray(gt_counts, dtype='uint32').tostring(), 1))
+
+
+def _unpack_counts(blob):
+    if blob is None:
+        return None
+    return np.frombuffer(zlib.decompress(str(blob)), dtype='uint32').reshape(-1, 4).copy()
@@ -1,3 +1,5 @@
+import numpy as np
+
 import stats
 
 
@@ -33,3 +35,34 @@ def get_hwe_likelihood(obs_hom_ref, obs_het, obs_hom_alt, aaf):
     inbreeding_coeff = (
         1.0 - (float(obs_het) / (float(exp_het)))) if obs_het > 0 else None
     return stats.lchisqprob(x2_statistic, 1), inbreeding_coeff
+
+
+def get_hwe_likelihoods(obs_hom_ref, obs_het, obs_hom_alt, aaf):
+    """
+    Batch version of get_hwe_likelihood for numpy arrays holding the
+    genotype counts and alternate allele frequencies of many variants.
+    Returns arrays of HWE p-values and inbreeding coefficients, with NaN
+    where get_hwe_likelihood returns None (aaf is NaN for variants whose
+    aaf is undefined).
+    """
+    obs_hom_ref = np.asarray(obs_hom_ref, dtype=np.float64)
+    obs_het = np.asarray(obs_het, dtype=np.float64)
+    obs_hom_alt = np.asarray(obs_hom_alt, dtype=np.float64)
+    aaf = np.asarray(aaf, dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # np.power(x, 2) goes through pow() like x ** 2 on floats does, whereas
+        # x ** 2 on arrays is x * x, which can round differently
+        sum = obs_hom_ref + obs_het + obs_hom_alt
+        raf = 1.0 - aaf
+        exp_hom_ref = np.power(raf, 2) * sum
+        exp_het = (2.0 * (raf * aaf)) * sum
+        exp_hom_alt = np.power(aaf, 2) * sum
+        x2_hom_ref = np.where(exp_hom_ref > 0, np.power(obs_hom_ref - exp_hom_ref, 2) / exp_hom_ref, 0)
+        x2_hom_alt = np.where(exp_hom_alt > 0, np.power(obs_hom_alt - exp_hom_alt, 2) / exp_hom_alt, 0)
+        x2_het = np.where(exp_het > 0, np.power(obs_het - exp_het, 2) / exp_het, 0)
+        x2_statistic = x2_hom_ref + x2_hom_alt + x2_het
+        inbreeding_coeff = np.where(obs_het > 0, 1.0 - (obs_het / exp_het), np.nan)
+    undefined = np.isnan(aaf)
+    hwe_p_value = np.where(undefined, np.nan, stats.achisqprob(x2_statistic, 1))
+    inbreeding_coeff[undefined] = np.nan
+    return hwe_p_value, inbreeding_coeff
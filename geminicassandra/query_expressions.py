@@ -4,13 +4,34 @@ Created on Mar 16, 2015
 @author: brecht
 '''
 import abc
-from multiprocessing import Pipe
-from multiprocessing.process import Process
-from cassandra.cluster import Cluster
+from id_sets import IdSet
 import array
 import sys
+import threading
+import Queue
+import numpy as np
 from multiprocessing.synchronize import Event
 
+# values per IN restriction of a pruned Basic_expression
+PRUNE_CHUNK = 100
+# most IN queries a Basic_expression sends to look up a starting set;
+# for bigger starting sets, it scans its rows and leaves the intersection
+# to its AND_expression
+PRUNE_MAX_QUERIES = 50
+# most queries the evaluation of an expression has running at once
+# (see set_max_concurrent_queries)
+MAX_CONCURRENT_QUERIES = 32
+
+_query_slots = threading.BoundedSemaphore(MAX_CONCURRENT_QUERIES)
+
+def set_max_concurrent_queries(n):
+    """
+    Let the evaluation of expressions run at most n queries at once.
+    The queries running already release the slots they took.
+    """
+    global _query_slots
+    _query_slots = threading.BoundedSemaphore(max(1, n))
+
 class Expression(object):
     
     __metaclass__ = abc.ABCMeta
@@ -23,36 +44,63 @@ class Expression(object):
     def can_prune(self):
         return True
 
+    def get_plans(self):
+        """
+        How the Basic_expressions of the last evaluation got their rows.
+        """
+        return []
+
 class Basic_expression(Expression):
     
-    def __init__(self, from_table, select_column, where_clause):
+    def __init__(self, from_table, select_column, where_clause, prunable=None):
         self.table = from_table
         self.select_column = select_column
         self.where_clause = where_clause
+        # whether the rows can be restricted to values of select_column
+        # with an IN (see GeminiQuery.can_prune_table); without the
+        # schema, any range restriction rules it out
+        if prunable is None:
+            prunable = not any(op in where_clause for op in ["<", ">"])
+        self.prunable = prunable
+        self.plan = None
   
     def evaluate(self, socket, starting_set):
         
         if len(starting_set) == 0:
-            return set()
+            return self.empty_set()
         
         query = "SELECT %s FROM %s" % \
             (self.select_column, self.table)
         if self.where_clause != "":
             query += " WHERE %s" % self.where_clause            
-        '''if self.can_prune() and not starting_set == "*":
-            if self.table.startswith('samples'):
-                in_clause = "','".join(starting_set)            
-                query += " AND %s IN ('%s')" % \
-                    (self.select_column, in_clause)
-            else:
-                in_clause = ",".join(map(str, starting_set))            
-                query += " AND %s IN (%s)" % \
-                    (self.select_column, in_clause)   '''  
-        return async_rows_as_set(socket, query)
+        n_queries = (len(starting_set) + PRUNE_CHUNK - 1) / PRUNE_CHUNK
+        if self.can_prune() and starting_set != "*" and n_queries <= PRUNE_MAX_QUERIES:
+            # look up the rows of the starting set only
+            query += " AND " if self.where_clause != "" else " WHERE "
+            queries = [query + self._get_in_clause(chunk) for chunk in _split(starting_set, PRUNE_CHUNK)]
+            res = async_rows_of_queries(socket, queries, self.select_column == 'variant_id')
+            self.plan = "prune %s: %d values in %d IN queries, %d rows" % \
+                (self, len(starting_set), n_queries, len(res))
+        else:
+            res = async_rows_of_queries(socket, [query], self.select_column == 'variant_id')
+            self.plan = "scan %s: %d rows" % (self, len(res))
+            if starting_set != "*":
+                self.plan += " for %d values" % len(starting_set)
+        return res
+    
+    def empty_set(self):
+        return IdSet() if self.select_column == 'variant_id' else set()
     
     def can_prune(self):
-        return not any (op in self.where_clause \
-                        for op in ["<", ">"])
+        return self.prunable
+
+    def get_plans(self):
+        return [self.plan] if self.plan is not None else []
+
+    def _get_in_clause(self, values):
+        if self.select_column == 'variant_id':
+            return "%s IN (%s)" % (self.select_column, ",".join(map(str, values)))
+        return "%s IN ('%s')" % (self.select_column, "','".join(values))
 
     def __str__(self):
         return self.where_clause
@@ -68,18 +116,18 @@ class AND_expression(Expression):
         if len(starting_set) == 0:
             return set()
         
-        '''if self.right.can_prune():
-            temp = self.left.evaluate(session, starting_set)
-            return self.right.evaluate(session, temp)
-        elif self.left.can_prune():
-            temp = self.right.evaluate(session, starting_set)
-            return self.left.evaluate(session, temp)
-        else:
-            temp = self.left.evaluate(session, starting_set)
-            return temp & self.right.evaluate(session, temp)'''
-         
-        temp = self.left.evaluate(session, starting_set)
-        return temp & self.right.evaluate(session, temp)        
+        # the operands that cannot be restricted to a starting set scan
+        # their rows anyway, so they go first, concurrently; the others
+        # follow in order, each one restricted to the result so far when
+        # that is small enough (see Basic_expression.evaluate)
+        operands = get_operands(self, AND_expression)
+        res = None
+        for temp in evaluate_concurrently(session, filter(lambda x: not x.can_prune(), operands), starting_set):
+            res = temp if res is None else res & temp
+        for operand in filter(lambda x: x.can_prune(), operands):
+            temp = operand.evaluate(session, starting_set if res is None else res)
+            res = temp if res is None else res & temp
+        return res
 
     def __str__(self):
         res = "(" + str(self.left) + ")" + " AND " + "(" + str(self.right) + ")"
@@ -87,6 +135,9 @@ class AND_expression(Expression):
 
     def can_prune(self):
         return True
+
+    def get_plans(self):
+        return self.left.get_plans() + self.right.get_plans()
     
 class OR_expression(Expression):
     
@@ -97,8 +148,12 @@ class OR_expression(Expression):
     def evaluate(self, session, starting_set):
         
         if len(starting_set) == 0:
-            return set()        
-        return (self.left.evaluate(session, starting_set) | self.right.evaluate(session, starting_set))
+            return set()
+        # the operands of a chain of ORs are independent
+        res = None
+        for temp in evaluate_concurrently(session, get_operands(self, OR_expression), starting_set):
+            res = temp if res is None else res | temp
+        return res
 
     def __str__(self):
         res = "(" + str(self.left) + ")" + " OR " + "(" + str(self.right) + ")"
@@ -106,6 +161,9 @@ class OR_expression(Expression):
 
     def can_prune(self):
         return True
+
+    def get_plans(self):
+        return self.left.get_plans() + self.right.get_plans()
     
 class NOT_expression(Expression):
     
@@ -121,17 +179,12 @@ class NOT_expression(Expression):
             return set()        
         elif starting_set == '*':
             if self.table == 'variants':
-                correct_starting_set = set(range(1, self.total_nr_variants+1))
+                correct_starting_set = IdSet.range(1, self.total_nr_variants)
             else:
                 correct_starting_set = async_rows_as_set(session, "SELECT %s FROM %s" % (self.select_column, self.table))            
         else:
             correct_starting_set = starting_set
         
-        '''if self.table == 'variants' and starting_set == "*":
-            return correct_starting_set - self.body.evaluate(session, "*")
-        else:
-            return correct_starting_set - \
-                self.body.evaluate(session, correct_starting_set)'''
         return correct_starting_set - \
                 self.body.evaluate(session, correct_starting_set)
                 
@@ -140,10 +193,20 @@ class NOT_expression(Expression):
 
     def can_prune(self):
         return True
+
+    def get_plans(self):
+        return self.body.get_plans()
     
 class GT_wildcard_expression(Expression):
-    
-    def __init__(self, column, wildcard_rule, rule_enforcement, sample_names, db_contact_points, keyspace, n_variants, cores_for_eval = 1):
+    """
+    A genotype filter on a set of samples (see GeminiQuery.parse_gt_wildcard):
+    the variants for which any, all, none or a count of the samples match
+    wildcard_rule. The queries of the samples run concurrently on the
+    session, and each variant of the starting set counts the samples
+    that match it as their results arrive.
+    """
+    
+    def __init__(self, column, wildcard_rule, rule_enforcement, sample_names, n_variants):
         self.column = column
         self.wildcard_rule = wildcard_rule
         if rule_enforcement.startswith('count'):
@@ -152,9 +215,6 @@ class GT_wildcard_expression(Expression):
         else:
             self.rule_enforcement = rule_enforcement        
         self.names = sample_names
-        self.nr_cores = cores_for_eval
-        self.db_contact_points = db_contact_points
-        self.keyspace = keyspace
         self.n_variants = n_variants
         
     def __str__(self):
@@ -165,220 +225,176 @@ class GT_wildcard_expression(Expression):
     
     def evaluate(self, session, starting_set):
         
-        step = len(self.names) / self.nr_cores
-    
-        procs = []
-        conns = []
-        results = []
-        
-        invert = False
-        invert_count = False
-        if self.wildcard_rule.startswith('!'):
-            corrected_rule = self.wildcard_rule[1:]
-            if self.rule_enforcement == 'all':
-                target_rule = 'any'
-                invert = True
-            elif self.rule_enforcement == 'any':
-                target_rule = 'all'
-                invert = True
-            elif self.rule_enforcement == 'none':
-                target_rule = 'all'
-            elif self.rule_enforcement.startswith('count'):
-                target_rule = 'count'
-                invert_count = True
-        else:
-            target_rule = self.rule_enforcement
-            corrected_rule = self.wildcard_rule
-            
         if starting_set == "*":
-            correct_starting_set = range(1,self.n_variants+1)
+            correct_starting_set = IdSet.range(1, self.n_variants)
         else:
-            correct_starting_set = starting_set
-        
-        for i in range(self.nr_cores):
-            parent_conn, child_conn = Pipe()
-            conns.append(parent_conn)
-            p = Process(target=eval(target_rule +'_query'),\
-                args=(child_conn, self.column, corrected_rule, self.db_contact_points, self.keyspace))
-            procs.append(p)
-            p.start()
-        
-        #Split names in chunks and communicate to procs
-        for i in range(self.nr_cores):
-            n = len(self.names)
-            begin = i*step + min(i, n % self.nr_cores)
-            end = begin + step
-            if i < n % self.nr_cores:
-                end += 1  
-            conns[i].send(self.names[begin:end]) 
-            conns[i].send(correct_starting_set)               
-        
-        #Collect results
-        for i in range(self.nr_cores):
-            results.append(conns[i].recv())
-            conns[i].close()
-        
-        for i in range(self.nr_cores):
-            procs[i].join()
-        
-        res = set()    
-        
-        if target_rule == 'any':
-            for r in results:
-                res = res | r
-        elif target_rule in ['all', 'none']:
-            res = results[0]
-            for r in results[1:]:
-                res = res & r
-                                
+            correct_starting_set = IdSet(starting_set)
+        if len(correct_starting_set) == 0:
+            return IdSet()
+        
+        # the rows of the samples that do not match a != rule are those
+        # that match the = rule; the others (unknown genotypes too) do
+        invert = self.wildcard_rule.startswith('!')
+        rule = self.wildcard_rule[1:] if invert else self.wildcard_rule
+        queries = ["SELECT variant_id FROM variants_by_samples_%s WHERE sample_name = '%s' AND %s %s" %
+                   (self.column, name, self.column, rule) for name in self.names]
+        
+        # the number of matching samples of each variant of the starting set
+        ids = correct_starting_set.ids
+        counts = np.zeros(len(ids), dtype=np.int32)
+        for variants in iter_rows_as_ids(session, queries):
+            positions = np.minimum(np.searchsorted(ids, variants), len(ids) - 1)
+            counts[positions[ids[positions] == variants]] += 1
         if invert:
-            res = set(correct_starting_set) - res
-        
-        if target_rule == 'count':
-            res_dict = {x: 0 for x in correct_starting_set}
-            for sub_result_dict in results:
-                for var, count in sub_result_dict.iteritems():
-                    res_dict[var] += count     
-            if invert_count:
-                total = len(self.names)
-                for variant, count in res_dict.iteritems():
-                    res_dict[variant] = total - count
-            res = set([variant for variant, count in res_dict.iteritems() \
-                       if eval(str(count) + self.count_comp)])
-        
-        return res
- 
-def all_query(conn, field, clause, contact_points, keyspace):
-        
-    cluster = Cluster(contact_points)
-    session = cluster.connect(keyspace)
-    
-    names = conn.recv()
-    initial_set = conn.recv()
-  
-    results = set(initial_set)
-    
-    for name in names:
-        
-        if len(results) == 0:
-            break
-        
-        query = "SELECT variant_id FROM variants_by_samples_%s WHERE sample_name = '%s' AND %s %s " % (field, name, field, clause)
-       
-        results = async_rows_as_set(session, query) & results
-        
-    session.shutdown()   
-    
-    conn.send(results)
-    conn.close()
+            counts = len(self.names) - counts
+        
+        if self.rule_enforcement == 'any':
+            matches = counts > 0
+        elif self.rule_enforcement == 'all':
+            matches = counts == len(self.names)
+        elif self.rule_enforcement == 'none':
+            matches = counts == 0
+        else:
+            matches = eval("counts" + self.count_comp)
+        return IdSet.from_sorted(ids[matches])
+    
+def get_operands(exp, operator):
+    """
+    The operands of a chain of operator (AND_expression or OR_expression)
+    expressions, in order.
+    """
+    if not isinstance(exp, operator):
+        return [exp]
+    return get_operands(exp.left, operator) + get_operands(exp.right, operator)
 
-def any_query(conn, field, clause, contact_points, keyspace):
-        
-    cluster = Cluster(contact_points)
-    session = cluster.connect(keyspace)
-    
-    names = conn.recv()
-    initial_set = set(conn.recv())
-    
-    results = set()
-    
-    for name in names:
-        
-        query = "SELECT variant_id FROM variants_by_samples_%s WHERE sample_name = '%s' AND %s %s " % (field, name, field, clause)
-        
-        row = async_rows_as_set(session, query)
-        results = row | results
-        
-    session.shutdown()  
-    
-    results = initial_set & results 
-    
-    conn.send(results)
-    conn.close()
+def evaluate_concurrently(session, expressions, starting_set):
+    """
+    The results of expressions on starting_set, in the order they arrive:
+    each one is evaluated in a thread of its own (their queries share the
+    slots of set_max_concurrent_queries).
+    """
+    if len(expressions) == 1:
+        yield expressions[0].evaluate(session, starting_set)
+        return
+    results = Queue.Queue()
+    
+    def evaluate(exp):
+        try:
+            results.put((exp.evaluate(session, starting_set), None))
+        except:
+            results.put((None, sys.exc_info()))
+    
+    for exp in expressions:
+        thread = threading.Thread(target=evaluate, args=(exp,))
+        thread.daemon = True
+        thread.start()
+    for i in range(len(expressions)):
+        (res, error) = results.get()
+        if error:
+            raise error[0], error[1], error[2]
+        yield res
 
-def none_query(conn, field, clause, contact_points, keyspace):
-        
-    cluster = Cluster(contact_points)
-    session = cluster.connect(keyspace)
-    
-    names = conn.recv()
-    initial_set = conn.recv()
-    
-    results = set(initial_set)
-    
-    for name in names:
-        
-        query = "SELECT variant_id FROM variants_by_samples_%s WHERE sample_name = '%s' AND %s %s " % (field, name, field, clause)
-        
-        variants = async_rows_as_set(session, query)
-        results = results - variants
-        
-    session.shutdown()   
-    
-    conn.send(results)
-    conn.close()   
-    
-def count_query(conn, field, clause, contact_points, keyspace):
-    
-    cluster = Cluster(contact_points)
-    session = cluster.connect(keyspace)    
-    names = conn.recv()   
-    initial_set = set(conn.recv()) 
-    results = dict()
-    
-    for name in names:        
-        query = '''SELECT variant_id FROM variants_by_samples_%s \
-                WHERE sample_name = '%s' AND %s %s ''' % (field, name, field, clause)   
-        
-        variants = initial_set & async_rows_as_set(session, query)
-        results = add_row_to_count_dict(results, variants)
-        
-    session.shutdown()       
-    conn.send(results)
-    conn.close()
-    
-def add_row_to_count_dict(res_dict, variants):
-    
-    for var in variants:
-        if not var in res_dict:
-            res_dict[var] = 1
-        else:
-            res_dict[var] += 1    
-    return res_dict   
+def async_rows_of_queries(session, queries, ids):
+    """
+    The values in the first column of the rows of all queries, which run
+    concurrently (at most MAX_CONCURRENT_QUERIES at once, see
+    set_max_concurrent_queries), as an IdSet with ids, as a set otherwise.
+    """
+    handlers = []
+    slots = _query_slots
+    for query in queries:
+        slots.acquire()
+        try:
+            future = session.execute_async(query)
+        except:
+            slots.release()
+            raise
+        handlers.append(PagedResultHandler(future, ids, slots))
+    for (query, handler) in zip(queries, handlers):
+        handler.finished_event.wait()
+        if handler.error:
+            sys.stderr.write("Query failed: %s\n" % query)
+            raise handler.error
+    if ids:
+        values = array.array('i')
+        for handler in handlers:
+            values.extend(handler.res)
+        return IdSet(np.frombuffer(values, dtype=np.int32) if len(values) > 0 else ())
+    return set().union(*[handler.res for handler in handlers])
+
+def iter_rows_as_ids(session, queries):
+    """
+    The ids in the first column of the rows of each of queries, as int32
+    arrays, in the order the queries finish. The queries run concurrently,
+    as many at once as there are free slots (see
+    set_max_concurrent_queries).
+    """
+    done = Queue.Queue()
+    slots = _query_slots
+    pending = list(reversed(queries))
+    running = {}
+    while len(pending) > 0 or len(running) > 0:
+        # with no query of ours running, wait for a slot of another thread
+        while len(pending) > 0 and slots.acquire(len(running) == 0):
+            query = pending.pop()
+            try:
+                future = session.execute_async(query)
+            except:
+                slots.release()
+                raise
+            running[PagedResultHandler(future, True, slots, done)] = query
+        handler = done.get()
+        query = running.pop(handler)
+        if handler.error:
+            sys.stderr.write("Query failed: %s\n" % query)
+            raise handler.error
+        yield np.frombuffer(handler.res, dtype=np.int32) if len(handler.res) > 0 else np.zeros(0, dtype=np.int32)
+
+def _split(values, size):
+    values = list(values)
+    return [values[i:i + size] for i in xrange(0, len(values), size)]
 
 def async_rows_as_set(session, query):
     
-    future = session.execute_async(query)
-    handler = PagedResultHandler(future)
-    handler.finished_event.wait()
-    
-    if handler.error:
-        sys.stderr.write("Query failed: %s\n" % query)
-        raise handler.error
-    else:    
-        return handler.res
+    return async_rows_of_queries(session, [query], False)
 
 class PagedResultHandler(object):
 
-    def __init__(self, future):
+    def __init__(self, future, ids=False, slots=None, done=None):
         self.error = None
         self.finished_event = Event()
         self.future = future
+        # the ids of the rows, as int32s, or a set of the values
+        self.ids = ids
+        # released when the query is done
+        self.slots = slots
+        # a queue the handler is put on when the query is done
+        self.done = done
+        self.res = array.array('i') if ids else set()
         self.future.add_callbacks(
             callback=self.handle_page,
             errback=self.handle_error)
-        self.res = set()
 
     def handle_page(self, results):
         
-        for row in results:            
-            self.res.add(row[0])
+        if self.ids:
+            self.res.extend(row[0] for row in results)
+        else:
+            for row in results:            
+                self.res.add(row[0])
 
         if self.future.has_more_pages:
             self.future.start_fetching_next_page()
         else:
-            self.finished_event.set()
+            self.finish()
 
     def handle_error(self, exc):
         self.error = exc
+        self.finish()
+
+    def finish(self):
+        if self.slots is not None:
+            self.slots.release()
         self.finished_event.set()
+        if self.done is not None:
+            self.done.put(self)
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+"""
+Evaluation order of the query expressions of a --where and --gt-filter.
+
+parse_clause builds the expression tree in the order of the text, and an
+AND_expression evaluates its left side first and restricts its right side
+to the result. A filter like
+
+    gt_types.X == HOM_REF && gt_types.Y == HET
+
+then scans the (huge) HOM_REF rows of X before the few HET rows of Y. The
+QueryPlanner estimates the number of variants that match each expression
+and reorders the operands of AND, the most selective first:
+
+ - a genotype filter on one sample (sample_name = 'X' AND gt_types ...)
+   matches as many variants as X has genotypes of the matching types, by
+   the sample_genotype_counts the loader keeps;
+ - a NOT matches the variants its body does not, an AND at most as many
+   as its most selective operand, an OR at most the sum of its operands;
+ - a wildcard on gt_types is estimated from the counts of its samples
+   (any: their sum, all: their minimum, none: the variants the sample
+   with the most matches does not have). Count wildcards and the other
+   filters have no estimate, and keep their place after the ones that do.
+
+Chains of ANDs are flattened, sorted and rebuilt left-deep, so that
+each operand is restricted to the result of the more selective ones
+before it. The operands of an OR are evaluated concurrently and their
+results united (see OR_expression.evaluate), so their order does not
+matter and is kept. explain() describes the plan with its estimates
+(--explain).
+"""
+import re
+
+from cassandra import InvalidRequest
+from cassandra.query import tuple_factory
+
+from gemini_constants import HOM_REF, HET, HOM_ALT, UNKNOWN
+from query_expressions import Basic_expression, AND_expression, OR_expression, \
+    NOT_expression, GT_wildcard_expression, get_operands
+
+# the genotype filter on one sample gt_filter_to_query_exp makes
+_GT_TYPES_FILTER = re.compile(r"^sample_name = '(.*)' AND gt_types\s*(!=|<=|>=|=|<|>)\s*(-?\d+)\s*$")
+
+# the rule of a genotype wildcard (see GeminiQuery.parse_gt_wildcard)
+_WILDCARD_RULE = re.compile(r"^(!=|<=|>=|=|<|>)\s*(-?\d+)$")
+
+_COMPARISONS = {'=': lambda x, y: x == y,
+                '!=': lambda x, y: x != y,
+                '<': lambda x, y: x < y,
+                '<=': lambda x, y: x <= y,
+                '>': lambda x, y: x > y,
+                '>=': lambda x, y: x >= y}
+
+
+class QueryPlanner(object):
+    """
+    Estimates and evaluation order of the expressions of a query on the
+    variants of a keyspace with n_variants variants. The genotype counts
+    of the samples are read from the database when first needed.
+    """
+    def __init__(self, session, n_variants):
+        self.session = session
+        self.n_variants = n_variants
+        self.gt_counts = None
+
+    def plan(self, exp):
+        """
+        The expression exp, with the operands of its ANDs in order of
+        increasing estimate.
+        """
+        if isinstance(exp, AND_expression):
+            operands = [self.plan(operand) for operand in get_operands(exp, AND_expression)]
+            # stable: the operands without an estimate keep their order
+            operands.sort(key=lambda operand: _sort_key(self.estimate(operand)))
+            res = operands[0]
+            for operand in operands[1:]:
+                res = AND_expression(res, operand)
+            return res
+        if isinstance(exp, OR_expression):
+            exp.left = self.plan(exp.left)
+            exp.right = self.plan(exp.right)
+            return exp
+        if isinstance(exp, NOT_expression):
+            exp.body = self.plan(exp.body)
+        return exp
+
+    def estimate(self, exp):
+        """
+        The estimated number of variants exp matches, None if unknown.
+        """
+        if isinstance(exp, Basic_expression):
+            return self._estimate_basic(exp)
+        if isinstance(exp, NOT_expression):
+            body = self.estimate(exp.body)
+            return None if body is None or exp.table != 'variants' else self.n_variants - body
+        if isinstance(exp, AND_expression):
+            known = filter(lambda x: x is not None, [self.estimate(exp.left), self.estimate(exp.right)])
+            return min(known) if len(known) > 0 else None
+        if isinstance(exp, OR_expression):
+            (left, right) = (self.estimate(exp.left), self.estimate(exp.right))
+            return None if left is None or right is None else min(self.n_variants, left + right)
+        if isinstance(exp, GT_wildcard_expression):
+            return self._estimate_wildcard(exp)
+        return None
+
+    def explain(self, exp, depth=0):
+        """
+        The lines that describe the plan of exp, with the estimates.
+        """
+        estimate = self.estimate(exp)
+        estimate = "?" if estimate is None else "~%d" % estimate
+        indent = "  " * depth
+        if isinstance(exp, Basic_expression):
+            how = "prune or scan" if exp.can_prune() else "scan"
+            return ["%s%s on %s (%s): %s variants" % (indent, exp, exp.table, how, estimate)]
+        if isinstance(exp, NOT_expression):
+            return ["%sNOT: %s variants" % (indent, estimate)] + self.explain(exp.body, depth + 1)
+        if isinstance(exp, (AND_expression, OR_expression)):
+            name = "AND" if isinstance(exp, AND_expression) else "OR"
+            res = ["%s%s: %s variants" % (indent, name, estimate)]
+            for operand in get_operands(exp, exp.__class__):
+                res += self.explain(operand, depth + 1)
+            return res
+        return ["%s%s: %s variants" % (indent, exp, estimate)]
+
+    def _estimate_basic(self, exp):
+        if exp.table != 'variants_by_samples_gt_types':
+            return None
+        match = _GT_TYPES_FILTER.match(exp.where_clause)
+        if match is None:
+            return None
+        (sample, op, value) = match.groups()
+        # the table has no rows for the unknown genotypes
+        return self._count_matches(sample, op, int(value), [HOM_REF, HET, HOM_ALT])
+
+    def _estimate_wildcard(self, exp):
+        match = _WILDCARD_RULE.match(exp.wildcard_rule)
+        if exp.column != 'gt_types' or match is None or exp.rule_enforcement == 'count':
+            return None
+        (op, value) = match.groups()
+        if op == '!=':
+            # evaluated as the variants that do not match = value
+            counts = [self._count_matches(name, '=', int(value), [HOM_REF, HET, HOM_ALT])
+                      for name in exp.names]
+            counts = [None if count is None else self.n_variants - count for count in counts]
+        else:
+            counts = [self._count_matches(name, op, int(value), [HOM_REF, HET, HOM_ALT])
+                      for name in exp.names]
+        if len(counts) == 0 or None in counts:
+            return None
+        if exp.rule_enforcement == 'any':
+            return min(self.n_variants, sum(counts))
+        if exp.rule_enforcement == 'all':
+            return min(counts)
+        return self.n_variants - max(counts)
+
+    def _count_matches(self, sample, op, value, gt_types):
+        """
+        The number of variants for which the genotype of sample (one of
+        gt_types) compares to value with op, None without its counts.
+        """
+        counts = self._get_gt_counts().get(sample)
+        if counts is None:
+            return None
+        return sum(counts[gt_type] for gt_type in gt_types if _COMPARISONS[op](gt_type, value))
+
+    def _get_gt_counts(self):
+        """
+        The genotype counts of the samples, by name: a dict of gt_type
+        (HOM_REF, ...) to count.
+        """
+        if self.gt_counts is None:
+            self.gt_counts = {}
+            # GeminiQuery switches the session to dict rows while it runs
+            self.session.row_factory = tuple_factory
+            try:
+                names = dict((row[1], row[0]) for row in
+                             self.session.execute("SELECT name, sample_id FROM samples"))
+                for row in self.session.execute('''SELECT sample_id, num_hom_ref, num_het, num_hom_alt,
+                                                   num_unknown FROM sample_genotype_counts'''):
+                    # the counters are keyed by the index of the sample
+                    if row[0] + 1 in names:
+                        self.gt_counts[names[row[0] + 1]] = {HOM_REF: row[1] or 0, HET: row[2] or 0,
+                                                             HOM_ALT: row[3] or 0, UNKNOWN: row[4] or 0}
+            except InvalidRequest:
+                # a keyspace without genotype counts: no estimates
+                pass
+        return self.gt_counts
+
+
+def _sort_key(estimate):
+    return (estimate is None, estimate)
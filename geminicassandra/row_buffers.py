@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+"""
+Compact buffers of the rows the loader hands to its writer stage.
+
+The loader used to buffer every row as a Python list: a variant row with
+its 8 x n_samples genotype columns, and three genotype index rows per
+sample and variant. With wide cohorts and big buffers, these boxed values
+took several GB per process. A RowBuffers keeps the genotypes of a buffer
+of variants in numpy arrays instead, one value per sample and field, and
+only builds the rows when the writer sends them:
+
+ - the wide genotype columns (gts_<sample>, ...) of the variants, in
+   arrays of shape (variants, samples), the gt_bases as codes of the
+   distinct values of the buffer; packed genotypes are packed into
+   their blobs right away, which are compact already;
+ - the rows of the genotype index tables (variant, sample, gt_type,
+   gt_depth, gt_bases), one per called sample, in flat arrays;
+ - the other rows (variants, impacts, ...) as tuples.
+
+The genotypes of the records cyvcf parsed (see genotype_parser) may hold
+values the arrays cannot (None, floats), so they are kept as rows.
+
+The arrays are allocated when first needed and grow when full; the
+loader reuses the buffers once the writer has written them (clear()).
+"""
+import numpy as np
+
+from compression import pack_genotype_column
+from genotype_parser import GT_FIELDS
+from gemini_constants import UNKNOWN
+
+# numpy dtypes of the wide genotype columns, in the order of GT_FIELDS
+# (those of genotype_parser); the gt_bases are codes
+WIDE_DTYPES = [np.int32, np.int8, np.int8, np.int32, np.int32, np.int32, np.float64, np.float64]
+
+# the columns of the genotype index rows, with their numpy dtypes
+INDEX_DTYPES = [('variant_id', np.int32), ('sample', np.int32), ('gt_types', np.int8),
+                ('gt_depths', np.int32), ('gts', np.int32)]
+
+
+class RowBuffers(object):
+    """
+    The rows of one buffer of variants of a loader, for the samples
+    samples. With packed, the genotype columns are packed blobs (see
+    compression.pack_genotype_column). Without genotypes (load
+    --no-genotypes), samples and gt_column_names are empty and the
+    variant rows have no genotype columns.
+    """
+    def __init__(self, samples, gt_column_names, packed, capacity):
+        self.samples = samples
+        self.gt_column_names = gt_column_names
+        self.packed = packed
+        # the number of variants the arrays are allocated for at first
+        self.capacity = max(1, capacity)
+        # (variant_id, field) arrays of shape (variants, samples), and
+        # (variant_id, sample, ...) arrays of the called samples
+        self.wide = None
+        self.index = None
+        self.clear()
+
+    def clear(self):
+        """
+        Empty the buffers, keeping their arrays for the next variants.
+        """
+        self.variants = []
+        self.impacts = []
+        self.subtypes = []
+        self.genes = []
+        self.chrom_starts = []
+        # the gt columns of the new samples of variants loaded before (--append)
+        self.variant_gts = []
+        # per variant: its row in the wide arrays, its gt columns when
+        # cyvcf parsed them, or None without genotypes
+        self.wide_rows = []
+        self.n_wide = 0
+        self.n_index = 0
+        # the genotype index rows of the records cyvcf parsed
+        self.slow_index_rows = []
+        # the distinct gt_bases of the buffer and their codes
+        self.bases_values = []
+        self.bases_codes = {}
+
+    def __len__(self):
+        return len(self.variants)
+
+    def add_variant(self, row, genotypes):
+        """
+        Add a variant row (without its genotype columns) and the genotypes
+        of its samples (a genotype_parser.Genotypes, None if they are not
+        loaded).
+        """
+        row = tuple(row)
+        if self.packed or genotypes is None:
+            if genotypes is None:
+                gt_columns = (None,) * len(self.gt_column_names)
+            else:
+                gt_columns = tuple(map(pack_genotype_column, self.gt_column_names, genotypes.columns))
+            self.variants.append(row + gt_columns)
+            self.wide_rows.append(None)
+        elif not genotypes.fast:
+            self.variants.append(row)
+            self.wide_rows.append(genotypes.column_values())
+        else:
+            self.variants.append(row)
+            self.wide_rows.append(self._add_wide(genotypes))
+
+    def add_genotypes(self, variant_id, genotypes, samples=None):
+        """
+        Add the genotype index rows of the called samples of a variant, or
+        of those of its samples at the indexes samples.
+        """
+        if not genotypes.fast:
+            selected = None if samples is None else set(samples)
+            for (i, gt_type, gt_depth, gt_bases) in genotypes.called():
+                if selected is None or i in selected:
+                    self.slow_index_rows.append((variant_id, self.samples[i], gt_type, gt_depth, gt_bases))
+            return
+        called = genotypes.gt_types != UNKNOWN
+        if samples is not None:
+            new = np.zeros(len(called), dtype=bool)
+            new[samples] = True
+            called &= new
+        called = np.flatnonzero(called)
+        n_rows = len(called)
+        self._reserve_index(self.n_index + n_rows)
+        rows = slice(self.n_index, self.n_index + n_rows)
+        (variant_ids, sample_idx, gt_types, gt_depths, gts) = self.index
+        variant_ids[rows] = variant_id
+        sample_idx[rows] = called
+        gt_types[rows] = genotypes.gt_types[called]
+        gt_depths[rows] = genotypes.gt_depths[called]
+        gts[rows] = self._get_bases_codes(genotypes)[called]
+        self.n_index += n_rows
+
+    def variant_rows(self):
+        """
+        The rows of the variants, with their genotype columns.
+        """
+        for (row, wide_row) in zip(self.variants, self.wide_rows):
+            if wide_row is None:
+                yield row
+            elif isinstance(wide_row, list):
+                yield row + tuple(value for values in wide_row for value in values)
+            else:
+                gt_columns = [self.wide[0][wide_row].tolist()]
+                gt_columns[0] = [self.bases_values[code] for code in gt_columns[0]]
+                gt_columns.extend(values[wide_row].tolist() for values in self.wide[1:])
+                yield row + tuple(value for values in gt_columns for value in values)
+
+    def index_batches(self, column, key_column, max_rows):
+        """
+        The (variant_id, sample, value) rows of the genotype index table of
+        column (gt_types, gt_depths or gts), in lists of at most max_rows
+        rows that share the partition key in key_column (0 for the
+        variant, 1 for the sample), as gemini_load_chunk._partition_batches
+        makes them. The rows of the records cyvcf parsed are not included
+        (see slow_rows).
+        """
+        if self.n_index == 0:
+            return
+        (variant_ids, sample_idx) = (self.index[0][:self.n_index], self.index[1][:self.n_index])
+        values = self.index[[name for (name, dtype) in INDEX_DTYPES].index(column)][:self.n_index]
+        # the rows are in the order of the variants; a stable sort keeps
+        # it within the partitions of a sample
+        keys = variant_ids if key_column == 0 else sample_idx
+        order = np.argsort(keys, kind='mergesort') if key_column == 1 else np.arange(self.n_index)
+        sorted_keys = keys[order]
+        starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]])
+        ends = np.r_[starts[1:], self.n_index]
+        for (start, end) in zip(starts.tolist(), ends.tolist()):
+            for batch_start in xrange(start, end, max_rows):
+                rows = order[batch_start:min(end, batch_start + max_rows)]
+                batch_values = values[rows].tolist()
+                if column == 'gts':
+                    batch_values = [self.bases_values[code] for code in batch_values]
+                yield [[variant_id, self.samples[sample], value] for (variant_id, sample, value)
+                       in zip(variant_ids[rows].tolist(), sample_idx[rows].tolist(), batch_values)]
+
+    def slow_rows(self, column):
+        """
+        The (variant_id, sample, value) rows of the genotype index table of
+        column of the records cyvcf parsed.
+        """
+        i = [name for (name, dtype) in INDEX_DTYPES].index(column)
+        return [[row[0], row[1], row[i]] for row in self.slow_index_rows]
+
+    def nbytes(self):
+        """
+        The bytes allocated for the arrays.
+        """
+        return sum(values.nbytes for values in (self.wide or []) + (self.index or []))
+
+    def _add_wide(self, genotypes):
+        if self.wide is None:
+            self.wide = [np.empty((self.capacity, len(self.samples)), dtype=dtype) for dtype in WIDE_DTYPES]
+        elif self.n_wide == len(self.wide[0]):
+            self.wide = [_grow(values, 2 * len(values)) for values in self.wide]
+        row = self.n_wide
+        self.wide[0][row] = self._get_bases_codes(genotypes)
+        for (values, field) in zip(self.wide[1:], GT_FIELDS[1:]):
+            values[row] = getattr(genotypes, field)
+        self.n_wide += 1
+        return row
+
+    def _reserve_index(self, n_rows):
+        if self.index is None:
+            size = max(n_rows, self.capacity * len(self.samples))
+            self.index = [np.empty(size, dtype=dtype) for (name, dtype) in INDEX_DTYPES]
+        elif n_rows > len(self.index[0]):
+            self.index = [_grow(values, max(n_rows, 2 * len(values))) for values in self.index]
+
+    def _get_bases_codes(self, genotypes):
+        """
+        The codes of the gt_bases of the samples.
+        """
+        codes = []
+        for value in genotypes.bases_values:
+            if value not in self.bases_codes:
+                self.bases_codes[value] = len(self.bases_values)
+                self.bases_values.append(value)
+            codes.append(self.bases_codes[value])
+        return np.array(codes, dtype=np.int32)[genotypes.bases_index]
+
+
+def _grow(values, size):
+    grown = np.empty((size,) + values.shape[1:], dtype=values.dtype)
+    grown[:len(values)] = values
+    return grown
@@ -6,6 +6,8 @@ http://www.nmr.mgh.harvard.edu/Neural_Systems_Group/gary/python/stats.py
 """
 import math
 
+import numpy as np
+
 def zprob(z):
     """
     Returns the area under the normal curve 'to the left of' the given z value.
@@ -105,4 +107,86 @@ def lchisqprob(chisq,df):
                 z = z + 1.0
             return (c*y+s)
     else:
-        return s
\ No newline at end of file
+        return s
+
+
+def azprob(z):
+    """
+    Array version of zprob: the area under the normal curve 'to the
+    left of' each of the given z values, with the same approximation.
+
+    Usage:   azprob(z)
+    """
+    Z_MAX = 6.0    # maximum meaningful z-value
+    z = np.asarray(z, dtype=np.float64)
+    y = 0.5 * np.fabs(z)
+    w = y*y
+    x_small = ((((((((0.000124818987 * w
+                      -0.001075204047) * w +0.005198775019) * w
+                    -0.019198292004) * w +0.059054035642) * w
+                  -0.151968751364) * w +0.319152932694) * w
+                -0.531923007300) * w +0.797884560593) * y * 2.0
+    u = y - 2.0
+    x_large = (((((((((((((-0.000045255659 * u
+                           +0.000152529290) * u -0.000019538132) * u
+                         -0.000676904986) * u +0.001390604284) * u
+                       -0.000794620820) * u -0.002034254874) * u
+                     +0.006549791214) * u -0.010557625006) * u
+                   +0.011630447319) * u -0.009279453341) * u
+                 +0.005353579108) * u -0.002141268741) * u
+               +0.000535310849) * u +0.999936657524
+    x = np.where(y >= (Z_MAX*0.5), 1.0, np.where(y < 1.0, x_small, x_large))
+    x = np.where(z == 0.0, 0.0, x)
+    return np.where(z > 0.0, (x+1.0)*0.5, (1.0-x)*0.5)
+
+
+def achisqprob(chisq, df):
+    """
+    Array version of lchisqprob: the (1-tailed) probability values
+    associated with the given chi-square values, all with the same df.
+
+    Usage:   achisqprob(chisq,df)
+    """
+    BIG = 20.0
+    def ex(x):
+        return np.where(x < -BIG, 0.0, np.exp(np.maximum(x, -BIG)))
+
+    chisq = np.asarray(chisq, dtype=np.float64)
+    if df < 1:
+        return np.ones(chisq.shape)
+    # the values of the chisq <= 0 entries are replaced by 1.0 at the end
+    with np.errstate(divide='ignore', invalid='ignore'):
+        a = 0.5 * chisq
+        even = (df % 2 == 0)
+        y = ex(-a)
+        if even:
+            s = y
+        else:
+            s = 2.0 * azprob(-np.sqrt(chisq))
+        if df > 2:
+            half_df = 0.5 * (df - 1.0)
+            # a > BIG
+            if even:
+                e = 0.0
+            else:
+                e = math.log(math.sqrt(math.pi))
+            c = np.log(a)
+            s_big = s
+            z = 1.0 if even else 0.5
+            while (z <= half_df):
+                e = math.log(z) + e
+                s_big = s_big + ex(c*z-a-e)
+                z = z + 1.0
+            # a <= BIG
+            if even:
+                e = 1.0
+            else:
+                e = 1.0 / math.sqrt(math.pi) / np.sqrt(a)
+            c = 0.0
+            z = 1.0 if even else 0.5
+            while (z <= half_df):
+                e = e * (a/float(z))
+                c = c + e
+                z = z + 1.0
+            s = np.where(a > BIG, s_big, c*y+s)
+        return np.where(chisq <= 0, 1.0, s)
@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+"""
+Adaptive control of the writes of the loader.
+
+An AdaptiveWriter keeps a window of requests in flight whose size
+follows AIMD: it grows by one request per window of successful
+requests and is halved when the cluster signals overload (timeouts,
+unavailable replicas, overloaded coordinators). A request that failed on
+such a transient error is retried on its own, after a jittered
+exponential backoff, instead of resubmitting everything it was sent
+with; any other error (an invalid request, a value of the wrong type)
+could never succeed and is raised. A request that still fails after
+MAX_RETRIES retries is appended to a replay file, which
+`geminicassandra load --replay` writes to the cluster later. A replay file
+is named after, and starts with, the keyspace its requests are for, and
+is only replayed into that keyspace.
+"""
+import os
+import sys
+import errno
+import glob
+import time
+import heapq
+import random
+import cPickle
+from collections import deque
+
+import cassandra
+from cassandra.cluster import NoHostAvailable
+from cassandra.protocol import OverloadedErrorMessage
+from cassandra.query import BatchStatement, BatchType
+
+from database_cassandra import get_session
+
+INITIAL_IN_FLIGHT = 32
+MIN_IN_FLIGHT = 1
+MAX_IN_FLIGHT = 256
+MAX_RETRIES = 8
+# the backoff before retry n is uniform in [0, min(MAX_BACKOFF, BASE_BACKOFF * 2^n)] s
+BASE_BACKOFF = 0.1
+MAX_BACKOFF = 10.0
+
+# errors that mean the cluster cannot keep up
+OVERLOAD_ERRORS = (cassandra.WriteTimeout, cassandra.OperationTimedOut, cassandra.Unavailable,
+                   OverloadedErrorMessage, NoHostAvailable)
+# errors after which a request is retried; others are raised
+RETRY_ERRORS = OVERLOAD_ERRORS + (cassandra.ReadTimeout,)
+
+REPLAY_DIR = "loading_logs"
+
+
+class AdaptiveWriter(object):
+    """
+    Executes prepared inserts, each with one row of values or, as an
+    UNLOGGED batch, with several rows. execute() returns as soon as the
+    request is sent (or waits for room in the window); wait() returns
+    once every request has succeeded or gone to the replay file.
+    """
+    def __init__(self, session, replay_file, log=None):
+        self.session = session
+        self.replay_file = replay_file
+        self.log = log
+        self.window = float(INITIAL_IN_FLIGHT)
+        # (request, send time, future), oldest first
+        self.in_flight = deque()
+        # (time it may be sent again, sequence number, request)
+        self.backlog = []
+        self.sequence = 0
+        self.last_decrease = 0.0
+        self.requests = 0
+        self.retries = 0
+        self.decreases = 0
+        self.replayed_rows = 0
+
+    def execute(self, query, rows):
+        self._send_ready_retries()
+        while len(self.in_flight) >= int(self.window):
+            self._collect_oldest()
+            self._send_ready_retries()
+        self.requests += 1
+        self._send((query, rows, 0))
+
+    def wait(self):
+        while len(self.in_flight) > 0 or len(self.backlog) > 0:
+            if len(self.in_flight) > 0:
+                self._collect_oldest()
+            else:
+                time.sleep(max(0.0, self.backlog[0][0] - time.time()))
+            self._send_ready_retries()
+
+    def close(self):
+        self.replay_file.close()
+
+    def _send(self, request):
+        (query, rows, attempt) = request
+        if len(rows) == 1:
+            statement = query.bind(rows[0])
+        else:
+            statement = BatchStatement(batch_type=BatchType.UNLOGGED)
+            for row in rows:
+                statement.add(query, row)
+        self.in_flight.append((request, time.time(), self.session.execute_async(statement)))
+
+    def _send_ready_retries(self):
+        now = time.time()
+        while len(self.backlog) > 0 and self.backlog[0][0] <= now and \
+              len(self.in_flight) < int(self.window):
+            self._send(heapq.heappop(self.backlog)[2])
+
+    def _collect_oldest(self):
+        (request, sent, future) = self.in_flight.popleft()
+        try:
+            future.result()
+            self.window = min(MAX_IN_FLIGHT, self.window + 1.0 / self.window)
+        except RETRY_ERRORS as e:
+            if isinstance(e, OVERLOAD_ERRORS) and sent > self.last_decrease:
+                # requests sent before the previous decrease saw the old
+                # window, they do not halve it again
+                self.window = max(MIN_IN_FLIGHT, self.window / 2)
+                self.last_decrease = time.time()
+                self.decreases += 1
+            self._retry(request, e)
+
+    def _retry(self, request, error):
+        (query, rows, attempt) = request
+        if attempt < MAX_RETRIES:
+            if attempt == 0:
+                self._log("retry::%s::%s;%d rows\n" % (type(error).__name__, query.query_string, len(rows)))
+            self.retries += 1
+            backoff = random.uniform(0, min(MAX_BACKOFF, BASE_BACKOFF * 2 ** attempt))
+            self.sequence += 1
+            heapq.heappush(self.backlog, (time.time() + backoff, self.sequence, (query, rows, attempt + 1)))
+        else:
+            self._log("replay::%s::%s;%d rows\n" % (type(error).__name__, query.query_string, len(rows)))
+            self.replay_file.write(query.query_string, rows)
+            self.replayed_rows += len(rows)
+
+    def _log(self, message):
+        if self.log is not None:
+            self.log.write(message)
+            self.log.flush()
+
+    def report(self):
+        return "%d requests, %d retries, %d window decreases (window now %d), %d rows to %s" % \
+            (self.requests, self.retries, self.decreases, int(self.window), self.replayed_rows,
+             self.replay_file.path)
+
+
+class ReplayFile(object):
+    """
+    Append-only file of the (query string, rows) of failed requests on
+    keyspace, after a {'keyspace': keyspace} header. Each record is
+    flushed to disk when it is written, so it survives a crash of the
+    loader; the file is only created once something fails.
+    """
+    def __init__(self, path, keyspace):
+        self.path = path
+        self.keyspace = keyspace
+        self.handle = None
+
+    def write(self, query_string, rows):
+        if self.handle is None:
+            new = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+            self.handle = open(self.path, "ab")
+            if new:
+                cPickle.dump({'keyspace': self.keyspace}, self.handle, 2)
+        cPickle.dump((query_string, [list(row) for row in rows]), self.handle, 2)
+        self.handle.flush()
+        os.fsync(self.handle.fileno())
+
+    def close(self):
+        if self.handle is not None:
+            self.handle.close()
+            self.handle = None
+
+
+def get_replay_file(keyspace):
+    """
+    The replay file of this process, for the requests on keyspace. The
+    keyspace is part of its name, so a later process with the same pid
+    that loads another keyspace does not append to it.
+    """
+    return ReplayFile(os.path.join(REPLAY_DIR, "%s.%d.replay" % (keyspace, os.getpid())), keyspace)
+
+
+def _replay_file_pid(path):
+    """
+    The pid of the process that wrote a replay file (named
+    <keyspace>.<pid>.replay, or <pid>.replay before replay files were
+    named after their keyspace).
+    """
+    name = os.path.basename(path)
+    name = name[:name.index(".replay")]
+    return int(name.split(".")[-1])
+
+
+def _is_running(pid):
+    if pid == os.getpid():
+        # the file of a process that had our pid before us
+        return False
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def read_replay_keyspace(path):
+    """
+    The keyspace of a replay file, None for the files written before
+    replay files had one.
+    """
+    with open(path, "rb") as handle:
+        try:
+            header = cPickle.load(handle)
+        except (EOFError, cPickle.UnpicklingError):
+            return None
+    return header['keyspace'] if isinstance(header, dict) else None
+
+
+def read_replay_file(path):
+    """
+    Yield the (query string, rows) records of a replay file. A record
+    cut short by a crash while it was written is skipped.
+    """
+    with open(path, "rb") as handle:
+        while True:
+            try:
+                record = cPickle.load(handle)
+                # the header
+                if isinstance(record, dict):
+                    continue
+                yield record
+            except EOFError:
+                return
+            except cPickle.UnpicklingError:
+                sys.stderr.write("WARNING: skipping the truncated end of %s.\n" % path)
+                return
+
+
+def replay(args):
+    """
+    Write the requests of the replay files of keyspace args.keyspace (see
+    load --replay); those of other keyspaces are left for a replay into
+    theirs, and those of loads that are still running are left until they
+    have finished. Each file is renamed to *.draining while it is written
+    and removed afterwards; requests that fail again go to this process's
+    replay file. Replaying a file twice is harmless, as the inserts are
+    idempotent.
+    """
+    paths = sorted(glob.glob(os.path.join(REPLAY_DIR, "*.replay")) +
+                   glob.glob(os.path.join(REPLAY_DIR, "*.replay.draining")))
+    keyspaces = dict((path, read_replay_keyspace(path)) for path in paths)
+    for path in paths:
+        if keyspaces[path] is None:
+            sys.stderr.write("WARNING: %s does not record its keyspace, replaying it into %s.\n" %
+                             (path, args.keyspace))
+        elif keyspaces[path] != args.keyspace:
+            sys.stderr.write("%s is for keyspace %s, not replaying it into %s.\n" %
+                             (path, keyspaces[path], args.keyspace))
+    paths = [path for path in paths if keyspaces[path] in (None, args.keyspace)]
+    running = [path for path in paths if not path.endswith(".draining") and _is_running(_replay_file_pid(path))]
+    for path in running:
+        sys.stderr.write("%s is written by a load that is still running (pid %d), not replaying it.\n" %
+                         (path, _replay_file_pid(path)))
+    paths = [path for path in paths if path not in running]
+    if len(paths) == 0:
+        sys.stderr.write("Nothing to replay into %s in %s.\n" % (args.keyspace, REPLAY_DIR))
+        return
+    session = get_session(args.contact_points, args.keyspace)
+    replay_file = get_replay_file(args.keyspace)
+    writer = AdaptiveWriter(session, replay_file, sys.stderr)
+    queries = {}
+    for path in paths:
+        if not path.endswith(".draining"):
+            os.rename(path, path + ".draining")
+            path += ".draining"
+        rows_replayed = 0
+        for (query_string, rows) in read_replay_file(path):
+            if query_string not in queries:
+                queries[query_string] = session.prepare(query_string)
+            writer.execute(queries[query_string], rows)
+            rows_replayed += len(rows)
+        writer.wait()
+        os.remove(path)
+        sys.stderr.write("%s: %d rows replayed.\n" % (path[:-len(".draining")], rows_replayed))
+    replay_file.close()
+    sys.stderr.write("Replay: %s.\n" % writer.report())
+    session.cluster.shutdown()
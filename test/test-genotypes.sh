@@ -209,3 +209,62 @@ geminicassandra query -q "select chrom, end, ref, alt, \
        > obs
 check obs exp
 rm obs exp
+
+####################################################################
+# 9. Test the genotype columns of a keyspace loaded with
+#    --packed-genotypes: the queries of 1.-8. give the same output
+#    as on the keyspace with a column per sample
+####################################################################
+check_packed()
+{
+	geminicassandra query "$@" --test-mode -db $cassandra_ips -ks test_snpeff_vcf_db > exp
+	geminicassandra query "$@" --test-mode -db $cassandra_ips -ks test_snpeff_vcf_packed_db > obs
+	check obs exp
+	rm obs exp
+}
+
+echo "    genotypes.t09...\c"
+check_packed -q "select gts_1094pc0005, gts_1094pc0009, \
+				gts_1094PC0012, gts_1094PC0013 \
+				from variants"
+
+echo "    genotypes.t10...\c"
+check_packed -q "select gt_types_1094pc0005, gt_types_1094pc0009, \
+	                    gt_types_1094pc0012, gt_types_1094pc0013 \
+	             from variants"
+
+echo "    genotypes.t11...\c"
+check_packed -q "select gt_types_1094pc0005, gt_types_1094pc0009, \
+	                    gt_types_1094pc0012, gt_types_1094pc0013 \
+	             from variants" \
+			 --gt-filter "gt_types.1094PC0012 == HET"
+
+echo "    genotypes.t12...\c"
+check_packed -q "select chrom, end, ref, alt, \
+	                    gt_types_1094pc0005, gt_types_1094pc0009, \
+	                    gt_types_1094pc0012, gt_types_1094pc0013 \
+	             from variants" \
+			 --gt-filter "(gt_types.1094PC0012 == HET || \
+						   gt_types.1094PC0005 == HET)" \
+			 --header
+
+echo "    genotypes.t13...\c"
+check_packed -q "select chrom, end, ref, alt, \
+	                    gt_depths_1094pc0005, gt_ref_depths_1094pc0009, \
+	                    gt_alt_depths_1094pc0012, gt_quals_1094pc0013 \
+	             from variants" \
+			 --header
+
+echo "    genotypes.t14...\c"
+check_packed -q "select * from variants" --header
+
+# the genotype qualities of chr1:30895 are all non-integral (8.58, 29.23,
+# 18.04, 12.03), so they print as the floats of the per-sample columns
+# only if the packed values are unpacked to Python floats too
+echo "    genotypes.t15...\c"
+check_packed -q "select chrom, end, \
+	                    gt_quals_1094pc0005, gt_quals_1094pc0009, \
+	                    gt_quals_1094pc0012, gt_quals_1094pc0013 \
+	             from variants" \
+			 --gt-filter "gt_types.1094PC0005 == HET" \
+			 --header
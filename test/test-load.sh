@@ -74,3 +74,99 @@ echo "chr1	1334051	CTAGAG	C" > exp
 geminicassandra query -q "select chrom, start, ref, alt from variants" -db $cassandra_ips -ks passonly_db --test-mode > obs
 check obs exp
 rm obs exp
+
+###########################################################################################
+#5. Test loading a file with genotypes without its genotypes, on one and on several cores
+###########################################################################################
+geminicassandra load -v test.comp_het.vcf --skip-gene-tables --skip-gerp-bp --skip-cadd --no-genotypes \
+	-db $cassandra_ips -ks comp_het_no_gts_db
+geminicassandra load -v test.comp_het.vcf --skip-gene-tables --skip-gerp-bp --skip-cadd --no-genotypes \
+	--cores 2 -db $cassandra_ips -ks comp_het_no_gts_cores_db
+
+echo "chr1	16976	G	A
+chr1	17221	A	G
+chr1	17362	TTCT	T
+chr1	17562	G	A
+chr1	17696	G	C
+chr1	17721	A	G
+chr1	17729	C	A
+chr1	17745	A	G" > exp
+
+echo "    load.t5...\c"
+geminicassandra query -q "select chrom, start, ref, alt from variants" -db $cassandra_ips -ks comp_het_no_gts_db --test-mode > obs
+check obs exp
+rm obs
+
+echo "    load.t6...\c"
+geminicassandra query -q "select chrom, start, ref, alt from variants" -db $cassandra_ips -ks comp_het_no_gts_cores_db --test-mode > obs
+check obs exp
+rm obs exp
+
+###########################################################################################
+#7. Test resuming an interrupted load with a different --chunk-size and --cores: the load
+#   goes on with the chunks it started with, so its variants and genotype counts are those
+#   of an uninterrupted load. The first load stops after 3 of its 88 buffers.
+###########################################################################################
+geminicassandra load -v test.query.vcf --skip-gene-tables --skip-gerp-bp --skip-cadd --test-mode \
+	-db $cassandra_ips -ks resume_reference_db
+geminicassandra load -v test.query.vcf --skip-gene-tables --skip-gerp-bp --skip-cadd \
+	--test-mode --buffer-size 10 --stop-after-buffers 3 -db $cassandra_ips -ks resume_db
+geminicassandra load -v test.query.vcf --skip-gene-tables --skip-gerp-bp --skip-cadd --test-mode \
+	--buffer-size 10 --resume --cores 2 --chunk-size 100 -db $cassandra_ips -ks resume_db > resume.out
+
+echo "    load.t7...\c"
+echo "Resuming the load of test.query.vcf." > exp
+grep "^Resuming the load" resume.out > obs
+check obs exp
+rm obs exp resume.out
+
+echo "    load.t8...\c"
+geminicassandra query -q "select chrom, start, ref, alt from variants" -db $cassandra_ips \
+	-ks resume_reference_db --test-mode > exp
+geminicassandra query -q "select chrom, start, ref, alt from variants" -db $cassandra_ips \
+	-ks resume_db --test-mode > obs
+check obs exp
+rm obs exp
+
+echo "    load.t9...\c"
+geminicassandra query -q "select sample_id, num_hom_ref, num_het, num_hom_alt, num_unknown from sample_genotype_counts" \
+	-db $cassandra_ips -ks resume_reference_db | sort > exp
+geminicassandra query -q "select sample_id, num_hom_ref, num_het, num_hom_alt, num_unknown from sample_genotype_counts" \
+	-db $cassandra_ips -ks resume_db | sort > obs
+check obs exp
+rm obs exp
+
+###########################################################################################
+#10. Test appending a VCF with a variant that is loaded already, a new variant and a new
+#    sample: the loaded variant is not added again, and the new sample gets its gt columns
+###########################################################################################
+geminicassandra load -v test.append.vcf --skip-gene-tables --skip-gerp-bp --skip-cadd --test-mode \
+	-db $cassandra_ips -ks append_db
+geminicassandra load -v test.append.new_sample.vcf --skip-gene-tables --skip-gerp-bp --skip-cadd --test-mode \
+	--append -db $cassandra_ips -ks append_db
+
+echo "    load.t10...\c"
+echo "chr1	9999	A	G
+chr1	19999	C	T
+chr1	29999	G	A
+chr1	39999	T	C" > exp
+geminicassandra query -q "select chrom, start, ref, alt from variants" -db $cassandra_ips -ks append_db --test-mode > obs
+check obs exp
+rm obs exp
+
+echo "    load.t11...\c"
+echo "samples	3
+variants	4" > exp
+geminicassandra query -q "select table_name, n_rows from row_counts" -db $cassandra_ips -ks append_db | sort > obs
+check obs exp
+rm obs exp
+
+echo "    load.t12...\c"
+echo "chr1	9999	0	None
+chr1	19999	1	3
+chr1	29999	0	None
+chr1	39999	0	1" > exp
+geminicassandra query -q "select chrom, start, gt_types_s2, gt_types_s3 from variants" -db $cassandra_ips \
+	-ks append_db --test-mode > obs
+check obs exp
+rm obs exp